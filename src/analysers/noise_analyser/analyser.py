@@ -7,6 +7,7 @@ from pyrocko.guts import Int, Bool, Float, String, StringChoice
 from pyrocko.gf.meta import OutOfBounds
 from ..base import Analyser, AnalyserConfig, AnalyserResult
 from grond.dataset import NotFound
+from grond.timing import nan_to_none
 
 logger = logging.getLogger('grond.analysers.NoiseAnalyser')
 
@@ -35,14 +36,12 @@ def get_phase_arrival_time(engine, source, target, wavename):
     scalar, float of the arrival time of the wave
     """
     store = engine.get_store(target.store_id)
-    dist = target.distance_to(source)
-    depth = source.depth
-    return store.t(wavename, (depth, dist)) + source.time
+    return store.t(wavename, source, target) + source.time
 
 
 def seismic_noise_variance(traces, engine, source, targets,
                            nwindows, pre_event_noise_duration,
-                           check_events, phase_def):
+                           check_events, phase_def, arrival_times=None):
     """
     Calculate variance of noise in a given time before P-Phase onset.
 
@@ -69,6 +68,9 @@ def seismic_noise_variance(traces, engine, source, targets,
     arrivals : list
         of :class'pyrocko.gf.Timing' arrivals of waveforms
         at station
+    arrival_times : list
+        of precomputed arrival times of ``phase_def`` at the targets,
+        optional
 
     Returns
     -------
@@ -79,7 +81,7 @@ def seismic_noise_variance(traces, engine, source, targets,
     global_cmt_catalog = catalog.GlobalCMT()
     var_ds = []
     ev_ws = []
-    for tr, target in zip(traces, targets):
+    for itarget, (tr, target) in enumerate(zip(traces, targets)):
         stat_w = 1.
 
         if tr is None:
@@ -87,9 +89,12 @@ def seismic_noise_variance(traces, engine, source, targets,
             ev_ws.append(num.nan)
         else:
 
-            arrival_time = get_phase_arrival_time(
-                engine=engine, source=source,
-                target=target, wavename=phase_def)
+            if arrival_times is not None:
+                arrival_time = arrival_times[itarget]
+            else:
+                arrival_time = get_phase_arrival_time(
+                    engine=engine, source=source,
+                    target=target, wavename=phase_def)
             if check_events:
                 events = global_cmt_catalog.get_events(
                     time_range=(
@@ -210,22 +215,39 @@ class NoiseAnalyser(Analyser):
 
             deltat = min(deltats)
 
+            source = problem.base_source
+            timing_table = problem.get_timing_table()
+            arrival_times = timing_table.get_times(
+                engine, self.phase_def, source, targets)
+            tmins_fit = timing_table.get_times_many(
+                engine, [target.misfit_config.tmin for target in targets],
+                source, targets)
+            tmaxs_fit = timing_table.get_times_many(
+                engine, [target.misfit_config.tmax for target in targets],
+                source, targets)
+
             data = []
-            for target in targets:
+            for itarget, target in enumerate(targets):
                 try:
                     freqlimits = list(target.get_freqlimits())
                     freqlimits = tuple(freqlimits)
 
-                    source = problem.base_source
+                    arrival_time = nan_to_none(arrival_times[itarget])
+                    if arrival_time is None:
+                        # raises OutOfBounds
+                        arrival_time = get_phase_arrival_time(
+                            engine=engine,
+                            source=source,
+                            target=target,
+                            wavename=self.phase_def)
 
-                    arrival_time = get_phase_arrival_time(
-                        engine=engine,
-                        source=source,
-                        target=target,
-                        wavename=self.phase_def)
+                        arrival_times[itarget] = arrival_time
 
                     tmin_fit, tmax_fit, tfade, tfade_taper = \
-                        target.get_taper_params(engine, source)
+                        target.get_taper_params(
+                            engine, source,
+                            tmin_fit=nan_to_none(tmins_fit[itarget]),
+                            tmax_fit=nan_to_none(tmaxs_fit[itarget]))
 
                     data.append([
                         tmin_fit,
@@ -264,7 +286,8 @@ class NoiseAnalyser(Analyser):
             var_ds, ev_ws = seismic_noise_variance(
                 traces_noise, engine, source, targets,
                 self.nwindows, tdur,
-                self.check_events, self.phase_def)
+                self.check_events, self.phase_def,
+                arrival_times=arrival_times)
 
             amp_maxs = num.array([
                 (tr.absmax()[1] if tr else num.nan) for tr in traces_signal])
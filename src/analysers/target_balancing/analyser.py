@@ -65,6 +65,7 @@ class TargetBalancingAnalyser(Analyser):
 
         wproblem = problem.copy()
         wproblem.targets = wtargets
+        wproblem.invalidate_parameter_layout()
 
         xbounds = wproblem.get_parameter_bounds()
 
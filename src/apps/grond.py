@@ -725,6 +725,10 @@ def command_go(args):
         parser.add_option(
             '--preserve', dest='preserve', action='store_true',
             help='preserve old rundir')
+        parser.add_option(
+            '--resume', dest='resume', action='store_true',
+            help='continue an interrupted run from the last checkpoint in '
+                 'its rundir')
         parser.add_option(
             '--status', dest='status', default='state',
             type='choice', choices=['state', 'quiet'],
@@ -738,6 +742,12 @@ def command_go(args):
             '--threads', dest='nthreads', type=int, default=1,
             help='set number of threads per process (default: 1).'
                  'Set to 0 to use all available cores.')
+        parser.add_option(
+            '--workers', dest='nworkers', type=int, default=1,
+            help='set number of worker processes evaluating the candidate '
+                 'models of one event in parallel (default: 1). Only '
+                 'effective in sampler phases with batch_size > 1. Cannot '
+                 'be combined with --parallel.')
 
     parser, options, args = cl_parse('go', args, setup)
 
@@ -754,7 +764,9 @@ def command_go(args):
             preserve=options.preserve,
             status=status,
             nparallel=options.nparallel,
-            nthreads=options.nthreads)
+            nthreads=options.nthreads,
+            nworkers=options.nworkers,
+            resume=options.resume)
         if len(env.get_selected_event_names()) == 1:
             logger.info(CLIHints(
                 'go', rundir=env.get_rundir_path()))
@@ -0,0 +1,171 @@
+'''
+Persistent cache for expensive, reproducible intermediate arrays.
+
+Arrays are stored as ``.npy`` files under ``<pyrocko cache_dir>/grond/`` and
+are looked up by a hash of everything they are derived from. Files are written
+atomically, so the cache can be shared by concurrent runs and processes.
+Sections can be limited in size with :py:func:`prune`, which removes the least
+recently used files. Any section directory may also be deleted by hand.
+'''
+
+import os
+import os.path as op
+import hashlib
+import logging
+import tempfile
+
+import numpy as num
+
+from pyrocko import config, util
+
+logger = logging.getLogger('grond.cache')
+
+
+def get_cache_dir(section):
+    return op.join(config.config().cache_dir, 'grond', section)
+
+
+def make_key(*args):
+    '''
+    Hash arrays and other values with a stable string representation.
+    '''
+    h = hashlib.sha1()
+    for arg in args:
+        if isinstance(arg, num.ndarray):
+            arg = num.ascontiguousarray(arg)
+            h.update(str((arg.dtype.str, arg.shape)).encode('utf8'))
+            h.update(arg.data)
+        else:
+            h.update(repr(arg).encode('utf8'))
+
+    return h.hexdigest()
+
+
+def touch(fn):
+    # the modification time marks the last use, see prune()
+    try:
+        os.utime(fn, None)
+    except OSError:
+        pass
+
+
+def load_array(section, key):
+    fn = op.join(get_cache_dir(section), key + '.npy')
+    if not op.exists(fn):
+        return None
+
+    try:
+        array = num.load(fn)
+        touch(fn)
+        return array
+    except (OSError, IOError, ValueError) as e:
+        logger.warning('Failed to read cache file "%s": %s' % (fn, e))
+        return None
+
+
+def save_array(section, key, array):
+    dirname = get_cache_dir(section)
+    try:
+        util.ensuredir(dirname)
+        fd, fn_temp = tempfile.mkstemp(dir=dirname, suffix='.npy.temp')
+        with os.fdopen(fd, 'wb') as f:
+            num.save(f, array)
+
+        os.rename(fn_temp, op.join(dirname, key + '.npy'))
+
+    except (OSError, IOError) as e:
+        logger.warning(
+            'Failed to write to cache directory "%s": %s' % (dirname, e))
+
+
+def load_arrays(section, key):
+    '''
+    Get dictionary of arrays stored with :py:func:`save_arrays` or ``None``.
+    '''
+    fn = op.join(get_cache_dir(section), key + '.npz')
+    if not op.exists(fn):
+        return None
+
+    try:
+        with num.load(fn) as data:
+            arrays = dict(data.items())
+
+        touch(fn)
+        return arrays
+
+    except (OSError, IOError, ValueError) as e:
+        logger.warning('Failed to read cache file "%s": %s' % (fn, e))
+        return None
+
+
+def save_arrays(section, key, arrays):
+    dirname = get_cache_dir(section)
+    try:
+        util.ensuredir(dirname)
+        fd, fn_temp = tempfile.mkstemp(dir=dirname, suffix='.npz.temp')
+        with os.fdopen(fd, 'wb') as f:
+            num.savez(f, **arrays)
+
+        os.rename(fn_temp, op.join(dirname, key + '.npz'))
+
+    except (OSError, IOError) as e:
+        logger.warning(
+            'Failed to write to cache directory "%s": %s' % (dirname, e))
+
+
+def cached_array(section, key, func):
+    '''
+    Get array from cache, or compute it with ``func()`` and store it.
+    '''
+    array = load_array(section, key)
+    if array is None:
+        array = func()
+        save_array(section, key, array)
+    else:
+        logger.debug('Using cached %s (%s).' % (section, key))
+
+    return array
+
+
+def prune(section, max_bytes):
+    '''
+    Remove least recently used files of a cache section exceeding a size
+    limit.
+
+    :param max_bytes: maximum total size of the files in the section
+    :returns: number of files removed
+    '''
+    dirname = get_cache_dir(section)
+    try:
+        fns = [
+            op.join(dirname, fn) for fn in os.listdir(dirname)
+            if not fn.endswith('.temp')]
+    except OSError:
+        return 0
+
+    entries = []
+    for fn in fns:
+        try:
+            st = os.stat(fn)
+            entries.append((st.st_mtime, st.st_size, fn))
+        except OSError:
+            # removed by a concurrent process
+            pass
+
+    entries.sort(reverse=True)
+    nbytes = 0
+    nremoved = 0
+    for _, size, fn in entries:
+        nbytes += size
+        if nbytes > max_bytes:
+            try:
+                os.remove(fn)
+                nremoved += 1
+            except OSError:
+                pass
+
+    if nremoved:
+        logger.debug(
+            'Removed %i files from cache section "%s".' % (nremoved, section))
+
+    return nremoved
@@ -15,7 +15,8 @@ from pyrocko import parimap, model, marker as pmarker
 
 from .dataset import NotFound, InvalidObject
 from .problems.base import Problem, load_problem_info_and_data, \
-    load_problem_data
+    load_problem_data, load_problem_info, load_optimiser_info, \
+    HistoryWriter, HistoryStorage
 
 from .optimisers.base import BadProblem
 from .targets.waveform.target import WaveformMisfitResult
@@ -177,8 +178,18 @@ def harvest(rundir, problem=None, nbest=10, force=False, weed=0):
     if weed == 2:
         ibests = ibests[gms[ibests] < mean_gm_best]
 
-    for i in ibests:
-        problem.dump_problem_data(dumpdir, xs[i], misfits[i, :, :])
+    # keep the storage layout of the rundir, misfits aggregated per target
+    # have been expanded on loading
+    storage = HistoryStorage.load_rundir(rundir)
+    aggregate = None
+    if storage.is_aggregated(problem):
+        aggregate = problem.aggregate_misfits
+
+    writer = HistoryWriter(
+        dumpdir, storage=storage, aggregate=aggregate,
+        durability=getattr(optimiser, 'history_durability', 'flush'))
+    writer.write(xs[ibests, :], misfits[ibests, :, :])
+    writer.close()
 
     logger.info('Done harvesting problem "%s".' % problem.name)
 
@@ -252,6 +263,8 @@ def check(
                     target for target in problem.targets
                     if util.match_nslc(target_string_ids, target.string_id())]
 
+                problem.invalidate_parameter_layout()
+
             logger.info(
                 'Number of targets (selected): %i' % len(problem.targets))
 
@@ -425,13 +438,23 @@ g_state = {}
 
 def go(environment,
        force=False, preserve=False,
-       nparallel=1, status='state', nthreads=0):
+       nparallel=1, status='state', nthreads=0, nworkers=1, resume=False):
+
+    nevents = environment.nevents_selected
+    nparallel = max(1, min(nparallel, nevents))
+    if nparallel > 1 and nworkers > 1:
+        # events processed in parallel run in daemonic processes, which are
+        # not allowed to start the worker processes of the optimiser
+        raise GrondError(
+            'Options --parallel and --workers cannot be combined when '
+            'processing more than one event. Use either --parallel=N to '
+            'process events in parallel or --workers=M to evaluate the '
+            'models of each event in parallel.')
 
     g_data = (environment, force, preserve,
-              status, nparallel, nthreads)
+              status, nparallel, nthreads, nworkers, resume)
     g_state[id(g_data)] = g_data
 
-    nevents = environment.nevents_selected
     for x in parimap.parimap(
             process_event,
             range(environment.nevents_selected),
@@ -443,8 +466,8 @@ def go(environment,
 
 def process_event(ievent, g_data_id):
 
-    environment, force, preserve, status, nparallel, nthreads = \
-        g_state[g_data_id]
+    environment, force, preserve, status, nparallel, nthreads, nworkers, \
+        resume = g_state[g_data_id]
 
     config = environment.get_config()
     event_name = environment.get_selected_event_names()[ievent]
@@ -466,12 +489,22 @@ def process_event(ievent, g_data_id):
         dict(problem_name=problem.name))
     environment.set_rundir_path(rundir)
 
+    from .optimisers import highscore
+
+    resuming = False
     if op.exists(rundir):
-        if preserve:
+        if resume and op.exists(
+                op.join(rundir, highscore.OptimiserCheckpoint.filename)):
+            resuming = True
+        elif preserve:
             nold_rundirs = len(glob.glob(rundir + '*'))
             shutil.move(rundir, rundir+'-old-%d' % (nold_rundirs))
         elif force:
             shutil.rmtree(rundir)
+        elif resume:
+            logger.warn('Skipping problem "%s": no checkpoint to resume from '
+                        'in rundir: %s' % (problem.name, rundir))
+            return
         else:
             logger.warn('Skipping problem "%s": rundir already exists: %s' %
                         (problem.name, rundir))
@@ -484,22 +517,36 @@ def process_event(ievent, g_data_id):
 
     logger.info('Rundir: %s' % rundir)
 
-    logger.info('Analysing problem "%s".' % problem.name)
+    if resuming:
+        # continue with the setup of the interrupted run, as analysers and
+        # bootstrap weights stored in the rundir
+        problem = load_problem_info(rundir)
+        config.setup_modelling_environment(problem)
+        for target in problem.targets:
+            target.set_dataset(ds)
+
+        optimiser = load_optimiser_info(rundir)
+        optimiser.set_nthreads(nthreads)
+        optimiser.set_nworkers(nworkers)
 
-    for analyser_conf in config.analyser_configs:
-        analyser = analyser_conf.get_analyser()
-        analyser.analyse(problem, ds)
+    else:
+        logger.info('Analysing problem "%s".' % problem.name)
+
+        for analyser_conf in config.analyser_configs:
+            analyser = analyser_conf.get_analyser()
+            analyser.analyse(problem, ds)
 
-    basepath = config.get_basepath()
-    config.change_basepath(rundir)
-    guts.dump(config, filename=op.join(rundir, 'config.yaml'))
-    config.change_basepath(basepath)
+        basepath = config.get_basepath()
+        config.change_basepath(rundir)
+        guts.dump(config, filename=op.join(rundir, 'config.yaml'))
+        config.change_basepath(basepath)
 
-    optimiser = config.optimiser_config.get_optimiser()
-    optimiser.set_nthreads(nthreads)
+        optimiser = config.optimiser_config.get_optimiser()
+        optimiser.set_nthreads(nthreads)
+        optimiser.set_nworkers(nworkers)
 
-    optimiser.init_bootstraps(problem)
-    problem.dump_problem_info(rundir)
+        optimiser.init_bootstraps(problem)
+        problem.dump_problem_info(rundir)
 
     monitor = None
     if status == 'state':
@@ -511,8 +558,7 @@ def process_event(ievent, g_data_id):
         xs_inject = synt.get_x()[num.newaxis, :]
 
     try:
-        if xs_inject is not None:
-            from .optimisers import highscore
+        if xs_inject is not None and not resuming:
             if not isinstance(optimiser, highscore.HighScoreOptimiser):
                 raise GrondError(
                     'Optimiser does not support injections.')
@@ -520,9 +566,10 @@ def process_event(ievent, g_data_id):
             optimiser.sampler_phases[0:0] = [
                 highscore.InjectionSamplerPhase(xs_inject=xs_inject)]
 
-        optimiser.optimise(
-            problem,
-            rundir=rundir)
+        if resuming:
+            optimiser.optimise(problem, rundir=rundir, resume=True)
+        else:
+            optimiser.optimise(problem, rundir=rundir)
 
         harvest(rundir, problem, force=True)
 
@@ -1,21 +1,25 @@
 import glob
 import copy
+import os
 import os.path as op
 import logging
 import math
+import time
+import weakref
 import numpy as num
 
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from pyrocko import util, pile, model, config, trace, \
     marker as pmarker
 from pyrocko.io.io_common import FileLoadError
 from pyrocko.fdsn import enhanced_sacpz, station as fs
-from pyrocko.guts import (Object, Tuple, String, Float, List, Bool, dump_all,
-                          load_all)
+from pyrocko.guts import (Object, Tuple, String, Float, List, Bool, Int,
+                          dump_all, load_all)
 
 from pyrocko import gf
 
 from .meta import Path, HasPaths, expand_template, GrondError
+from .cache import make_key, load_arrays, save_arrays
 
 from .synthetic_tests import SyntheticTest
 
@@ -72,6 +76,153 @@ def dump_station_corrections(station_corrections, filename):
     return dump_all(station_corrections, filename=filename)
 
 
+g_waveform_caches = weakref.WeakSet()
+
+
+class WaveformCache(object):
+    '''
+    Least recently used cache for processed waveforms with a byte budget.
+
+    Entries are traces or ``None`` for waveforms which are not available
+    (negative entries). When the size of the cached traces exceeds
+    ``nbytes_max``, the least recently used entries are evicted. Hits, misses
+    and evictions are counted, hits on negative entries separately.
+    '''
+
+    # approximate memory used by an entry, in addition to its samples
+    nbytes_entry = 1024
+
+    # interval of status log messages in seconds
+    log_interval = 60.
+
+    def __init__(self, nbytes_max=1024**3):
+        self.nbytes_max = nbytes_max
+        self._entries = OrderedDict()
+        self.nbytes = 0
+        self.nnegative = 0
+        self.nhits = 0
+        self.nhits_negative = 0
+        self.nmisses = 0
+        self.nevictions = 0
+        self._tlog_last = time.time()
+
+        g_waveform_caches.add(self)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __getitem__(self, key):
+        self._log_status()
+        try:
+            value, _ = self._entries[key]
+        except KeyError:
+            self.nmisses += 1
+            raise
+
+        self._entries.move_to_end(key)
+        if value is None:
+            self.nhits_negative += 1
+        else:
+            self.nhits += 1
+
+        return value
+
+    def __setitem__(self, key, value):
+        if key in self._entries:
+            self._remove(key)
+
+        nbytes = self.nbytes_entry
+        if value is not None:
+            nbytes += value.ydata.nbytes
+        else:
+            self.nnegative += 1
+
+        self._entries[key] = (value, nbytes)
+        self.nbytes += nbytes
+
+        while self.nbytes > self.nbytes_max and len(self._entries) > 1:
+            self._remove(next(iter(self._entries)))
+            self.nevictions += 1
+
+    def _remove(self, key):
+        value, nbytes = self._entries.pop(key)
+        self.nbytes -= nbytes
+        if value is None:
+            self.nnegative -= 1
+
+    def clear(self):
+        self._entries.clear()
+        self.nbytes = 0
+        self.nnegative = 0
+
+    def status_str(self):
+        return (
+            'waveform cache: %i entries (%i negative), %.1f of %.1f MiB, '
+            '%i hits (%i negative), %i misses, %i evictions' % (
+                len(self), self.nnegative,
+                self.nbytes / 1024.**2, self.nbytes_max / 1024.**2,
+                self.nhits, self.nhits_negative, self.nmisses,
+                self.nevictions))
+
+    def _log_status(self):
+        t = time.time()
+        if t - self._tlog_last > self.log_interval:
+            logger.info(self.status_str())
+            self._tlog_last = t
+
+
+def get_waveform_cache_status():
+    '''
+    Status of the waveform caches in use by this process.
+
+    :returns: list of strings, see :py:meth:`WaveformCache.status_str`
+    '''
+    return [cache.status_str() for cache in list(g_waveform_caches)
+            if len(cache) != 0]
+
+
+def file_identities(paths):
+    '''
+    Get paths and modification times of existing files.
+    '''
+    identities = []
+    for path in paths:
+        try:
+            identities.append((op.abspath(path), os.stat(path).st_mtime))
+        except OSError:
+            pass
+
+    return identities
+
+
+def traces_to_arrays(trs):
+    arrays = dict(
+        codes=num.array([tr.nslc_id for tr in trs], dtype=num.str_),
+        tmins=num.array([tr.tmin for tr in trs], dtype=num.float64),
+        deltats=num.array([tr.deltat for tr in trs], dtype=num.float64))
+
+    for itr, tr in enumerate(trs):
+        arrays['ydata_%i' % itr] = tr.ydata
+
+    return arrays
+
+
+def arrays_to_traces(arrays):
+    trs = []
+    for itr, (codes, tmin, deltat) in enumerate(zip(
+            arrays['codes'], arrays['tmins'], arrays['deltats'])):
+
+        trs.append(trace.Trace(
+            *[str(x) for x in codes],
+            tmin=float(tmin), deltat=float(deltat),
+            ydata=arrays['ydata_%i' % itr]))
+
+    return trs
+
+
 class Dataset(object):
 
     def __init__(self, event_name=None):
@@ -92,16 +243,22 @@ class Dataset(object):
         self.apply_correction_factors = True
         self.apply_displaced_sampling_workaround = False
         self.extend_incomplete = False
+        self.persistent_waveform_cache = False
         self.clip_handling = 'by_nsl'
         self.kite_scenes = []
         self.gnss_campaigns = []
         self.synthetic_test = None
         self._picks = None
-        self._cache = {}
+        self._cache = WaveformCache()
+        self._raw_files_index = None
+        self._response_sources = []
         self._event_name = event_name
 
     def empty_cache(self):
-        self._cache = {}
+        self._cache.clear()
+
+    def set_waveform_cache_size(self, nbytes_max):
+        self._cache.nbytes_max = nbytes_max
 
     def set_synthetic_test(self, synthetic_test):
         self.synthetic_test = synthetic_test
@@ -178,6 +335,10 @@ class Dataset(object):
 
     def add_responses(self, sacpz_dirname=None, stationxml_filenames=None):
         if sacpz_dirname:
+            self._response_sources.append(file_identities(
+                op.join(sacpz_dirname, fn)
+                for fn in sorted(os.listdir(sacpz_dirname))))
+
             logger.debug(
                 'Loading SAC PZ responses from "%s"...' % sacpz_dirname)
             for x in enhanced_sacpz.iload_dirname(sacpz_dirname):
@@ -188,6 +349,9 @@ class Dataset(object):
                 if not op.exists(stationxml_filename):
                     continue
 
+                self._response_sources.append(
+                    file_identities([stationxml_filename]))
+
                 logger.debug(
                     'Loading StationXML responses from "%s"...' %
                     stationxml_filename)
@@ -647,6 +811,52 @@ class Dataset(object):
 
         return projections
 
+    def _get_raw_files_index(self):
+        # nsl -> list of (tmin, tmax, path, mtime) of the raw waveform files
+        # with data of the station, rebuilt when files are added or removed
+        nupdates = self.pile.get_update_count()
+        if self._raw_files_index is None \
+                or self._raw_files_index[0] != nupdates:
+
+            index = defaultdict(list)
+            for f in self.pile.iter_files():
+                for nsl in set(tr.nslc_id[:3] for tr in f.traces):
+                    index[nsl].append((f.tmin, f.tmax, f.abspath, f.mtime))
+
+            self._raw_files_index = (nupdates, index)
+
+        return self._raw_files_index[1]
+
+    def _get_persistent_cache_key(
+            self, station, tmin, tmax, tpad, quantity, backazimuth):
+
+        # Everything the processed waveforms of a station depend on, besides
+        # the processing parameters: raw data files, response files, station
+        # corrections, clippings and processing flags. Files are identified
+        # by path and modification time, so that no data or responses have
+        # to be loaded to look up a cache entry.
+        nsl = station.nsl()
+        raw_files = sorted(
+            (path, mtime)
+            for (tmin_f, tmax_f, path, mtime)
+            in self._get_raw_files_index().get(nsl, [])
+            if tmin_f <= tmax + tpad and tmin - tpad <= tmax_f)
+
+        corrections = sorted(
+            str(sc) for (codes, sc) in self.station_corrections.items()
+            if codes[:3] == nsl)
+
+        clippings = sorted(
+            (k, v.tolist()) for (k, v) in self.clippings.items()
+            if k[:3] == nsl)
+
+        return make_key(
+            str(station), raw_files, self._response_sources, quantity,
+            corrections, clippings,
+            self.apply_correction_factors, self.apply_correction_delays,
+            self.apply_displaced_sampling_workaround, self.extend_incomplete,
+            self.clip_handling, backazimuth)
+
     def _get_waveform(
             self,
             obj, quantity='displacement',
@@ -685,14 +895,18 @@ class Dataset(object):
 
         cache_k = nslc + (
             tmin, tmax, tuple(freqlimits), tfade, deltat, tpad, quantity)
-        if cache is not None and (nslc + cache_k) in cache:
-            obj = cache[nslc + cache_k]
-            if isinstance(obj, Exception):
-                raise obj
-            elif obj is None:
-                raise NotFound('Waveform not found!', nslc)
+        if cache is not None:
+            try:
+                obj = cache[nslc + cache_k]
+            except KeyError:
+                pass
             else:
-                return obj
+                if isinstance(obj, Exception):
+                    raise obj
+                elif obj is None:
+                    raise NotFound('Waveform not found!', nslc)
+                else:
+                    return obj
 
         syn_test = self.synthetic_test
         toffset_noise_extract = 0.0
@@ -730,6 +944,29 @@ class Dataset(object):
         else:
             abs_delay_max = 0.0
 
+        persistent_key = None
+        if self.persistent_waveform_cache and not syn_test and not debug:
+            if source is not None and target is not None:
+                backazimuth_key = source.azibazi_to(target)[1]
+            else:
+                backazimuth_key = backazimuth
+
+            persistent_key = make_key(
+                cache_k, self._get_persistent_cache_key(
+                    station, tmin, tmax, tpad + abs_delay_max + tfade,
+                    quantity, backazimuth_key))
+
+            arrays = load_arrays('waveforms', persistent_key)
+            if arrays is not None:
+                trs_projected = arrays_to_traces(arrays)
+                if cache is not None:
+                    for tr in trs_projected:
+                        cache[tr.nslc_id + cache_k] = tr
+
+                for tr in trs_projected:
+                    if tr.channel == channel:
+                        return tr
+
         projections = self._get_projections(
             station, backazimuth, source, target, tmin, tmax)
 
@@ -826,6 +1063,11 @@ class Dataset(object):
                 if tr.channel == channel:
                     tr_return = tr
 
+            if persistent_key is not None and tr_return:
+                save_arrays(
+                    'waveforms', persistent_key,
+                    traces_to_arrays(trs_projected))
+
             if debug:
                 return trs_projected, trs_restituted, trs_raw, tr_return
 
@@ -985,6 +1227,16 @@ class DatasetConfig(HasPaths):
     extend_incomplete = Bool.T(
         default=False,
         help='Extend incomplete seismic traces.')
+    persistent_waveform_cache = Bool.T(
+        default=False,
+        help='Keep restituted and projected waveforms in a persistent cache '
+             'in the Pyrocko cache directory, shared by all Grond processes. '
+             'Raw waveform files modified in place are not detected.')
+    waveform_cache_size = Int.T(
+        default=1024**3,
+        help='Memory budget in bytes for processed waveforms kept in memory. '
+             'When exceeded, the least recently used waveforms are '
+             'discarded.')
     picks_paths = List.T(
         Path.T())
     blacklist_paths = List.T(
@@ -1118,6 +1370,8 @@ class DatasetConfig(HasPaths):
                 ds.apply_displaced_sampling_workaround = \
                     self.apply_displaced_sampling_workaround
                 ds.extend_incomplete = self.extend_incomplete
+                ds.persistent_waveform_cache = self.persistent_waveform_cache
+                ds.set_waveform_cache_size(self.waveform_cache_size)
 
                 for picks_path in self.picks_paths:
                     ds.add_picks(
@@ -1144,6 +1398,7 @@ __all__ = '''
     DatasetError
     InvalidObject
     NotFound
+    WaveformCache
     StationCorrection
     load_station_corrections
     dump_station_corrections
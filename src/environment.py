@@ -107,7 +107,8 @@ class Environment(object):
             'misfits',
             'models',
             'choices',
-            'chains'
+            'chains',
+            'history_storage.yaml'
             ]
 
         if op.exists(destination) and not force:
@@ -9,6 +9,7 @@ from datetime import timedelta
 
 from pyrocko import util, guts
 from grond.environment import Environment
+from grond.dataset import get_waveform_cache_status
 
 
 logger = logging.getLogger('grond.monit')
@@ -186,6 +187,9 @@ class GrondMonitor(threading.Thread):
         if optimiser_status.extra_footer is not None:
             lnadd(optimiser_status.extra_footer)
 
+        for status in get_waveform_cache_status():
+            lnadd(status)
+
         self._tm.show('\n'.join(lines))
 
     def terminate(self):
@@ -18,11 +18,16 @@ class Optimiser(Object):
     def __init__(self, **kwargs):
         Object.__init__(self, **kwargs)
         self._nthreads = 0
+        self._nworkers = 1
 
     def set_nthreads(self, nthreads):
         logger.debug('Setting nthreads to %d', nthreads)
         self._nthreads = nthreads
 
+    def set_nworkers(self, nworkers):
+        logger.debug('Setting nworkers to %d', nworkers)
+        self._nworkers = nworkers
+
     def optimise(self, problem):
         raise NotImplementedError
 
@@ -4,14 +4,20 @@ import os.path as op
 import os
 import logging
 import time
+import multiprocessing
 import numpy as num
 from collections import OrderedDict
 
-from pyrocko.guts import StringChoice, Int, Float, Object, List
+from scipy.special import ndtr, ndtri, log_ndtr
+
+from pyrocko import guts
+from pyrocko.guts import StringChoice, Int, Float, Object, List, Dict, \
+    String
 from pyrocko.guts_array import Array
 
 from grond.meta import GrondError, Forbidden, has_get_plot_classes
-from grond.problems.base import ModelHistory
+from grond.problems.base import ModelHistory, HistoryStorage, \
+    HistoryWriter, correlated_residuals
 from grond.optimisers.base import Optimiser, OptimiserConfig, BadProblem, \
     OptimiserStatus
 
@@ -24,15 +30,77 @@ def nextpow2(i):
     return 2**int(math.ceil(math.log(i)/math.log(2.)))
 
 
-def excentricity_compensated_probabilities(xs, sbx, factor):
+g_worker_state = {}
+
+
+def _worker_init(state_id):
+    # GF stores opened by the parent must not be shared between processes,
+    # each worker gets its own engine. All other caches are inherited.
+    problem = g_worker_state[state_id]
+    engine = problem.get_engine()
+    if engine is not None:
+        problem.set_engine(guts.clone(engine))
+
+
+def _worker_misfits(args):
+    state_id, models, mask = args
+    return g_worker_state[state_id].misfits_many(models, mask=mask)
+
+
+class MisfitsPool(object):
+    '''
+    Pool of worker processes evaluating chunks of model batches.
+
+    The workers are forked from the current process, so that they start with
+    the data caches which the problem has built up so far. Chunks are
+    collected in submission order, the result is identical to that of
+    :py:meth:`grond.problems.base.Problem.misfits_many` in the main process.
+    '''
+
+    def __init__(self, problem, nworkers):
+        self._state_id = id(problem)
+        self._nworkers = nworkers
+        g_worker_state[self._state_id] = problem
+        self._pool = multiprocessing.get_context('fork').Pool(
+            nworkers,
+            initializer=_worker_init,
+            initargs=(self._state_id,))
+
+    def misfits_many(self, models, mask=None):
+        chunks = num.array_split(
+            models, min(self._nworkers, models.shape[0]))
+
+        return num.concatenate(self._pool.map(
+            _worker_misfits,
+            [(self._state_id, chunk, mask) for chunk in chunks]))
+
+    def close(self, terminate=False):
+        if terminate:
+            self._pool.terminate()
+        else:
+            self._pool.close()
+
+        self._pool.join()
+        del g_worker_state[self._state_id]
+
+
+def excentricity_compensated_neighbours(xs, sbx, factor):
+    '''
+    Count models within the scaled unit distance of each model (incl. itself).
+    '''
+    n = xs.shape[0]
     inonflat = num.where(sbx != 0.0)[0]
-    scale = num.zeros_like(sbx)
-    scale[inonflat] = 1.0 / (sbx[inonflat] * (factor if factor != 0. else 1.0))
-    distances_sqr_all = num.sum(
-        ((xs[num.newaxis, :, :] - xs[:, num.newaxis, :]) *
-         scale[num.newaxis, num.newaxis, :])**2, axis=2)
-    probabilities = 1.0 / num.sum(distances_sqr_all < 1.0, axis=1)
-    # print(num.sort(num.sum(distances_sqr_all < 1.0, axis=1)))
+    scale = 1.0 / (sbx[inonflat] * (factor if factor != 0. else 1.0))
+    distances_sqr_all = num.zeros((n, n))
+    for ipar, s in zip(inonflat, scale):
+        d = xs[:, ipar] * s
+        distances_sqr_all += (d[num.newaxis, :] - d[:, num.newaxis])**2
+
+    return num.sum(distances_sqr_all < 1.0, axis=1)
+
+
+def excentricity_compensated_probabilities(xs, sbx, factor):
+    probabilities = 1.0 / excentricity_compensated_neighbours(xs, sbx, factor)
     probabilities /= num.sum(probabilities)
     return probabilities
 
@@ -40,12 +108,82 @@ def excentricity_compensated_probabilities(xs, sbx, factor):
 def excentricity_compensated_choice(xs, sbx, factor, rstate):
     probabilities = excentricity_compensated_probabilities(
         xs, sbx, factor)
+    return choice_cumulative(num.cumsum(probabilities), rstate)
+
+
+def choice_cumulative(cumulative_probabilities, rstate):
     r = rstate.random_sample()
-    ichoice = num.searchsorted(num.cumsum(probabilities), r)
-    ichoice = min(ichoice, xs.shape[0]-1)
+    ichoice = num.searchsorted(cumulative_probabilities, r)
+    ichoice = min(ichoice, cumulative_probabilities.size-1)
     return ichoice
 
 
+def truncated_normal(mean, std, xmin, xmax, rstate):
+    '''
+    Draw from normal distributions truncated to ``[xmin, xmax]``.
+
+    Inverse transform sampling, evaluated on the side of the mean where the
+    interval has most of its mass, for accuracy in the tails. Where the
+    interval is beyond the resolution of the normal CDF, the inversion is
+    done on the logarithm of the CDF. Arguments are broadcast against each
+    other; exactly one uniform random number is consumed per drawn value, in
+    row-major order. Where ``std`` is zero, ``mean`` is returned.
+    '''
+    mean, std, xmin, xmax = num.broadcast_arrays(mean, std, xmin, xmax)
+    u = rstate.random_sample(mean.shape)
+
+    with num.errstate(divide='ignore', invalid='ignore'):
+        a = (xmin - mean) / std
+        b = (xmax - mean) / std
+
+    flip = a + b > 0.
+    za = num.where(flip, -b, a)
+    zb = num.where(flip, -a, b)
+    pa = ndtr(za)
+    pb = ndtr(zb)
+
+    with num.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        z = num.array(ndtri(pa + u * (pb - pa)))
+
+        tail = num.logical_and(
+            num.logical_not(pb > pa), num.isfinite(zb))
+
+        if num.any(tail):
+            z[tail] = truncated_normal_tail(za[tail], zb[tail], u[tail])
+
+    z = num.where(flip, -z, z)
+    x = num.clip(mean + std * z, xmin, xmax)
+    return num.where(std > 0., x, mean)
+
+
+def truncated_normal_tail(za, zb, u, niter_max=50):
+    '''
+    Inverse CDF of the standard normal distribution truncated to ``[za, zb]``
+    with ``za + zb <= 0``, in log space.
+
+    Solves ``log_ndtr(z) = log(ndtr(za) + u * (ndtr(zb) - ndtr(za)))`` with
+    Newton's method, starting from an exponential approximation of the tail.
+    '''
+    la = log_ndtr(za)
+    lb = log_ndtr(zb)
+    target = lb + num.log(u + (1.0 - u) * num.exp(la - lb))
+
+    rate = num.abs(zb)
+    z = zb + num.log1p(-u * -num.expm1(-rate * (zb - za))) / rate
+    z = num.where(num.isfinite(z), num.clip(z, za, zb), zb)
+
+    for _ in range(niter_max):
+        lz = log_ndtr(z)
+        log_pdf = -0.5 * z**2 - 0.5 * math.log(2.0 * math.pi)
+        dz = (lz - target) * num.exp(lz - log_pdf)
+        dz[num.logical_not(num.isfinite(dz))] = 0.0
+        z = num.clip(z - dz, za, zb)
+        if num.all(num.abs(dz) <= 1e-12 * (1.0 + num.abs(z))):
+            break
+
+    return num.where(num.isfinite(target), z, za)
+
+
 def local_std(xs):
     ssbx = num.sort(xs, axis=0)
     dssbx = num.diff(ssbx, axis=0)
@@ -100,6 +238,55 @@ class Sample(Object):
         return i
 
 
+class RandomStateCheckpoint(Object):
+    '''State of a :py:class:`numpy.random.RandomState`.'''
+
+    keys = Array.T(shape=(624,), dtype=num.uint32, serialize_as='base64')
+    pos = Int.T()
+    has_gauss = Int.T()
+    cached_gaussian = Float.T()
+
+    @classmethod
+    def from_rstate(cls, rstate):
+        _, keys, pos, has_gauss, cached_gaussian = rstate.get_state()
+        return cls(
+            keys=keys,
+            pos=int(pos),
+            has_gauss=int(has_gauss),
+            cached_gaussian=float(cached_gaussian))
+
+    def get_rstate(self):
+        rstate = num.random.RandomState()
+        rstate.set_state((
+            'MT19937', self.keys, self.pos, self.has_gauss,
+            self.cached_gaussian))
+
+        return rstate
+
+
+class OptimiserCheckpoint(Object):
+    '''
+    State of an optimisation at a given number of models.
+
+    Written periodically to the rundir, next to ``optimiser.yaml``, to be able
+    to resume an interrupted run.
+    '''
+
+    nmodels = Int.T(
+        help='Number of models in the rundir at the checkpoint.')
+    file_sizes = Dict.T(
+        String.T(), Int.T(),
+        help='Sizes of the model history files at the checkpoint in bytes.')
+    rstates = Dict.T(
+        Int.T(), RandomStateCheckpoint.T(),
+        help='Random states of the sampler phases, by index of the phase.')
+    isbad_mask = Array.T(
+        shape=(None,), dtype=num.bool, serialize_as='list', optional=True,
+        help='Targets with unavailable misfits.')
+
+    filename = 'optimiser_checkpoint.yaml'
+
+
 class SamplerPhase(Object):
     niterations = Int.T(
         help='Number of iteration for this phase.')
@@ -109,6 +296,12 @@ class SamplerPhase(Object):
     seed = Int.T(
         optional=True,
         help='Random state seed.')
+    batch_size = Int.T(
+        default=1,
+        help='Number of candidate models to draw from the current state and '
+             'to evaluate together in one step. Phases independent of the '
+             'chains state, as the uniform sampler, give the same models as '
+             'with a batch size of 1.')
 
     def __init__(self, *args, **kwargs):
         Object.__init__(self, *args, **kwargs)
@@ -120,9 +313,39 @@ class SamplerPhase(Object):
 
         return self._rstate
 
+    def get_rstate_checkpoint(self):
+        if self._rstate is None:
+            return None
+
+        return RandomStateCheckpoint.from_rstate(self._rstate)
+
+    def set_rstate_checkpoint(self, checkpoint):
+        self._rstate = checkpoint.get_rstate()
+
     def get_raw_sample(self, problem, iiter, chains):
         raise NotImplementedError
 
+    def get_raw_samples(self, problem, iiter, chains, n):
+        return [
+            self.get_raw_sample(problem, iiter + i, chains)
+            for i in range(n)]
+
+    def get_samples(self, problem, iiter, chains, n):
+        assert 0 <= iiter and iiter + n <= self.niterations
+
+        samples = []
+        for i, sample in enumerate(
+                self.get_raw_samples(problem, iiter, chains, n)):
+
+            try:
+                sample.preconstrain(problem)
+            except Forbidden:
+                sample = self.get_sample(problem, iiter + i, chains)
+
+            samples.append(sample)
+
+        return samples
+
     def get_sample(self, problem, iiter, chains):
         assert 0 <= iiter < self.niterations
 
@@ -182,6 +405,8 @@ class DirectedSamplerPhase(SamplerPhase):
 
     ntries_sample_limit = Int.T(default=1000)
 
+    NCANDIDATES_MULTIVARIATE = 16
+
     def get_scatter_scale_factor(self, iiter):
         s = self.scatter_scale
         sa = self.scatter_scale_begin
@@ -199,23 +424,13 @@ class DirectedSamplerPhase(SamplerPhase):
         else:
             return s or 1.0
 
-    def get_raw_sample(self, problem, iiter, chains):
-        rstate = self.get_rstate()
-        factor = self.get_scatter_scale_factor(iiter)
-        npar = problem.nparameters
-        pnames = problem.parameter_names
-        xbounds = problem.get_parameter_bounds()
-
+    def get_starting_point(self, chains, ichain_choice, rstate):
         ilink_choice = None
-        ichain_choice = num.argmin(chains.accept_sum)
-
         if self.starting_point == 'excentricity_compensated':
-            models = chains.models(ichain_choice)
-            ilink_choice = excentricity_compensated_choice(
-                models,
-                chains.standard_deviation_models(
-                    ichain_choice, self.standard_deviation_estimator),
-                2., rstate)
+            ilink_choice = choice_cumulative(
+                chains.excentricity_compensated_cumulative(
+                    ichain_choice, self.standard_deviation_estimator, 2.),
+                rstate)
 
             xchoice = chains.model(ichain_choice, ilink_choice)
 
@@ -230,79 +445,106 @@ class DirectedSamplerPhase(SamplerPhase):
             assert False, 'invalid starting_point choice: %s' % (
                 self.starting_point)
 
-        ntries_sample = 0
-        if self.sampler_distribution == 'normal':
-            x = num.zeros(npar, dtype=num.float)
-            sx = chains.standard_deviation_models(
-                ichain_choice, self.standard_deviation_estimator)
+        return ilink_choice, xchoice
 
-            for ipar in range(npar):
-                ntries = 0
-                while True:
-                    if sx[ipar] > 0.:
-                        v = rstate.normal(
-                            xchoice[ipar],
-                            factor*sx[ipar])
-                    else:
-                        v = xchoice[ipar]
+    def get_raw_samples(self, problem, iiter, chains, n):
+        '''
+        Draw a block of ``n`` samples from the current state of the chains.
+
+        The random state of the phase is consumed in a fixed order: first
+        the starting points of all samples, one after the other, then, for
+        ``sampler_distribution='normal'``, one uniform random number per
+        sample and parameter, in row-major order, or for
+        ``sampler_distribution='multivariate_normal'``, standard normal
+        vectors in rejection batches of ``NCANDIDATES_MULTIVARIATE``, sample
+        after sample.
+        '''
+        rstate = self.get_rstate()
+        xbounds = problem.get_parameter_bounds()
 
-                    if xbounds[ipar, 0] <= v and \
-                            v <= xbounds[ipar, 1]:
+        ichain_choice = num.argmin(chains.accept_sum)
 
-                        break
+        starting_points = [
+            self.get_starting_point(chains, ichain_choice, rstate)
+            for i in range(n)]
 
-                    if ntries > self.ntries_sample_limit:
-                        logger.warning(
-                            'failed to produce a suitable '
-                            'candidate sample from normal '
-                            'distribution for parameter \'%s\''
-                            '- drawing from uniform instead.' %
-                            pnames[ipar])
-                        v = rstate.uniform(xbounds[ipar, 0],
-                                           xbounds[ipar, 1])
-                        break
+        xchoices = num.array([xchoice for (_, xchoice) in starting_points])
+        factors = num.array([
+            self.get_scatter_scale_factor(iiter + i) for i in range(n)])
 
-                    ntries += 1
+        if self.sampler_distribution == 'normal':
+            sx = chains.standard_deviation_models(
+                ichain_choice, self.standard_deviation_estimator)
 
-                x[ipar] = v
+            xs = truncated_normal(
+                xchoices,
+                factors[:, num.newaxis] * sx[num.newaxis, :],
+                xbounds[:, 0], xbounds[:, 1],
+                rstate)
 
         elif self.sampler_distribution == 'multivariate_normal':
-            ok_mask_sum = num.zeros(npar, dtype=num.int)
-            while True:
-                ntries_sample += 1
-                xcandi = rstate.multivariate_normal(
-                    xchoice, factor**2 * chains.cov(ichain_choice))
+            xs = num.array([
+                self.get_multivariate_normal(
+                    problem, chains, ichain_choice, xchoice, factor, rstate)
+                for (xchoice, factor) in zip(xchoices, factors)])
 
-                ok_mask = num.logical_and(
-                    xbounds[:, 0] <= xcandi, xcandi <= xbounds[:, 1])
+        samples = []
+        for x, (ilink_choice, _) in zip(xs, starting_points):
+            imodel_base = None
+            if ilink_choice is not None:
+                imodel_base = chains.imodel(ichain_choice, ilink_choice)
 
-                if num.all(ok_mask):
-                    break
+            samples.append(Sample(
+                model=x,
+                ichain_base=ichain_choice,
+                ilink_base=ilink_choice,
+                imodel_base=imodel_base))
 
-                ok_mask_sum += ok_mask
+        return samples
 
-                if ntries_sample > self.ntries_sample_limit:
-                    logger.warning(
-                        'failed to produce a suitable candidate '
-                        'sample from multivariate normal '
-                        'distribution, (%s) - drawing from uniform instead' %
-                        ', '.join('%s:%i' % xx for xx in
-                                  zip(pnames, ok_mask_sum)))
-                    xbounds = problem.get_parameter_bounds()
-                    xcandi = problem.random_uniform(xbounds, rstate)
-                    break
+    def get_raw_sample(self, problem, iiter, chains):
+        return self.get_raw_samples(problem, iiter, chains, 1)[0]
 
-            x = xcandi
+    def get_multivariate_normal(
+            self, problem, chains, ichain_choice, xchoice, factor, rstate):
 
-        imodel_base = None
-        if ilink_choice is not None:
-            imodel_base = chains.imodel(ichain_choice, ilink_choice)
+        npar = problem.nparameters
+        pnames = problem.parameter_names
+        xbounds = problem.get_parameter_bounds()
 
-        return Sample(
-            model=x,
-            ichain_base=ichain_choice,
-            ilink_base=ilink_choice,
-            imodel_base=imodel_base)
+        lcov = chains.covariance_cholesky(ichain_choice)
+
+        ntries_sample = 0
+        ok_mask_sum = num.zeros(npar, dtype=num.int)
+        while True:
+            # vectorised rejection: draw a batch of candidates at a time
+            xcandis = xchoice + factor * num.dot(
+                rstate.standard_normal(
+                    (self.NCANDIDATES_MULTIVARIATE, npar)),
+                lcov.T)
+
+            ok_masks = num.logical_and(
+                xbounds[:, 0] <= xcandis, xcandis <= xbounds[:, 1])
+
+            iok = num.where(num.all(ok_masks, axis=1))[0]
+            if iok.size != 0:
+                xcandi = xcandis[iok[0]]
+                break
+
+            ntries_sample += xcandis.shape[0]
+            ok_mask_sum += num.sum(ok_masks, axis=0)
+
+            if ntries_sample > self.ntries_sample_limit:
+                logger.warning(
+                    'failed to produce a suitable candidate '
+                    'sample from multivariate normal '
+                    'distribution, (%s) - drawing from uniform instead' %
+                    ', '.join('%s:%i' % xx for xx in
+                              zip(pnames, ok_mask_sum)))
+                xcandi = problem.random_uniform(xbounds, rstate)
+                break
+
+        return xcandi
 
 
 def make_bayesian_weights(nbootstrap, nmisfits,
@@ -329,6 +571,9 @@ def make_bayesian_weights(nbootstrap, nmisfits,
 
 
 class Chains(object):
+
+    GOTO_BLOCK_SIZE = 32
+
     def __init__(
             self, problem, history, nchains, nlinks_cap):
 
@@ -344,6 +589,7 @@ class Chains(object):
         self.nread = 0
 
         self.accept_sum = num.zeros(self.nchains, dtype=num.int)
+        self._chain_caches = {}
         self._acceptance_history = num.zeros(
             (self.nchains, 1024), dtype=num.bool)
 
@@ -359,31 +605,60 @@ class Chains(object):
 
         while self.nread < n:
             nread = self.nread
-            gbms = self.history.bootstrap_misfits[nread, :]
+            nblock = min(n - nread, self.GOTO_BLOCK_SIZE)
+            nlinks = self.nlinks
+
+            # (nchains, nblock)
+            gbms = self.history.bootstrap_misfits[nread:nread+nblock, :].T
+            gbms_nan = num.isnan(gbms)
+
+            # A new link is accepted if fewer than nlinks_cap - 1 of the
+            # links seen so far sort before or equal to it. The chains hold
+            # the best of all links seen, so it is sufficient to count in the
+            # current chains and in the preceding models of the block. NaN
+            # sorts last, as in num.sort.
+            rank = num.sum(num.logical_or(
+                self.chains_m[:, :nlinks, num.newaxis]
+                <= gbms[:, num.newaxis, :],
+                gbms_nan[:, num.newaxis, :]), axis=1)
+
+            if nblock > 1:
+                before = num.logical_or(
+                    gbms[:, num.newaxis, :] <= gbms[:, :, num.newaxis],
+                    gbms_nan[:, :, num.newaxis])
+
+                before &= num.tri(nblock, k=-1, dtype=num.bool)
+                rank += num.sum(before, axis=2)
+
+            accept = rank < self.nlinks_cap - 1
+
+            chains_m = num.concatenate(
+                (self.chains_m[:, :nlinks], gbms), axis=1)
+            chains_i = num.concatenate(
+                (self.chains_i[:, :nlinks],
+                 num.repeat(
+                     num.arange(nread, nread+nblock)[num.newaxis, :],
+                     self.nchains, axis=0)),
+                axis=1)
+
+            isort = num.argsort(chains_m, axis=1, kind='mergesort')
+            ichains = num.arange(self.nchains)[:, num.newaxis]
+
+            self.nlinks = min(nlinks + nblock, self.nlinks_cap - 1)
+            self.chains_m[:, :self.nlinks] = \
+                chains_m[ichains, isort[:, :self.nlinks]]
+            self.chains_i[:, :self.nlinks] = \
+                chains_i[ichains, isort[:, :self.nlinks]]
 
-            self.chains_m[:, self.nlinks] = gbms
-            self.chains_i[:, self.nlinks] = nread
-            nbootstrap = self.chains_m.shape[0]
-
-            self.nlinks += 1
-            chains_m = self.chains_m
-            chains_i = self.chains_i
-
-            for ichain in range(nbootstrap):
-                isort = num.argsort(chains_m[ichain, :self.nlinks])
-                chains_m[ichain, :self.nlinks] = chains_m[ichain, isort]
-                chains_i[ichain, :self.nlinks] = chains_i[ichain, isort]
+            self._append_acceptance(accept)
+            self.accept_sum += num.sum(accept, axis=1)
 
-            if self.nlinks == self.nlinks_cap:
-                accept = (chains_i[:, self.nlinks_cap-1] != nread) \
-                    .astype(num.bool)
-                self.nlinks -= 1
-            else:
-                accept = num.ones(self.nchains, dtype=num.bool)
+            for ichain in num.where(num.any(accept, axis=1))[0]:
+                self._chain_caches.pop(ichain, None)
 
-            self._append_acceptance(accept)
-            self.accept_sum += accept
-            self.nread += 1
+            if num.any(accept):
+                self._chain_caches.pop(None, None)
+            self.nread += nblock
 
     def load(self):
         return self.goto()
@@ -424,7 +699,44 @@ class Chains(object):
     def best_model_misfit(self, ichain=0):
         return self.chains_m[ichain, 0]
 
+    def _cached(self, ichain, key, func, *args):
+        # Results derived from the links of a chain stay valid until the
+        # chain accepts a new link. Results derived from all chains are kept
+        # under ichain None, which is invalidated on any acceptance.
+        cache = self._chain_caches.setdefault(ichain, {})
+        if key not in cache:
+            cache[key] = func(*args)
+
+        return cache[key]
+
+    def _cache_key_chain(self, ichain, estimator):
+        if estimator == 'standard_deviation_all_chains':
+            return None, ichain
+        else:
+            return ichain, None
+
     def standard_deviation_models(self, ichain, estimator):
+        icache, _ = self._cache_key_chain(ichain, estimator)
+        return self._cached(
+            icache, ('standard_deviation', estimator),
+            self._standard_deviation_models, ichain, estimator)
+
+    def excentricity_compensated_cumulative(self, ichain, estimator, factor):
+        '''
+        Cumulative excentricity compensated probabilities of a chain's links.
+        '''
+        def func():
+            return num.cumsum(excentricity_compensated_probabilities(
+                self.models(ichain),
+                self.standard_deviation_models(ichain, estimator),
+                factor))
+
+        icache, ikey = self._cache_key_chain(ichain, estimator)
+        return self._cached(
+            icache, ('excentricity_compensated', estimator, factor, ikey),
+            func)
+
+    def _standard_deviation_models(self, ichain, estimator):
         if estimator == 'median_density_single_chain':
             xs = self.models(ichain)
             return local_std(xs)
@@ -438,21 +750,43 @@ class Chains(object):
             assert False, 'invalid standard_deviation_estimator choice'
 
     def covariance_models(self, ichain):
+        return self._cached(
+            ichain, 'covariance', self._covariance_models, ichain)
+
+    def _covariance_models(self, ichain):
         xs = self.models(ichain)
-        return num.cov(xs.T)
+        return num.atleast_2d(num.cov(xs.T))
+
+    def covariance_cholesky(self, ichain):
+        '''
+        Factor ``L`` of the chain's model covariance, with ``L L^T = cov``.
+
+        Falls back to a square root from the eigendecomposition if the
+        covariance is not positive definite, e.g. with fixed parameters.
+        '''
+        def func():
+            cov = self.covariance_models(ichain)
+            try:
+                return num.linalg.cholesky(cov)
+            except num.linalg.LinAlgError:
+                w, v = num.linalg.eigh(cov)
+                return v * num.sqrt(num.maximum(w, 0.))
+
+        return self._cached(ichain, 'covariance_cholesky', func)
 
     @property
     def acceptance_history(self):
         return self._acceptance_history[:, :self.nread]
 
     def _append_acceptance(self, acceptance):
-        if self.nread >= self._acceptance_history.shape[1]:
+        nblock = acceptance.shape[1]
+        if self.nread + nblock > self._acceptance_history.shape[1]:
             new_buf = num.zeros(
-                (self.nchains, nextpow2(self.nread+1)), dtype=num.bool)
+                (self.nchains, nextpow2(self.nread+nblock)), dtype=num.bool)
             new_buf[:, :self._acceptance_history.shape[1]] = \
                 self._acceptance_history
             self._acceptance_history = new_buf
-        self._acceptance_history[:, self.nread] = acceptance
+        self._acceptance_history[:, self.nread:self.nread+nblock] = acceptance
 
 
 @has_get_plot_classes
@@ -464,15 +798,20 @@ class HighScoreOptimiser(Optimiser):
     nbootstrap = Int.T(default=100)
     bootstrap_type = BootstrapTypeChoice.T(default='bayesian')
     bootstrap_seed = Int.T(default=23)
+    history_storage = HistoryStorage.T(optional=True)
+    history_durability = StringChoice.T(
+        choices=['flush', 'fsync'], default='flush')
 
     SPARKS = u'\u2581\u2582\u2583\u2584\u2585\u2586\u2587\u2588'
     ACCEPTANCE_AVG_LEN = 100
+    CHECKPOINT_INTERVAL = 60.
 
     def __init__(self, **kwargs):
         Optimiser.__init__(self, **kwargs)
         self._bootstrap_weights = None
         self._bootstrap_residuals = None
         self._correlated_weights = None
+        self._correlated_bootstrap_residuals = None
         self._status_chains = None
         self._rstate_bootstrap = None
 
@@ -570,6 +909,14 @@ class HighScoreOptimiser(Optimiser):
 
         return self._correlated_weights
 
+    def get_correlated_bootstrap_residuals(self, problem):
+        if self._correlated_bootstrap_residuals is None:
+            self._correlated_bootstrap_residuals = correlated_residuals(
+                self.get_bootstrap_residuals(problem),
+                self.get_correlated_weights(problem))
+
+        return self._correlated_bootstrap_residuals
+
     @property
     def nchains(self):
         return self.nbootstrap + 1
@@ -592,11 +939,13 @@ class HighScoreOptimiser(Optimiser):
 
         assert False, 'sample out of bounds'
 
-    def log_progress(self, problem, iiter, niter, phase, iiter_phase):
+    def log_progress(
+            self, problem, iiter, niter, phase, iiter_phase, nbatch=1):
+
         t = time.time()
         if self._tlog_last < t - 10. \
                 or iiter_phase == 0 \
-                or iiter_phase == phase.niterations - 1:
+                or iiter_phase + nbatch >= phase.niterations:
 
             logger.info(
                 '%s at %i/%i (%s, %i/%i)' % (
@@ -606,66 +955,190 @@ class HighScoreOptimiser(Optimiser):
 
             self._tlog_last = t
 
-    def optimise(self, problem, rundir=None):
-        if rundir is not None:
-            self.dump(filename=op.join(rundir, 'optimiser.yaml'))
+    def dump_checkpoint(self, rundir, history, isbad_mask):
+        history.flush()
 
-        history = ModelHistory(problem,
-                               nchains=self.nchains,
-                               path=rundir, mode='w')
-        chains = self.chains(problem, history)
+        file_sizes = {}
+        for name in HistoryWriter.file_names:
+            fn = op.join(rundir, name)
+            if op.exists(fn):
+                file_sizes[name] = op.getsize(fn)
 
+        rstates = {}
+        for iphase, phase in enumerate(self.sampler_phases):
+            rstate = phase.get_rstate_checkpoint()
+            if rstate is not None:
+                rstates[iphase] = rstate
+
+        checkpoint = OptimiserCheckpoint(
+            nmodels=history.nmodels,
+            file_sizes=file_sizes,
+            rstates=rstates,
+            isbad_mask=isbad_mask)
+
+        fn = op.join(rundir, OptimiserCheckpoint.filename)
+        checkpoint.dump(filename=fn + '.temp')
+        os.rename(fn + '.temp', fn)
+
+    def load_checkpoint(self, rundir):
+        '''
+        Restore the sampler state from the checkpoint in a rundir.
+
+        Models written to the rundir after the checkpoint are discarded.
+        '''
+        fn = op.join(rundir, OptimiserCheckpoint.filename)
+        if not op.exists(fn):
+            raise GrondError('No checkpoint to resume from in %s' % rundir)
+
+        checkpoint = guts.load(filename=fn)
+
+        for name in HistoryWriter.file_names:
+            fn = op.join(rundir, name)
+            if not op.exists(fn):
+                continue
+
+            size = checkpoint.file_sizes.get(name, 0)
+            if op.getsize(fn) < size:
+                raise GrondError(
+                    'File %s is shorter than at the checkpoint, cannot '
+                    'resume.' % fn)
+
+            os.truncate(fn, size)
+
+        for iphase, rstate in checkpoint.rstates.items():
+            self.sampler_phases[iphase].set_rstate_checkpoint(rstate)
+
+        return checkpoint
+
+    def optimise(self, problem, rundir=None, resume=False):
+        '''
+        Run the optimisation.
+
+        :param rundir: directory to write the models to
+        :param resume: continue an interrupted run in *rundir* from its last
+            checkpoint. The result is the same as that of an uninterrupted
+            run.
+        '''
         niter = self.niterations
         isbad_mask = None
+        iiter = 0
+
+        if resume:
+            checkpoint = self.load_checkpoint(rundir)
+            iiter = checkpoint.nmodels
+            isbad_mask = checkpoint.isbad_mask
+            logger.info(
+                '%s: resuming at %i/%i' % (problem.name, iiter+1, niter))
+
+        elif rundir is not None:
+            self.dump(filename=op.join(rundir, 'optimiser.yaml'))
+
+        history = ModelHistory(
+            problem,
+            nchains=self.nchains,
+            path=rundir, mode='a' if resume else 'w',
+            storage=self.history_storage,
+            durability=self.history_durability,
+            correlated_weights=self.get_correlated_weights(problem))
+        chains = self.chains(problem, history)
+        chains.load()
+
+        assert history.nmodels == iiter
+
         self._tlog_last = 0
-        for iiter in range(niter):
-            iphase, phase, iiter_phase = self.get_sampler_phase(iiter)
-            self.log_progress(problem, iiter, niter, phase, iiter_phase)
+        tcheckpoint = time.time()
+        pool = None
+        try:
+            while iiter < niter:
+                iphase, phase, iiter_phase = self.get_sampler_phase(iiter)
+                nbatch = max(1, min(
+                    phase.batch_size, phase.niterations - iiter_phase))
 
-            sample = phase.get_sample(problem, iiter_phase, chains)
-            sample.iphase = iphase
+                self.log_progress(
+                    problem, iiter, niter, phase, iiter_phase, nbatch)
 
-            if isbad_mask is not None and num.any(isbad_mask):
-                isok_mask = num.logical_not(isbad_mask)
-            else:
-                isok_mask = None
+                samples = phase.get_samples(
+                    problem, iiter_phase, chains, nbatch)
+
+                for sample in samples:
+                    sample.iphase = iphase
+
+                if isbad_mask is not None and num.any(isbad_mask):
+                    isok_mask = num.logical_not(isbad_mask)
+                else:
+                    isok_mask = None
+
+                models = num.array([sample.model for sample in samples])
+                if pool is None and self._nworkers > 1 and nbatch > 1 \
+                        and iiter > 0:
+                    pool = MisfitsPool(problem, self._nworkers)
+
+                if pool is not None and nbatch > 1:
+                    misfits = pool.misfits_many(models, mask=isok_mask)
+                else:
+                    misfits = problem.misfits_many(models, mask=isok_mask)
 
-            misfits = problem.misfits(sample.model, mask=isok_mask)
+                bootstrap_misfits = problem.combine_misfits(
+                    misfits,
+                    extra_weights=self.get_bootstrap_weights(problem),
+                    extra_residuals=self.get_bootstrap_residuals(problem),
+                    extra_correlated_weights=self.get_correlated_weights(
+                        problem),
+                    extra_correlated_residuals=(
+                        self.get_correlated_bootstrap_residuals(problem)))
 
-            bootstrap_misfits = problem.combine_misfits(
-                misfits,
-                extra_weights=self.get_bootstrap_weights(problem),
-                extra_residuals=self.get_bootstrap_residuals(problem),
-                extra_correlated_weights=self.get_correlated_weights(problem))
-            isbad_mask_new = num.isnan(misfits[:, 0])
-            if isbad_mask is not None and num.any(
-                    isbad_mask != isbad_mask_new):
+                for ibatch in range(nbatch):
+                    isbad_mask_new = num.isnan(misfits[ibatch, :, 0])
+                    if isbad_mask is not None and num.any(
+                            isbad_mask != isbad_mask_new):
 
-                errmess = [
-                    'problem %s: inconsistency in data availability'
-                    ' at iteration %i' %
-                    (problem.name, iiter)]
+                        errmess = [
+                            'problem %s: inconsistency in data availability'
+                            ' at iteration %i' %
+                            (problem.name, iiter + ibatch)]
 
-                for target, isbad_new, isbad in zip(
-                        problem.targets, isbad_mask_new, isbad_mask):
+                        for target, isbad_new, isbad in zip(
+                                problem.targets, isbad_mask_new, isbad_mask):
 
-                    if isbad_new != isbad:
-                        errmess.append('  %s, %s -> %s' % (
-                            target.string_id(), isbad, isbad_new))
+                            if isbad_new != isbad:
+                                errmess.append('  %s, %s -> %s' % (
+                                    target.string_id(), isbad, isbad_new))
 
-                raise BadProblem('\n'.join(errmess))
+                        raise BadProblem('\n'.join(errmess))
 
-            isbad_mask = isbad_mask_new
+                    isbad_mask = isbad_mask_new
 
-            if num.all(isbad_mask):
-                raise BadProblem(
-                    'Problem %s: all target misfit values are NaN.'
-                    % problem.name)
+                    if num.all(isbad_mask):
+                        raise BadProblem(
+                            'Problem %s: all target misfit values are NaN.'
+                            % problem.name)
 
-            history.append(
-                sample.model, misfits,
-                bootstrap_misfits,
-                sample.pack_context())
+                history.extend(
+                    models, misfits,
+                    bootstrap_misfits,
+                    num.array([sample.pack_context() for sample in samples]))
+
+                iiter += nbatch
+
+                if rundir is not None and (
+                        iiter == niter or
+                        time.time() - tcheckpoint > self.CHECKPOINT_INTERVAL):
+
+                    self.dump_checkpoint(rundir, history, isbad_mask)
+                    tcheckpoint = time.time()
+
+        except BaseException:
+            if pool is not None:
+                pool.close(terminate=True)
+                pool = None
+
+            raise
+
+        finally:
+            if pool is not None:
+                pool.close()
+
+            history.close()
 
     @property
     def niterations(self):
@@ -772,12 +1245,27 @@ class HighScoreOptimiserConfig(OptimiserConfig):
         default=100,
         help='Number of bootstrap realisations to be tracked simultaneously in'
              ' the optimisation.')
+    history_storage = HistoryStorage.T(
+        optional=True,
+        help='Storage policy for the misfits written to the rundir. By '
+             'default, all misfit contributions are stored uncompressed with '
+             'double precision.')
+    history_durability = StringChoice.T(
+        choices=['flush', 'fsync'],
+        default='flush',
+        help='Durability of the models and misfits written to the rundir. '
+             '\'flush\' hands the data to the operating system, so it '
+             'survives a crash of Grond. \'fsync\' additionally forces it '
+             'to disk, so it also survives a crash of the machine, at the '
+             'cost of slower writes.')
 
     def get_optimiser(self):
         return HighScoreOptimiser(
             sampler_phases=list(self.sampler_phases),
             chain_length_factor=self.chain_length_factor,
-            nbootstrap=self.nbootstrap)
+            nbootstrap=self.nbootstrap,
+            history_storage=self.history_storage,
+            history_durability=self.history_durability)
 
 
 def load_optimiser_history(dirname, problem):
@@ -810,6 +1298,7 @@ __all__ = '''
     UniformSamplerPhase
     DirectedSamplerPhase
     Chains
+    OptimiserCheckpoint
     HighScoreOptimiserConfig
     HighScoreOptimiser
 '''.split()
@@ -339,7 +339,7 @@ modified.
 
         gcms = problem.combine_misfits(
             history.misfits,
-            extra_correlated_weights=optimiser.get_correlated_weights(problem),
+            extra_correlated_weights=history.get_correlated_weights(optimiser),
             get_contributions=True)
 
         gcms = gcms[isort, :]
@@ -12,9 +12,10 @@ import logging
 import os.path as op
 import os
 import time
+import zlib
 
 from pyrocko import gf, util, guts
-from pyrocko.guts import Object, String, List, Dict, Int
+from pyrocko.guts import Object, String, List, Dict, Int, Bool, StringChoice
 
 from grond.meta import ADict, Parameter, GrondError, xjoin, Forbidden, \
     StringID, has_get_plot_classes
@@ -22,6 +23,7 @@ from ..targets import MisfitResult, MisfitTarget, TargetGroup, \
     WaveformMisfitTarget, SatelliteMisfitTarget, GNSSCampaignMisfitTarget
 
 from grond import stats
+from grond.timing import TimingTable
 
 from grond.version import __version__
 
@@ -52,6 +54,184 @@ def correlated_weights(values, weight_matrix):
     return num.matmul(values, weight_matrix)
 
 
+def correlated_residuals(extra_residuals, extra_correlated_weights):
+    '''
+    Apply correlated weights to residual perturbations
+
+    As the correlated weighting is linear, the weighted perturbations of the
+    bootstrap residuals can be computed once and reused for every model.
+
+    :param extra_residuals: 2D array of perturbations, indexed as
+        ``extra_residuals[ibootstrap, iresidual]``
+    :param extra_correlated_weights: dictionary of ``imisfit: correlated
+        weight matrix``, see :meth:`Problem.combine_misfits`
+
+    :returns: dictionary of ``imisfit: weighted perturbations``
+    '''
+    corr = dict()
+    for imisfit, corr_weight_mat in extra_correlated_weights.items():
+        jmisfit = imisfit + corr_weight_mat.shape[0]
+        corr[imisfit] = correlated_weights(
+            extra_residuals[:, imisfit:jmisfit], corr_weight_mat)
+
+    return corr
+
+
+class ModellingPlan(object):
+    '''
+    Compiled bookkeeping of the forward modelling for a set of targets.
+
+    Maps the unique modelling targets requested by the misfit targets to
+    integer indices, so that results can be distributed back to the misfit
+    targets without rebuilding and hashing target lists for every model.
+    The plan is built once and reused as long as targets and mask do not
+    change, see :py:meth:`Problem.get_modelling_plan`.
+    '''
+
+    def __init__(self, engine, source, targets, mask=None):
+        self.targets = list(targets)
+        self.target_modelling_targets = [
+            target.prepare_modelling(engine, source, targets)
+            for target in targets]
+
+        self.targets_prepare_per_model = [
+            target for target in targets
+            if target.prepare_modelling_per_model]
+
+        self.mask = None
+        self.set_mask(engine, source, mask)
+
+    def matches_targets(self, targets):
+        return len(targets) == len(self.targets) and all(
+            a is b for (a, b) in zip(targets, self.targets))
+
+    def matches_mask(self, mask):
+        if mask is None or self.mask is None:
+            return mask is None and self.mask is None
+
+        return num.array_equal(mask, self.mask)
+
+    def set_mask(self, engine, source, mask):
+        '''
+        Rebuild the index maps for a new target mask.
+
+        Targets are not prepared again.
+        '''
+        if mask is not None:
+            mask = num.array(mask, dtype=num.bool)
+
+        self.mask = mask
+
+        index = {}
+        self.target_indices = []
+        for itarget, mtargets in enumerate(self.target_modelling_targets):
+            if mask is None or mask[itarget]:
+                self.target_indices.append(
+                    [index.setdefault(mtarget, len(index))
+                     for mtarget in mtargets])
+            else:
+                self.target_indices.append(None)
+
+        self.modelling_targets = list(index.keys())
+
+        self.engine_targets = []
+        self.iwaveform = []
+        for imtarget, mtarget in enumerate(self.modelling_targets):
+            if isinstance(mtarget, WaveformMisfitTarget):
+                self.engine_targets.extend(
+                    mtarget.get_plain_targets(engine, source))
+                self.iwaveform.append(imtarget)
+            else:
+                self.engine_targets.append(mtarget)
+
+    def prepare(self, engine, source):
+        '''
+        Prepare the targets which need to be prepared for every model.
+        '''
+        for target in self.targets_prepare_per_model:
+            target.prepare_modelling(engine, source, self.targets)
+
+    def finalize(self, engine, source, modelling_results):
+        '''
+        Distribute modelling results to the misfit targets.
+
+        :param modelling_results: results of the unique modelling targets
+        :returns: list of results, one for each misfit target
+        '''
+        results = []
+        for target, mtargets, indices in zip(
+                self.targets,
+                self.target_modelling_targets,
+                self.target_indices):
+
+            if indices is not None:
+                result = target.finalize_modelling(
+                    engine, source, mtargets,
+                    [modelling_results[i] for i in indices])
+            else:
+                result = gf.SeismosizerError(
+                    'target was excluded from modelling')
+
+            results.append(result)
+
+        return results
+
+
+class ParameterLayout(object):
+    '''
+    Precomputed layout of the parameters and misfits of a problem.
+
+    Holds the parameter list and names, the parameter bounds, the index
+    ranges of the target parameters and the misfit offsets of the targets,
+    which would otherwise be rebuilt from the targets on every access. The
+    layout is built once, see :py:meth:`Problem.get_parameter_layout`, and
+    must be invalidated with :py:meth:`Problem.invalidate_parameter_layout`
+    when targets or parameters of the problem are changed.
+    '''
+
+    def __init__(self, problem):
+        targets = problem.targets
+
+        parameters = list(problem.problem_parameters)
+        target_slices = []
+        for target in targets:
+            target_parameters = target.target_parameters
+            target_slices.append(slice(
+                len(parameters), len(parameters) + len(target_parameters)))
+            parameters.extend(target_parameters)
+
+        self.parameters = tuple(parameters)
+        self.dependants = tuple(problem.dependants)
+        self.combined = self.parameters + self.dependants
+        self.nparameters = len(self.parameters)
+        self.target_slices = tuple(target_slices)
+
+        self.parameter_names = tuple(p.name for p in self.combined)
+        self.index = {}
+        for ip, name in enumerate(self.parameter_names):
+            self.index.setdefault(name, ip)
+
+        # filled on first use by Problem.get_parameter_bounds and
+        # Problem.get_source_parameters
+        self.bounds = None
+        self.source_indices = None
+
+        self.misfit_offsets = num.cumsum(
+            [0] + [target.nmisfits for target in targets])
+        self.misfit_offsets.flags.writeable = False
+        self.nmisfits = int(self.misfit_offsets[-1])
+
+        self.waveform_targets = tuple(
+            t for t in targets if isinstance(t, WaveformMisfitTarget))
+        self.satellite_targets = tuple(
+            t for t in targets if isinstance(t, SatelliteMisfitTarget))
+        self.gnss_targets = tuple(
+            t for t in targets if isinstance(t, GNSSCampaignMisfitTarget))
+
+    def get_indices(self, names):
+        return [self.index[name] for name in names]
+
+
 class ProblemConfig(Object):
     '''
     Base class for config section defining the objective function setup.
@@ -88,6 +268,9 @@ class Problem(Object):
     grond_version = String.T(optional=True)
     nthreads = Int.T(default=1)
 
+    # approximate limit in bytes for intermediate arrays in combine_misfits
+    combine_misfits_memory_limit = 512 * 1024**2
+
     def __init__(self, **kwargs):
         Object.__init__(self, **kwargs)
 
@@ -97,11 +280,17 @@ class Problem(Object):
         self._target_weights = None
         self._engine = None
         self._family_mask = None
+        self._target_family_mask = None
+        self._timing_table = None
+        self._modelling_plan = None
+        self._parameter_layout = None
 
         if hasattr(self, 'problem_waveform_parameters') and self.has_waveforms:
             self.problem_parameters =\
                 self.problem_parameters + self.problem_waveform_parameters
 
+            self.invalidate_parameter_layout()
+
         self.check()
 
     @classmethod
@@ -123,28 +312,74 @@ class Problem(Object):
     def copy(self):
         o = copy.copy(self)
         o._target_weights = None
+        o._modelling_plan = None
+        o._parameter_layout = None
         return o
 
+    def get_parameter_layout(self):
+        '''
+        Get precomputed layout of parameters and misfits.
+
+        :returns: :py:class:`ParameterLayout`
+        '''
+        if self._parameter_layout is None:
+            self._parameter_layout = ParameterLayout(self)
+
+        return self._parameter_layout
+
+    def invalidate_parameter_layout(self):
+        '''
+        Discard the precomputed parameter layout.
+
+        Must be called when targets, parameters or ranges of the problem are
+        changed.
+        '''
+        self._parameter_layout = None
+
     def set_target_parameter_values(self, x):
-        nprob = len(self.problem_parameters)
-        for target in self.targets:
-            target.set_parameter_values(x[nprob:nprob+target.nparameters])
-            nprob += target.nparameters
+        layout = self.get_parameter_layout()
+        for target, sl in zip(self.targets, layout.target_slices):
+            target.set_parameter_values(x[sl])
+
+    def set_target_parameter_values_many(self, xs, sources):
+        layout = self.get_parameter_layout()
+        for target, sl in zip(self.targets, layout.target_slices):
+            target.set_parameter_values_many(sources, xs[:, sl])
 
     def get_parameter_dict(self, model, group=None):
         params = []
-        for ip, p in enumerate(self.parameters):
+        for ip, p in enumerate(self.get_parameter_layout().parameters):
             if group in p.groups or group is None:
                 params.append((p.name, model[ip]))
         return ADict(params)
 
     def get_parameter_array(self, d):
         arr = num.zeros(self.nparameters, dtype=num.float)
-        for ip, p in enumerate(self.parameters):
+        for ip, p in enumerate(self.get_parameter_layout().parameters):
             if p.name in d.keys():
                 arr[ip] = d[p.name]
         return arr
 
+    def get_source_parameters(self, x):
+        '''
+        Get the attributes of the base source set by a model.
+
+        :param x: model
+        :returns: dict with attribute values, made relative to the base
+            source where the corresponding range is relative
+        '''
+        layout = self.get_parameter_layout()
+        if layout.source_indices is None:
+            layout.source_indices = tuple(
+                (k, layout.index[k]) for k in self.base_source.keys()
+                if layout.index.get(k, layout.nparameters)
+                < layout.nparameters)
+
+        return dict(
+            (k, float(self.ranges[k].make_relative(
+                self.base_source[k], x[ip])))
+            for (k, ip) in layout.source_indices)
+
     def dump_problem_info(self, dirname):
         fn = op.join(dirname, 'problem.yaml')
         util.ensuredirs(fn)
@@ -175,19 +410,18 @@ class Problem(Object):
                 num.array(sampler_context, dtype='<i8').tofile(f)
 
     def name_to_index(self, name):
-        pnames = [p.name for p in self.combined]
-        return pnames.index(name)
+        try:
+            return self.get_parameter_layout().index[name]
+        except KeyError:
+            raise ValueError('%s is not a parameter' % name)
 
     @property
     def parameters(self):
-        target_parameters = []
-        for target in self.targets:
-            target_parameters.extend(target.target_parameters)
-        return self.problem_parameters + target_parameters
+        return list(self.get_parameter_layout().parameters)
 
     @property
     def parameter_names(self):
-        return [p.name for p in self.combined]
+        return list(self.get_parameter_layout().parameter_names)
 
     @property
     def dependant_names(self):
@@ -195,7 +429,7 @@ class Problem(Object):
 
     @property
     def nparameters(self):
-        return len(self.parameters)
+        return self.get_parameter_layout().nparameters
 
     @property
     def ntargets(self):
@@ -215,10 +449,7 @@ class Problem(Object):
 
     @property
     def nmisfits(self):
-        nmisfits = 0
-        for target in self.targets:
-            nmisfits += target.nmisfits
-        return nmisfits
+        return self.get_parameter_layout().nmisfits
 
     @property
     def ndependants(self):
@@ -226,26 +457,23 @@ class Problem(Object):
 
     @property
     def ncombined(self):
-        return len(self.parameters) + len(self.dependants)
+        return len(self.get_parameter_layout().combined)
 
     @property
     def combined(self):
-        return self.parameters + self.dependants
+        return list(self.get_parameter_layout().combined)
 
     @property
     def satellite_targets(self):
-        return [t for t in self.targets
-                if isinstance(t, SatelliteMisfitTarget)]
+        return list(self.get_parameter_layout().satellite_targets)
 
     @property
     def gnss_targets(self):
-        return [t for t in self.targets
-                if isinstance(t, GNSSCampaignMisfitTarget)]
+        return list(self.get_parameter_layout().gnss_targets)
 
     @property
     def waveform_targets(self):
-        return [t for t in self.targets
-                if isinstance(t, WaveformMisfitTarget)]
+        return list(self.get_parameter_layout().waveform_targets)
 
     @property
     def has_satellite(self):
@@ -261,6 +489,7 @@ class Problem(Object):
 
     def set_engine(self, engine):
         self._engine = engine
+        self.invalidate_modelling_plan()
 
     def get_engine(self):
         return self._engine
@@ -301,6 +530,16 @@ class Problem(Object):
 
         return self._target_weights
 
+    def get_aggregated_target_weights(self):
+        '''
+        Target weights for misfits aggregated per target.
+
+        See :py:meth:`aggregate_misfits`.
+        '''
+        return num.array(
+            [target.get_combined_weight()[0] for target in self.targets],
+            dtype=num.float)
+
     def get_target_residuals(self):
         pass
 
@@ -316,20 +555,25 @@ class Problem(Object):
 
         return ws
 
-    def inter_family_weights2(self, ns):
+    def inter_family_weights2(self, ns, per_target=False):
         '''
         :param ns: 2D array with normalization factors ``ns[imodel, itarget]``
+        :param per_target: whether *ns* holds one value per target instead
+            of one per misfit, see :py:meth:`aggregate_misfits`
         :returns: 2D array ``weights[imodel, itarget]``
         '''
 
         exp, root = self.get_norm_functions()
-        family, nfamilies = self.get_family_mask()
+        family, nfamilies = self.get_family_mask(per_target=per_target)
 
         ws = num.zeros(ns.shape)
         for ifamily in range(nfamilies):
             mask = family == ifamily
+            # memory layout determines the summation order, make it the same
+            # for any number of models
+            ns_family = num.ascontiguousarray(ns[:, mask])
             ws[:, mask] = (1.0 / root(
-                num.nansum(exp(ns[:, mask]), axis=1)))[:, num.newaxis]
+                num.nansum(exp(ns_family), axis=1)))[:, num.newaxis]
 
         return ws
 
@@ -340,17 +584,22 @@ class Problem(Object):
         return model
 
     def get_parameter_bounds(self):
-        out = []
-        for p in self.problem_parameters:
-            r = self.ranges[p.name]
-            out.append((r.start, r.stop))
-
-        for target in self.targets:
-            for p in target.target_parameters:
-                r = target.target_ranges[p.name_nogroups]
+        layout = self.get_parameter_layout()
+        if layout.bounds is None:
+            out = []
+            for p in self.problem_parameters:
+                r = self.ranges[p.name]
                 out.append((r.start, r.stop))
 
-        return num.array(out, dtype=num.float)
+            for target in self.targets:
+                for p in target.target_parameters:
+                    r = target.target_ranges[p.name_nogroups]
+                    out.append((r.start, r.stop))
+
+            layout.bounds = num.array(out, dtype=num.float)
+            layout.bounds.flags.writeable = False
+
+        return layout.bounds.copy()
 
     def get_dependant_bounds(self):
         return num.zeros((0, 2))
@@ -384,7 +633,10 @@ class Problem(Object):
             extra_weights=None,
             extra_residuals=None,
             extra_correlated_weights=dict(),
-            get_contributions=False):
+            get_contributions=False,
+            extra_correlated_residuals=None,
+            memory_limit=None,
+            aggregated=False):
 
         '''
         Combine misfit contributions (residuals) to global or bootstrap misfits
@@ -414,6 +666,22 @@ class Problem(Object):
         :param get_contributions: get the weighted and perturbed contributions
             (don't do the sum).
 
+        :param extra_correlated_residuals: if given, dictionary of
+            ``imisfit: weighted perturbations`` as returned by
+            :py:func:`correlated_residuals` for *extra_residuals* and
+            *extra_correlated_weights*. Saves weighting the perturbations on
+            every call.
+
+        :param memory_limit: approximate limit in bytes for intermediate
+            arrays. Larger sets of models are processed in chunks, with
+            identical results. Defaults to
+            :py:attr:`combine_misfits_memory_limit`.
+
+        :param aggregated: if ``True``, *misfits* are aggregated per target,
+            as returned by :py:meth:`aggregate_misfits`. Correlated weights
+            have already been applied to them, *extra_correlated_weights* are
+            ignored in this case and no bootstrap misfits can be computed.
+
         :returns: if no *extra_weights* or *extra_residuals* are given, a 1D
             array indexed as ``misfits[imodel]`` containing the global misfit
             for each model is returned, otherwise a 2D array
@@ -424,12 +692,14 @@ class Problem(Object):
             misfits = misfits[num.newaxis, :, :]
             return self.combine_misfits(
                 misfits, extra_weights, extra_residuals,
-                extra_correlated_weights, get_contributions)[0, ...]
+                extra_correlated_weights, get_contributions,
+                extra_correlated_residuals, memory_limit, aggregated)[0, ...]
 
         if extra_weights is None and extra_residuals is None:
             return self.combine_misfits(
                 misfits, False, False,
-                extra_correlated_weights, get_contributions)[:, 0]
+                extra_correlated_weights, get_contributions,
+                memory_limit=memory_limit, aggregated=aggregated)[:, 0]
 
         assert misfits.ndim == 3
         assert not num.any(extra_weights) or extra_weights.ndim == 2
@@ -442,7 +712,42 @@ class Problem(Object):
         exp, root = self.get_norm_functions()
 
         nmodels = misfits.shape[0]
-        nmisfits = misfits.shape[1]  # noqa
+        nmisfits = misfits.shape[1]
+
+        assert nmisfits == (self.ntargets if aggregated else self.nmisfits)
+        if aggregated:
+            if num.any(extra_weights) or num.any(extra_residuals):
+                raise GrondError(
+                    'Bootstrap misfits cannot be computed from misfits '
+                    'aggregated per target.')
+
+            extra_correlated_weights = dict()
+
+        if num.any(extra_residuals) and extra_correlated_weights \
+                and extra_correlated_residuals is None:
+            extra_correlated_residuals = correlated_residuals(
+                extra_residuals, extra_correlated_weights)
+
+        if memory_limit is None:
+            memory_limit = self.combine_misfits_memory_limit
+
+        nbootstrap = max([1] + [
+            extra.shape[0] for extra in (extra_weights, extra_residuals)
+            if num.any(extra)])
+
+        # about six arrays of shape (nmodels, nbootstrap, nmisfits) are
+        # alive at a time
+        nmodels_chunk = max(1, int(memory_limit // (
+            6 * nbootstrap * nmisfits * misfits.itemsize)))
+
+        if nmodels > nmodels_chunk:
+            return num.concatenate([
+                self.combine_misfits(
+                    misfits[imodel:imodel+nmodels_chunk],
+                    extra_weights, extra_residuals,
+                    extra_correlated_weights, get_contributions,
+                    extra_correlated_residuals, memory_limit, aggregated)
+                for imodel in range(0, nmodels, nmodels_chunk)])
 
         mf = misfits[:, num.newaxis, :, :].copy()
 
@@ -456,20 +761,24 @@ class Problem(Object):
 
             jmisfit = imisfit + corr_weight_mat.shape[0]
 
-            for imodel in range(nmodels):
-                corr_res = res[imodel, :, imisfit:jmisfit]
-                corr_norms = norms[imodel, :, imisfit:jmisfit]
+            # (r + e) W = r W + e W, e W is the same for all models
+            corr_res = correlated_weights(
+                misfits[:, imisfit:jmisfit, 0], corr_weight_mat)
+            corr_norms = correlated_weights(
+                misfits[:, imisfit:jmisfit, 1], corr_weight_mat)
 
-                res[imodel, :, imisfit:jmisfit] = \
-                    correlated_weights(corr_res, corr_weight_mat)
+            res[:, :, imisfit:jmisfit] = corr_res[:, num.newaxis, :]
+            norms[:, :, imisfit:jmisfit] = corr_norms[:, num.newaxis, :]
 
-                norms[imodel, :, imisfit:jmisfit] = \
-                    correlated_weights(corr_norms, corr_weight_mat)
+            if num.any(extra_residuals):
+                corr_extra = extra_correlated_residuals[imisfit]
+                res[:, :, imisfit:jmisfit] += corr_extra[num.newaxis, :, :]
+                norms[:, :, imisfit:jmisfit] += corr_extra[num.newaxis, :, :]
 
         # Apply normalization family weights (these weights depend on
         # on just calculated correlated norms!)
-        weights_fam = \
-            self.inter_family_weights2(norms[:, 0, :])[:, num.newaxis, :]
+        weights_fam = self.inter_family_weights2(
+            norms[:, 0, :], per_target=aggregated)[:, num.newaxis, :]
 
         weights_fam = exp(weights_fam)
 
@@ -479,7 +788,12 @@ class Problem(Object):
         res *= weights_fam
         norms *= weights_fam
 
-        weights_tar = self.get_target_weights()[num.newaxis, num.newaxis, :]
+        if aggregated:
+            weights_tar = self.get_aggregated_target_weights()
+        else:
+            weights_tar = self.get_target_weights()
+
+        weights_tar = weights_tar[num.newaxis, num.newaxis, :]
         if num.any(extra_weights):
             weights_tar = weights_tar * extra_weights[num.newaxis, :, :]
 
@@ -498,19 +812,93 @@ class Problem(Object):
         assert result[result < 0].size == 0
         return result
 
-    def make_family_mask(self):
+    def aggregate_misfits(self, misfits, extra_correlated_weights=dict()):
+        '''
+        Aggregate misfit contributions of each target
+
+        Correlated weights are applied to the contributions before they are
+        summed up per target. :py:meth:`combine_misfits` gives the same global
+        misfits for the aggregated as for the original contributions.
+
+        :param misfits: 3D array ``misfits[imodel, iresidual, :]`` of misfit
+            and normalisation contributions, see :py:meth:`combine_misfits`
+        :param extra_correlated_weights: dictionary of
+            ``imisfit: correlated weight matrix``
+
+        :returns: 3D array ``misfits[imodel, itarget, :]``
+        '''
+        exp, root = self.get_norm_functions()
+
+        misfits = num.array(misfits, dtype=num.float)
+        for imisfit, corr_weight_mat in extra_correlated_weights.items():
+            jmisfit = imisfit + corr_weight_mat.shape[0]
+            for icomponent in range(2):
+                misfits[:, imisfit:jmisfit, icomponent] = correlated_weights(
+                    misfits[:, imisfit:jmisfit, icomponent], corr_weight_mat)
+
+        aggregated = num.empty((misfits.shape[0], self.ntargets, 2))
+
+        imisfit = 0
+        for itarget, target in enumerate(self.targets):
+            jmisfit = imisfit + target.nmisfits
+            target_misfits = misfits[:, imisfit:jmisfit, :]
+            aggregated[:, itarget, :] = root(
+                num.nansum(exp(target_misfits), axis=1))
+
+            isbad = num.all(num.isnan(target_misfits[:, :, 0]), axis=1)
+            aggregated[isbad, itarget, :] = num.nan
+            imisfit = jmisfit
+
+        return aggregated
+
+    def expand_aggregated_misfits(self, aggregated):
+        '''
+        Arrange misfits aggregated per target like full misfit contributions
+
+        The contribution of each target is placed at its first misfit, the
+        others are set to zero, or to NaN for targets without data.
+        :py:meth:`combine_misfits` without correlated weights gives the same
+        global misfits for the expanded as for the aggregated misfits.
+
+        :param aggregated: 3D array ``misfits[imodel, itarget, :]``, see
+            :py:meth:`aggregate_misfits`
+
+        :returns: 3D array ``misfits[imodel, imisfit, :]``
+        '''
+        misfits = num.zeros((aggregated.shape[0], self.nmisfits, 2))
+
+        imisfit = 0
+        for itarget, target in enumerate(self.targets):
+            jmisfit = imisfit + target.nmisfits
+            isbad = num.isnan(aggregated[:, itarget, 0])
+            misfits[isbad, imisfit:jmisfit, :] = num.nan
+            misfits[:, imisfit, :] = aggregated[:, itarget, :]
+            imisfit = jmisfit
+
+        return misfits
+
+    def make_family_mask(self, per_target=False):
         family_names = set()
-        families = num.zeros(self.nmisfits, dtype=num.int)
+        families = num.zeros(
+            self.ntargets if per_target else self.nmisfits, dtype=num.int)
 
         idx = 0
         for itarget, target in enumerate(self.targets):
+            nmisfits = 1 if per_target else target.nmisfits
             family_names.add(target.normalisation_family)
-            families[idx:idx + target.nmisfits] = len(family_names) - 1
-            idx += target.nmisfits
+            families[idx:idx + nmisfits] = len(family_names) - 1
+            idx += nmisfits
 
         return families, len(family_names)
 
-    def get_family_mask(self):
+    def get_family_mask(self, per_target=False):
+        if per_target:
+            if self._target_family_mask is None:
+                self._target_family_mask = self.make_family_mask(
+                    per_target=True)
+
+            return self._target_family_mask
+
         if self._family_mask is None:
             self._family_mask = self.make_family_mask()
 
@@ -529,63 +917,171 @@ class Problem(Object):
         for target in targets:
             target.set_result_mode(result_mode)
 
-        modelling_targets = []
-        t2m_map = {}
-        for itarget, target in enumerate(targets):
-            t2m_map[target] = target.prepare_modelling(engine, source, targets)
-            if mask is None or mask[itarget]:
-                modelling_targets.extend(t2m_map[target])
+        plan = self.get_modelling_plan(engine, source, targets, mask)
 
-        u2m_map = {}
-        for imtarget, mtarget in enumerate(modelling_targets):
-            if mtarget not in u2m_map:
-                u2m_map[mtarget] = []
+        modelling_results = self._process_modelling(
+            engine, [source], plan)[0]
 
-            u2m_map[mtarget].append(imtarget)
+        return plan.finalize(engine, source, modelling_results)
 
-        modelling_targets_unique = list(u2m_map.keys())
+    def evaluate_many(self, xs, mask=None, result_mode='sparse'):
+        '''
+        Evaluate several models with a single forward modelling request.
 
-        resp = engine.process(source, modelling_targets_unique,
-                              nthreads=self.nthreads)
-        modelling_results_unique = list(resp.results_list[0])
+        Modelling targets are prepared once for the whole batch, so their
+        setup must not depend on the source model.
 
-        modelling_results = [None] * len(modelling_targets)
+        :param xs: 2D array ``xs[imodel, iparameter]``
+        :param mask: if given, boolean array ``mask[itarget]``, selecting the
+            targets to be modelled
+        :returns: list of result lists ``results[imodel][itarget]``
+        '''
+        sources = [self.get_source(x) for x in xs]
+        engine = self.get_engine()
 
-        for mtarget, mresult in zip(
-                modelling_targets_unique, modelling_results_unique):
+        self.set_target_parameter_values_many(xs, sources)
 
-            for itarget in u2m_map[mtarget]:
-                modelling_results[itarget] = mresult
+        targets = self.targets
 
-        imt = 0
-        results = []
-        for itarget, target in enumerate(targets):
-            nmt_this = len(t2m_map[target])
-            if mask is None or mask[itarget]:
-                result = target.finalize_modelling(
+        for target in targets:
+            target.set_result_mode(result_mode)
+
+        plan = self.get_modelling_plan(engine, sources[0], targets, mask)
+
+        results_list = self._process_modelling(engine, sources, plan)
+
+        results_many = [
+            plan.finalize(engine, source, modelling_results)
+            for source, modelling_results in zip(sources, results_list)]
+
+        for target in targets:
+            target.set_parameter_values_many(None, None)
+
+        return results_many
+
+    def get_modelling_plan(self, engine, source, targets, mask=None):
+        '''
+        Get the compiled modelling plan for a set of targets and a mask.
+
+        The plan is rebuilt only when targets or mask differ from those of
+        the previous call. Targets are prepared again only when the targets
+        change.
+
+        :returns: :py:class:`ModellingPlan`
+        '''
+        plan = self._modelling_plan
+        if plan is None or not plan.matches_targets(targets):
+            plan = ModellingPlan(engine, source, targets, mask)
+            self._clear_piggyback_subtargets(targets)
+            self._modelling_plan = plan
+
+        elif not plan.matches_mask(mask):
+            plan.set_mask(engine, source, mask)
+
+        return plan
+
+    def invalidate_modelling_plan(self):
+        '''
+        Discard the compiled modelling plan.
+
+        Must be called when the modelling setup of the targets is changed in
+        place.
+        '''
+        self._modelling_plan = None
+
+    def _process_modelling(self, engine, sources, plan):
+        '''
+        Forward model and post-process modelling targets.
+
+        Waveform targets are forward modelled as plain targets, their misfits
+        are calculated afterwards for all waveform targets of a source at
+        once, see :py:meth:`WaveformMisfitTarget.post_process_many`.
+
+        :returns: list of result lists ``results[isource][imtarget]``
+        '''
+        plan.prepare(engine, sources[0])
+
+        results_list = self._engine_process(
+            engine, sources, plan.engine_targets)
+
+        if plan.iwaveform:
+            for source, results in zip(sources, results_list):
+                ipost = [
+                    i for i in plan.iwaveform
+                    if not isinstance(results[i], gf.SeismosizerError)]
+
+                post_results = WaveformMisfitTarget.post_process_many(
                     engine, source,
-                    t2m_map[target],
-                    modelling_results[imt:imt+nmt_this])
+                    [plan.modelling_targets[i] for i in ipost],
+                    [results[i].trace for i in ipost],
+                    timing_table=self.get_timing_table())
 
-                imt += nmt_this
-            else:
-                result = gf.SeismosizerError(
-                    'target was excluded from modelling')
+                for i, result in zip(ipost, post_results):
+                    results[i] = result
 
-            results.append(result)
+        self._clear_piggyback_subtargets(plan.targets)
+        return results_list
 
-        return results
+    def _engine_process(self, engine, sources, targets):
+        '''
+        Forward model sources at targets with the engine.
+
+        :returns: list of result lists ``results[isource][itarget]``
+        '''
+        resp = engine.process(sources, targets, nthreads=self.nthreads)
+        return [list(results) for results in resp.results_list]
+
+    def get_timing_table(self):
+        '''
+        Get cache of phase arrival times at the targets of this problem.
+
+        :returns: :py:class:`grond.timing.TimingTable`
+        '''
+        if self._timing_table is None:
+            self._timing_table = TimingTable()
+
+        return self._timing_table
+
+    def _clear_piggyback_subtargets(self, targets):
+        for target in targets:
+            if isinstance(target, WaveformMisfitTarget):
+                target.clear_piggyback_subtargets()
+
+    def _fill_misfits(self, results, misfits):
+        offsets = self.get_parameter_layout().misfit_offsets
+        for itarget, result in enumerate(results):
+            if isinstance(result, MisfitResult):
+                misfits[offsets[itarget]:offsets[itarget+1], :] = \
+                    result.misfits
 
     def misfits(self, x, mask=None):
         results = self.evaluate(x, mask=mask, result_mode='sparse')
         misfits = num.full((self.nmisfits, 2), num.nan)
+        self._fill_misfits(results, misfits)
+        return misfits
 
-        imisfit = 0
-        for target, result in zip(self.targets, results):
-            if isinstance(result, MisfitResult):
-                misfits[imisfit:imisfit+target.nmisfits, :] = result.misfits
+    def misfits_many(self, xs, mask=None):
+        '''
+        Calculate misfits for several models at once.
+
+        All source models are forward modelled in a single request to the
+        engine, so that the per-request overhead is paid only once per batch.
+
+        :param xs: 2D array ``xs[imodel, iparameter]``
+        :param mask: if given, boolean array ``mask[itarget]``, selecting the
+            targets to be modelled
+        :returns: 3D array ``misfits[imodel, imisfit, 0]`` are the misfit
+            contributions, ``misfits[imodel, imisfit, 1]`` the normalisation
+            contributions. Misfits of targets not modelled are set to NaN.
+        '''
+        xs = num.asarray(xs)
+        misfits = num.full((xs.shape[0], self.nmisfits, 2), num.nan)
+        if xs.shape[0] == 0:
+            return misfits
 
-            imisfit += target.nmisfits
+        results_many = self.evaluate_many(xs, mask=mask, result_mode='sparse')
+        for imodel, results in enumerate(results_many):
+            self._fill_misfits(results, misfits[imodel])
 
         return misfits
 
@@ -641,6 +1137,206 @@ class InvalidAttributeName(GrondError):
     pass
 
 
+class HistoryStorage(Object):
+    '''
+    Storage policy for the misfits of an optimisation run.
+
+    The policy of a rundir is saved in the file ``history_storage.yaml``.
+    Rundirs without it use the defaults.
+    '''
+
+    misfits_dtype = StringChoice.T(
+        choices=['float64', 'float32'],
+        default='float64',
+        help='Precision of the stored misfit and normalisation contributions.')
+    aggregate_targets = Bool.T(
+        default=False,
+        help='Store a single misfit and normalisation contribution per target '
+             'instead of one per residual, with correlated weights applied. '
+             'Global misfits are unaffected. When reading, the contribution '
+             'of a target is assigned to its first residual, so the '
+             'individual contributions of e.g. satellite targets are not '
+             'available for plotting, and bootstrap misfits cannot be '
+             'recomputed from the stored misfits.')
+    compression = StringChoice.T(
+        choices=['none', 'zlib'],
+        default='none',
+        help='Compress the misfits file in chunks. Compressed misfits are '
+             'decompressed into memory when reading the rundir.')
+
+    filename = 'history_storage.yaml'
+
+    @property
+    def dtype(self):
+        return {'float64': '<f8', 'float32': '<f4'}[self.misfits_dtype]
+
+    def is_aggregated(self, problem):
+        return self.aggregate_targets and problem.ntargets != problem.nmisfits
+
+    def get_nmisfits(self, problem):
+        if self.is_aggregated(problem):
+            return problem.ntargets
+
+        return problem.nmisfits
+
+    def get_misfits_row_size(self, problem):
+        return self.get_nmisfits(problem) * 2 * num.dtype(self.dtype).itemsize
+
+    def dump_rundir(self, dirname):
+        guts.dump(self, filename=op.join(dirname, self.filename))
+
+    @classmethod
+    def load_rundir(cls, dirname):
+        fn = op.join(dirname, cls.filename)
+        if not op.exists(fn):
+            return cls()
+
+        return guts.load(filename=fn)
+
+
+def write_compressed(f, data):
+    '''
+    Append a compressed chunk of raw data to a file.
+
+    A chunk is stored as the uncompressed and compressed sizes in bytes
+    (``<i8``), followed by the zlib compressed data.
+    '''
+    compressed = zlib.compress(data)
+    f.write(num.array([len(data), len(compressed)], dtype='<i8').tobytes())
+    f.write(compressed)
+
+
+def iter_compressed(fn, decompress=True):
+    '''
+    Iterate over the complete chunks of a file with compressed chunks.
+
+    Yields the uncompressed size and, if *decompress* is ``True``, the data
+    of each chunk. An incomplete last chunk (still being written) is
+    skipped.
+    '''
+    with open(fn, 'rb') as f:
+        nbytes_file = os.fstat(f.fileno()).st_size
+        while True:
+            header = f.read(16)
+            if len(header) < 16:
+                return
+
+            nbytes, nbytes_compressed = num.frombuffer(header, dtype='<i8')
+            if f.tell() + nbytes_compressed > nbytes_file:
+                return
+
+            if decompress:
+                yield nbytes, zlib.decompress(f.read(nbytes_compressed))
+            else:
+                f.seek(nbytes_compressed, 1)
+                yield nbytes, None
+
+
+class HistoryWriter(object):
+    '''
+    Buffered writer for the model history files of a rundir.
+
+    Keeps the files ``models``, ``misfits``, ``chains`` and ``choices`` open
+    and appends rows in blocks, in the same layout as
+    :py:meth:`Problem.dump_problem_data`. Buffered rows are written when more
+    than ``nbytes_flush`` bytes are pending, when the last write is older than
+    ``tflush`` seconds, or on :py:meth:`flush` and :py:meth:`close`.
+
+    :param path: path to rundir
+    :param nbytes_flush: size threshold for pending data in bytes
+    :param tflush: time threshold in seconds
+    :param durability: ``'flush'`` hands the data to the operating system,
+        ``'fsync'`` additionally waits until it is on disk
+    :param storage: :py:class:`HistoryStorage` policy for the misfits, saved
+        to the rundir. Default is to store the misfits uncompressed as
+        ``<f8``.
+    :param aggregate: function aggregating misfits per target, applied
+        before writing, see :py:meth:`Problem.aggregate_misfits`
+    '''
+
+    # written last, so that readers counting rows in these files never see
+    # models for which the other files are incomplete
+    file_names = ('chains', 'choices', 'misfits', 'models')
+
+    def __init__(
+            self, path, nbytes_flush=4*1024**2, tflush=5.,
+            durability='flush', storage=None, aggregate=None):
+
+        assert durability in ('flush', 'fsync')
+
+        self.path = path
+        self.nbytes_flush = nbytes_flush
+        self.tflush = tflush
+        self.durability = durability
+        self.aggregate = aggregate
+
+        if storage is not None:
+            storage.dump_rundir(path)
+        else:
+            storage = HistoryStorage()
+
+        self.storage = storage
+
+        self._files = {}
+        self._pending = dict((name, []) for name in self.file_names)
+        self._nbytes_pending = 0
+        self._tlast_flush = time.time()
+
+    def write(
+            self, models, misfits,
+            bootstrap_misfits=None,
+            sampler_contexts=None):
+
+        if self.aggregate is not None:
+            misfits = self.aggregate(misfits)
+
+        for name, data, dtype in [
+                ('models', models, '<f8'),
+                ('misfits', misfits, self.storage.dtype),
+                ('chains', bootstrap_misfits, '<f8'),
+                ('choices', sampler_contexts, '<i8')]:
+
+            if data is not None:
+                data = num.asarray(data, dtype=dtype)
+                self._pending[name].append(data.tobytes())
+                self._nbytes_pending += data.nbytes
+
+        if self._nbytes_pending >= self.nbytes_flush \
+                or time.time() - self._tlast_flush >= self.tflush:
+
+            self.flush()
+
+    def flush(self):
+        for name in self.file_names:
+            if not self._pending[name]:
+                continue
+
+            if name not in self._files:
+                self._files[name] = open(op.join(self.path, name), 'ab')
+
+            f = self._files[name]
+            if name == 'misfits' and self.storage.compression == 'zlib':
+                write_compressed(f, b''.join(self._pending[name]))
+            else:
+                f.write(b''.join(self._pending[name]))
+
+            f.flush()
+            if self.durability == 'fsync':
+                os.fsync(f.fileno())
+
+            self._pending[name] = []
+
+        self._nbytes_pending = 0
+        self._tlast_flush = time.time()
+
+    def close(self):
+        self.flush()
+        for f in self._files.values():
+            f.close()
+
+        self._files.clear()
+
+
 class ModelHistory(object):
     '''
     Write, read and follow sequences of models produced in an optimisation run.
@@ -648,19 +1344,49 @@ class ModelHistory(object):
     :param problem: :class:`grond.Problem` instance
     :param path: path to rundir, defaults to None
     :type path: str, optional
-    :param mode: open mode, 'r': read, 'w': write
+    :param mode: open mode, 'r': read, 'w': write, 'a': load the models of
+        an existing rundir and append new ones
     :type mode: str, optional
+    :param durability: durability policy of the writer in mode 'w', see
+        :py:class:`HistoryWriter`
+    :type durability: str, optional
+    :param storage: storage policy of the misfits in mode 'w'. In modes 'r'
+        and 'a', the policy is read from the rundir.
+    :type storage: :py:class:`HistoryStorage`, optional
+    :param correlated_weights: correlated weights applied to the misfits
+        before they are aggregated per target, see
+        :py:meth:`Problem.aggregate_misfits`
+    :type correlated_weights: dict, optional
+
+    The misfits held in memory always have one column per misfit. When
+    reading a rundir with misfits aggregated per target in mode 'r', they are
+    expanded with :py:meth:`Problem.expand_aggregated_misfits` and
+    :py:attr:`misfits_aggregated` is set; use
+    :py:meth:`get_correlated_weights` to combine them. In mode 'a', the full
+    contributions of the loaded models are not available in this case and set
+    to NaN.
+
+    In mode 'w', models are written to the rundir in blocks. Call
+    :py:meth:`close` (or :py:meth:`flush`) to make sure that all models are
+    written.
     '''
 
     nmodels_capacity_min = 1024
 
-    def __init__(self, problem, nchains=None, path=None, mode='r'):
+    def __init__(self, problem, nchains=None, path=None, mode='r',
+                 durability='flush', storage=None, correlated_weights=None):
         self.mode = mode
 
         self.problem = problem
         self.path = path
         self.nchains = nchains
 
+        self._writer = None
+        self.durability = durability
+        self.storage = storage
+        self.correlated_weights = correlated_weights
+        self.misfits_aggregated = False
+
         self._models_buffer = None
         self._misfits_buffer = None
         self._bootstraps_buffer = None
@@ -681,6 +1407,8 @@ class ModelHistory(object):
 
         if mode == 'r':
             self.load()
+        elif mode == 'a':
+            self.load_append()
 
     @staticmethod
     def verify_rundir(rundir):
@@ -811,14 +1539,22 @@ class ModelHistory(object):
                 = sampler_contexts
             self.sampler_contexts = self._sample_contexts_buffer[:nmodels+n, :]
 
-        if self.path and self.mode == 'w':
-            for i in range(n):
-                self.problem.dump_problem_data(
-                    self.path, models[i, :], misfits[i, :, :],
-                    bootstrap_misfits[i, :]
-                    if bootstrap_misfits is not None else None,
-                    sampler_contexts[i, :]
-                    if sampler_contexts is not None else None)
+        if self.path and self.mode in ('w', 'a'):
+            if self._writer is None:
+                aggregate = None
+                if self.storage is not None \
+                        and self.storage.is_aggregated(self.problem):
+
+                    def aggregate(misfits):
+                        return self.problem.aggregate_misfits(
+                            misfits, self.correlated_weights or dict())
+
+                self._writer = HistoryWriter(
+                    self.path, durability=self.durability,
+                    storage=self.storage, aggregate=aggregate)
+
+            self._writer.write(
+                models, misfits, bootstrap_misfits, sampler_contexts)
 
         self._sorted_misfit_idx.clear()
 
@@ -839,12 +1575,36 @@ class ModelHistory(object):
             model[num.newaxis, :], misfits[num.newaxis, :, :],
             bootstrap_misfits, sampler_context)
 
-    def load(self):
-        self.mode = 'r'
+    def flush(self):
+        ''' Write buffered models to the rundir '''
+        if self._writer is not None:
+            self._writer.flush()
+
+    def close(self):
+        ''' Write buffered models to the rundir and close its files '''
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    def load_append(self):
         self.verify_rundir(self.path)
+        self.storage = HistoryStorage.load_rundir(self.path)
         models, misfits, bootstraps, sampler_contexts = load_problem_data(
             self.path, self.problem, nchains=self.nchains)
+
+        if self.storage.is_aggregated(self.problem):
+            misfits = num.full(
+                (models.shape[0], self.problem.nmisfits, 2), num.nan)
+
+        # the loaded models are in the rundir already
+        self.mode = 'r'
         self.extend(models, misfits, bootstraps, sampler_contexts)
+        self.mode = 'a'
+
+    def load(self):
+        self.mode = 'r'
+        self.verify_rundir(self.path)
+        self._map(get_nmodels(self.path, self.problem))
 
     def update(self):
         ''' Update history from path '''
@@ -853,21 +1613,42 @@ class ModelHistory(object):
             return
 
         try:
-            new_models, new_misfits, new_bootstraps, new_sampler_contexts = \
-                load_problem_data(
-                    self.path,
-                    self.problem,
-                    nmodels_skip=self.nmodels,
-                    nchains=self.nchains)
+            self._map(nmodels_available)
 
         except ValueError:
             return
 
-        self.extend(
-            new_models,
-            new_misfits,
-            new_bootstraps,
-            new_sampler_contexts)
+    def _map(self, nmodels):
+        # In read mode, the history arrays are read-only memory mapped views
+        # on the rundir files (compressed misfits are read into memory).
+        self.storage = HistoryStorage.load_rundir(self.path)
+        self.misfits_aggregated = self.storage.is_aggregated(self.problem)
+        models, misfits, bootstraps, sampler_contexts = map_problem_data(
+            self.path, self.problem, nmodels, nchains=self.nchains)
+
+        nmodels_old = self.nmodels
+        n = nmodels - nmodels_old
+
+        self._models_buffer = models
+        self._misfits_buffer = misfits
+        self.models = models
+        self.misfits = misfits
+
+        if bootstraps is not None:
+            self._bootstraps_buffer = bootstraps
+            self.bootstrap_misfits = bootstraps
+
+        if sampler_contexts is not None:
+            self._sample_contexts_buffer = sampler_contexts
+            self.sampler_contexts = sampler_contexts
+
+        self._sorted_misfit_idx.clear()
+
+        self.emit(
+            'extend', nmodels_old, n,
+            models[nmodels_old:], misfits[nmodels_old:],
+            sampler_contexts[nmodels_old:]
+            if sampler_contexts is not None else None)
 
     def add_listener(self, listener):
         ''' Add a listener to the history
@@ -927,8 +1708,26 @@ class ModelHistory(object):
 
         self._attributes[name] = attribute
 
+    def get_correlated_weights(self, optimiser):
+        '''
+        Correlated weights to pass to :py:meth:`Problem.combine_misfits`
+        together with :py:attr:`misfits`.
+
+        Empty if the misfits were stored aggregated per target, with the
+        correlated weights already applied.
+        '''
+        if self.misfits_aggregated:
+            return {}
+
+        return optimiser.get_correlated_weights(self.problem)
+
     def ensure_bootstrap_misfits(self, optimiser):
         if self.bootstrap_misfits is None:
+            if self.misfits_aggregated:
+                raise GrondError(
+                    'Bootstrap misfits cannot be computed from misfits '
+                    'aggregated per target.')
+
             problem = self.problem
             self.bootstrap_misfits = problem.combine_misfits(
                 self.misfits,
@@ -1028,13 +1827,53 @@ def get_nmodels(dirname, problem):
     with open(fn, 'r') as f:
         nmodels1 = os.fstat(f.fileno()).st_size // (problem.nparameters * 8)
 
+    storage = HistoryStorage.load_rundir(dirname)
     fn = op.join(dirname, 'misfits')
-    with open(fn, 'r') as f:
-        nmodels2 = os.fstat(f.fileno()).st_size // (problem.nmisfits * 2 * 8)
+    if storage.compression == 'zlib':
+        nbytes = sum(
+            nbytes for (nbytes, _) in iter_compressed(fn, decompress=False))
+    else:
+        with open(fn, 'r') as f:
+            nbytes = os.fstat(f.fileno()).st_size
+
+    nmodels2 = nbytes // storage.get_misfits_row_size(problem)
 
     return min(nmodels1, nmodels2)
 
 
+def load_misfits(dirname, problem, nmodels_skip, nmodels, storage):
+    fn = op.join(dirname, 'misfits')
+    nmisfits = storage.get_nmisfits(problem)
+    nbytes_row = storage.get_misfits_row_size(problem)
+
+    if storage.compression == 'zlib':
+        ibyte_min = nmodels_skip * nbytes_row
+        ibyte_max = (nmodels_skip + nmodels) * nbytes_row
+        chunks = []
+        ibyte = 0
+        for nbytes, data in iter_compressed(fn):
+            if ibyte + nbytes > ibyte_min:
+                chunks.append(data[max(0, ibyte_min - ibyte):])
+
+            ibyte += nbytes
+            if ibyte >= ibyte_max:
+                break
+
+        data = b''.join(chunks)[:ibyte_max - ibyte_min]
+        misfits = num.frombuffer(data, dtype=storage.dtype)
+    else:
+        with open(fn, 'r') as f:
+            f.seek(nmodels_skip * nbytes_row)
+            misfits = num.fromfile(
+                f, dtype=storage.dtype, count=nmodels*nmisfits*2)
+
+    misfits = misfits.astype(num.float).reshape((nmodels, nmisfits, 2))
+    if storage.is_aggregated(problem):
+        misfits = problem.expand_aggregated_misfits(misfits)
+
+    return misfits
+
+
 def load_problem_info_and_data(dirname, subset=None, nchains=None):
     problem = load_problem_info(dirname)
     models, misfits, bootstraps, sampler_contexts = load_problem_data(
@@ -1057,14 +1896,63 @@ def load_problem_info(dirname):
             'No problem info available (%s).' % dirname)
 
 
-def load_problem_data(dirname, problem, nmodels_skip=0, nchains=None):
+def get_chains_fn(dirname):
+    for fn in (op.join(dirname, 'bootstraps'),
+               op.join(dirname, 'chains')):
+        if op.exists(fn):
+            return fn
+    return False
 
-    def get_chains_fn():
-        for fn in (op.join(dirname, 'bootstraps'),
-                   op.join(dirname, 'chains')):
-            if op.exists(fn):
-                return fn
-        return False
+
+def map_problem_data(dirname, problem, nmodels, nchains=None):
+    '''
+    Get read-only memory mapped views on the first models of a rundir.
+
+    Returns the same arrays as :py:func:`load_problem_data` without reading
+    or copying the data; pages are only loaded when accessed. Misfits
+    stored with reduced precision are mapped as they are. Compressed misfits
+    and misfits aggregated per target are read into memory, the latter are
+    expanded with :py:meth:`Problem.expand_aggregated_misfits`.
+    '''
+    storage = HistoryStorage.load_rundir(dirname)
+
+    def map_file(fn, dtype, shape):
+        if nmodels == 0:
+            return num.zeros(shape, dtype=dtype)
+
+        return num.memmap(fn, dtype=dtype, mode='r', shape=shape)
+
+    try:
+        models = map_file(
+            op.join(dirname, 'models'), '<f8',
+            (nmodels, problem.nparameters))
+
+        if storage.compression == 'zlib' or storage.is_aggregated(problem):
+            misfits = load_misfits(dirname, problem, 0, nmodels, storage)
+        else:
+            misfits = map_file(
+                op.join(dirname, 'misfits'), storage.dtype,
+                (nmodels, storage.get_nmisfits(problem), 2))
+
+        chains = None
+        fn = get_chains_fn(dirname)
+        if fn and nchains is not None:
+            chains = map_file(fn, '<f8', (nmodels, nchains))
+
+        sampler_contexts = None
+        fn = op.join(dirname, 'choices')
+        if op.exists(fn):
+            sampler_contexts = map_file(fn, '<i8', (nmodels, 4))
+
+    except OSError as e:
+        logger.debug(str(e))
+        raise ProblemDataNotAvailable(
+            'No problem data available (%s).' % dirname)
+
+    return models, misfits, chains, sampler_contexts
+
+
+def load_problem_data(dirname, problem, nmodels_skip=0, nchains=None):
 
     try:
         nmodels = get_nmodels(dirname, problem) - nmodels_skip
@@ -1079,17 +1967,12 @@ def load_problem_data(dirname, problem, nmodels_skip=0, nchains=None):
 
         models = models.reshape((nmodels, problem.nparameters))
 
-        fn = op.join(dirname, 'misfits')
-        with open(fn, 'r') as f:
-            f.seek(nmodels_skip * problem.nmisfits * 2 * 8)
-            misfits = num.fromfile(
-                    f, dtype='<f8',
-                    count=nmodels*problem.nmisfits*2)\
-                .astype(num.float)
-        misfits = misfits.reshape((nmodels, problem.nmisfits, 2))
+        misfits = load_misfits(
+            dirname, problem, nmodels_skip, nmodels,
+            HistoryStorage.load_rundir(dirname))
 
         chains = None
-        fn = get_chains_fn()
+        fn = get_chains_fn(dirname)
         if fn and nchains is not None:
             with open(fn, 'r') as f:
                 f.seek(nmodels_skip * nchains * 8)
@@ -1122,6 +2005,9 @@ def load_problem_data(dirname, problem, nmodels_skip=0, nchains=None):
 __all__ = '''
     ProblemConfig
     Problem
+    ModellingPlan
+    ParameterLayout
+    HistoryStorage
     ModelHistory
     ProblemInfoNotAvailable
     ProblemDataNotAvailable
@@ -0,0 +1,364 @@
+'''
+Synthetic seismograms of moment tensor point sources from cached elementary
+seismograms.
+'''
+
+import logging
+import math
+from collections import OrderedDict
+
+import numpy as num
+
+from pyrocko import gf, util
+from pyrocko.gf import meta, seismosizer
+
+logger = logging.getLogger('grond.problems.cmt.elementary')
+
+
+def location_key(source, depth):
+    return (
+        source.lat, source.lon, source.north_shift, source.east_shift, depth)
+
+
+def receiver_key(target, base_rule):
+    return (base_rule,) + tuple(
+        getattr(target, k) for k in gf.Target.T.propnames
+        if k not in ('quantity', 'filter'))
+
+
+def get_base_rule(engine, source, target):
+    '''
+    Get quantity to request from the GF store and number of differentiations
+    the engine applies to it for a target.
+
+    :returns: tuple ``(quantity, differentiate)`` or ``None`` for unknown
+        rules
+    '''
+    rule = engine.get_rule(source, target)
+    if isinstance(rule, (
+            seismosizer.VectorRule, seismosizer.HorizontalVectorRule)):
+        return rule.components[0].split('.')[0], rule.differentiate
+    elif isinstance(rule, seismosizer.ScalarRule):
+        return rule.c, 0
+    else:
+        return None
+
+
+def snap_source_depth(config, depth):
+    '''
+    Get source depth of the GF store node used for a source depth with
+    ``nearest_neighbor`` interpolation.
+
+    :param config: GF store config
+    :returns: depth of the nearest node, ``None`` for stores not indexed by
+        source depth and for depths out of bounds
+    '''
+    if isinstance(config, gf.ConfigTypeA):
+        idim = 0
+    elif isinstance(config, gf.ConfigTypeB):
+        idim = 1
+    else:
+        return None
+
+    depth_min, depth_delta, ndepths = \
+        config.mins[idim], config.deltas[idim], config.ns[idim]
+
+    # halves are rounded up, as in the store's nearest neighbor lookup
+    idepth = int(math.floor((depth - depth_min) / depth_delta + 0.5))
+    if not 0 <= idepth < ndepths:
+        return None
+
+    return depth_min + idepth * depth_delta
+
+
+def shift_and_sum(data, itmin, deltat, tref):
+    '''
+    Shift elementary seismogram to a source time.
+
+    Emulates the stacking of the Green's functions in the GF store: the
+    source time is split onto the two neighbouring samples and the traces
+    are continued with their first and last values.
+    '''
+
+    times, amplitudes = gf.STF().discretize_t(deltat, tref)
+    ishifts = num.round(times / deltat).astype(num.int64)
+    nshift = ishifts[-1] - ishifts[0]
+    n = data.size
+
+    out = num.zeros(n + nshift)
+    for ishift, amplitude in zip(ishifts - ishifts[0], amplitudes):
+        out[:ishift] += amplitude * data[0]
+        out[ishift:ishift+n] += amplitude * data
+        out[ishift+n:] += amplitude * data[-1]
+
+    return out, itmin + ishifts[0]
+
+
+class MTElementaryCache(object):
+    '''
+    Synthetic seismograms of moment tensor point sources from elementary
+    seismograms.
+
+    Synthetic seismograms are linear in the moment tensor. For each source
+    location, the seismograms of the six unit moment tensors are forward
+    modelled once, with zero origin time, without source time function and
+    in the quantity stored in the GF store. Seismograms of any moment tensor,
+    origin time and source time function at a cached location are combined
+    from these, applying the origin time shift, differentiation and source
+    time function in the same way as the engine does. Results equal those of
+    the engine up to floating point rounding.
+
+    Modelling the elementary seismograms of a new location costs six forward
+    models. The cache therefore only pays off if source locations repeat.
+    For targets with ``nearest_neighbor`` interpolation, source depths are
+    snapped to the depth nodes of the GF store, which is exact. Horizontal
+    locations are not quantised.
+
+    Sources other than :py:class:`pyrocko.gf.MTSource` with source time
+    function applied in post-processing and targets with time windows,
+    resampling or filters are forward modelled with the engine.
+    '''
+
+    #: Maximum number of source locations kept.
+    cache_size = 8
+
+    def __init__(self):
+        self._cache = OrderedDict()
+        self.nhits = 0
+        self.nmisses = 0
+
+    def clear(self):
+        self._cache.clear()
+
+    def is_supported_source(self, source):
+        return type(source) is gf.MTSource and (
+            source.stf is None or source.stf_mode == 'post')
+
+    def is_supported_target(self, target):
+        return type(target) is gf.Target \
+            and not (target.tmin and target.tmax is not None) \
+            and target.sample_rate is None \
+            and target.filter is None
+
+    def process(self, engine, sources, targets, nthreads=0):
+        '''
+        Forward model sources at targets.
+
+        :returns: list of result lists ``results[isource][itarget]``, as
+            ``engine.process(sources, targets).results_list``
+        '''
+
+        isupported = []
+        iothers = []
+        base_rules = []
+        for itarget, target in enumerate(targets):
+            base_rule = None
+            if self.is_supported_target(target):
+                base_rule = get_base_rule(engine, sources[0], target)
+
+            if base_rule is not None:
+                isupported.append(itarget)
+                base_rules.append(base_rule)
+            else:
+                iothers.append(itarget)
+
+        if not isupported or not all(
+                self.is_supported_source(source) for source in sources):
+
+            resp = engine.process(sources, targets, nthreads=nthreads)
+            return [list(results) for results in resp.results_list]
+
+        results_list = [[None] * len(targets) for source in sources]
+
+        if iothers:
+            resp = engine.process(
+                sources, [targets[i] for i in iothers], nthreads=nthreads)
+
+            for results, results_others in zip(
+                    results_list, resp.results_list):
+                for itarget, result in zip(iothers, results_others):
+                    results[itarget] = result
+
+        supported_targets = [targets[i] for i in isupported]
+        for source, results in zip(sources, results_list):
+            elementary = self.get_elementary(
+                engine, source, supported_targets, base_rules, nthreads)
+
+            for itarget, target, entry in zip(
+                    isupported, supported_targets, elementary):
+
+                results[itarget] = self.synthesize(
+                    engine, source, target, entry)
+
+        return results_list
+
+    def get_modelling_depth(self, engine, source, target):
+        '''
+        Get source depth at which elementary seismograms for a target are
+        modelled.
+
+        With ``nearest_neighbor`` interpolation, the engine uses the Green's
+        functions of the nearest source depth node of the store, so all
+        source depths around a node share the elementary seismograms modelled
+        at the node.
+        '''
+        if target.interpolation == 'nearest_neighbor':
+            depth = snap_source_depth(
+                engine.get_store(target.store_id).config, source.depth)
+
+            if depth is not None:
+                return depth
+
+        return source.depth
+
+    def get_elementary(self, engine, source, targets, base_rules, nthreads=0):
+        '''
+        Get elementary seismograms for a source location, modelling missing
+        ones.
+
+        :param base_rules: for each target, quantity and number of
+            differentiations, see :py:func:`get_base_rule`
+        '''
+        keys = [
+            location_key(
+                source, self.get_modelling_depth(engine, source, target))
+            for target in targets]
+
+        entries_by_key = {}
+        for key in keys:
+            if key in entries_by_key:
+                continue
+
+            try:
+                entries = self._cache.pop(key)
+            except KeyError:
+                entries = {}
+                while len(self._cache) >= self.cache_size:
+                    self._cache.popitem(last=False)
+
+            self._cache[key] = entries_by_key[key] = entries
+
+        rkeys = []
+        missing = OrderedDict()
+        for key, target, base_rule in zip(keys, targets, base_rules):
+            rkey = receiver_key(target, base_rule)
+            rkeys.append(rkey)
+            if rkey not in entries_by_key[key] \
+                    and (key, rkey) not in missing:
+
+                missing[key, rkey] = (target, base_rule)
+
+        self.nhits += len(targets) - len(missing)
+        self.nmisses += len(missing)
+
+        by_key = OrderedDict()
+        for (key, rkey), target_rule in missing.items():
+            by_key.setdefault(key, []).append((rkey, target_rule))
+
+        for key, items in by_key.items():
+            rkeys_missing, targets_rules = zip(*items)
+            entries_by_key[key].update(zip(
+                rkeys_missing,
+                self._model_elementary(
+                    engine, source, key[-1], targets_rules, nthreads)))
+
+        return [
+            entries_by_key[key][rkey] for (key, rkey) in zip(keys, rkeys)]
+
+    def _model_elementary(self, engine, source, depth, targets_rules,
+                          nthreads):
+        unit_sources = []
+        for i in range(6):
+            m6 = num.zeros(6)
+            m6[i] = 1.0
+            unit_sources.append(gf.MTSource(
+                lat=source.lat, lon=source.lon,
+                north_shift=source.north_shift,
+                east_shift=source.east_shift,
+                depth=depth,
+                time=0.0,
+                m6=m6))
+
+        elementary_targets = []
+        for target, (quantity, _) in targets_rules:
+            d = dict((k, getattr(target, k)) for k in gf.Target.T.propnames)
+            d['quantity'] = quantity
+            elementary_targets.append(gf.Target(**d))
+
+        resp = engine.process(
+            unit_sources, elementary_targets, nthreads=nthreads)
+
+        entries = []
+        for itarget, (target, (_, differentiate)) in enumerate(targets_rules):
+            results = [
+                resp.results_list[i][itarget] for i in range(6)]
+
+            errors = [
+                result for result in results
+                if isinstance(result, gf.SeismosizerError)]
+
+            if errors:
+                entries.append(errors[0])
+                continue
+
+            trs = [result.trace for result in results]
+            deltat = trs[0].deltat
+            itmins = [int(round(tr.tmin / deltat)) for tr in trs]
+            itmin = min(itmins)
+            itmax = max(
+                itmin_ + tr.data.size - 1 for (itmin_, tr) in zip(itmins, trs))
+
+            data = num.empty((6, itmax - itmin + 1))
+            for i, (itmin_, tr) in enumerate(zip(itmins, trs)):
+                i0 = itmin_ - itmin
+                data[i, :i0] = tr.data[0]
+                data[i, i0:i0+tr.data.size] = tr.data
+                data[i, i0+tr.data.size:] = tr.data[-1]
+
+            entries.append((itmin, deltat, differentiate, data))
+
+        return entries
+
+    def synthesize(self, engine, source, target, entry):
+        '''
+        Synthetic seismogram of a source from elementary seismograms.
+
+        Follows :py:meth:`pyrocko.gf.LocalEngine.base_seismogram` and
+        ``_post_process_dynamic``.
+        '''
+
+        if isinstance(entry, gf.SeismosizerError):
+            return entry
+
+        itmin, deltat, differentiate, elementary = entry
+
+        data = num.dot(source.m6, elementary)
+        deltat_store = engine.get_store(target.store_id).config.deltat
+        data, itmin = shift_and_sum(data, itmin, deltat_store, source.time)
+
+        if differentiate:
+            data = util.diff_fd(differentiate, 4, deltat, data)
+
+        stf = source.effective_stf_post()
+        times, amplitudes = stf.discretize_t(deltat, 0.0)
+
+        # repeat end point to prevent boundary effects
+        padded_data = num.empty(data.size + amplitudes.size, dtype=float)
+        padded_data[:data.size] = data
+        padded_data[data.size:] = data[-1]
+        data = num.convolve(amplitudes, padded_data)
+
+        tmin = itmin * deltat + times[0]
+
+        tr = meta.SeismosizerTrace(
+            codes=target.codes,
+            data=data[:-amplitudes.size],
+            deltat=deltat,
+            tmin=tmin)
+
+        return target.post_process(engine, source, tr)
+
+
+__all__ = '''
+    MTElementaryCache
+'''.split()
@@ -3,12 +3,13 @@ import math
 import logging
 
 from pyrocko import gf, util, moment_tensor as mtm
-from pyrocko.guts import String, Float, Dict, StringChoice, Int
+from pyrocko.guts import String, Float, Dict, StringChoice, Int, Bool
 
 from grond.meta import Forbidden, expand_template, Parameter, \
     has_get_plot_classes
 
 from ..base import Problem, ProblemConfig
+from .elementary import MTElementaryCache
 
 guts_prefix = 'grond'
 logger = logging.getLogger('grond.problems.cmt.problem')
@@ -38,6 +39,14 @@ class CMTProblemConfig(ProblemConfig):
     distance_min = Float.T(default=0.0)
     mt_type = MTType.T(default='full')
     stf_type = STFType.T(default='HalfSinusoidSTF')
+    elementary_cache = Bool.T(
+        default=False,
+        help='Reuse the seismograms of the six elementary moment tensors per '
+             'source location. Only useful if the source location is fixed, '
+             'or if only the depth is free and the targets use '
+             'nearest_neighbor interpolation, where depths are snapped to '
+             'the GF store nodes. Otherwise each new location costs six '
+             'forward models and the optimisation gets slower.')
     nthreads = Int.T(default=1)
 
     def get_problem(self, event, target_groups, targets):
@@ -64,6 +73,7 @@ class CMTProblemConfig(ProblemConfig):
             distance_min=self.distance_min,
             mt_type=self.mt_type,
             stf_type=self.stf_type,
+            elementary_cache=self.elementary_cache,
             norm_exponent=self.norm_exponent,
             nthreads=self.nthreads)
 
@@ -106,36 +116,74 @@ class CMTProblem(Problem):
     distance_min = Float.T(default=0.0)
     mt_type = MTType.T(default='full')
     stf_type = STFType.T(default='HalfSinusoidSTF')
+    elementary_cache = Bool.T(default=False)
 
     def __init__(self, **kwargs):
         Problem.__init__(self, **kwargs)
         self.deps_cache = {}
+        self._elementary_cache = None
         self.problem_parameters = self.problem_parameters \
             + self.problem_parameters_stf[self.stf_type]
+        self.invalidate_parameter_layout()
         self._base_stf = STFType.base_stf(self.stf_type)
 
-    def get_stf(self, d):
+    def get_elementary_cache(self):
+        if self._elementary_cache is None:
+            self._elementary_cache = MTElementaryCache()
+
+        return self._elementary_cache
+
+    def _check_elementary_cache(self, targets):
+        names = ['north_shift', 'east_shift']
+        if not all(
+                target.interpolation == 'nearest_neighbor'
+                for target in targets):
+
+            names.append('depth')
+
+        free = [
+            name for name in names
+            if self.ranges[name].start != self.ranges[name].stop]
+
+        if free:
+            logger.warning(
+                'Elementary seismogram cache is enabled, but the source '
+                'location parameters %s are not fixed. Each new source '
+                'location is modelled with six elementary sources, which may '
+                'make the forward modelling several times slower.'
+                % ', '.join(free))
+
+    def _engine_process(self, engine, sources, targets):
+        if not self.elementary_cache:
+            return Problem._engine_process(self, engine, sources, targets)
+
+        if self._elementary_cache is None:
+            self._check_elementary_cache(targets)
+
+        return self.get_elementary_cache().process(
+            engine, sources, targets, nthreads=self.nthreads)
+
+    def get_stf(self, x):
+        ix = self.get_parameter_layout().index
         d_stf = {}
         for p in self.problem_parameters_stf[self.stf_type]:
-            d_stf[p.name] = float(d[p.name])
+            d_stf[p.name] = float(x[ix[p.name]])
 
         return self._base_stf.clone(**d_stf)
 
     def get_source(self, x):
-        d = self.get_parameter_dict(x)
-        rm6 = num.array([d.rmnn, d.rmee, d.rmdd, d.rmne, d.rmnd, d.rmed],
-                        dtype=num.float)
+        layout = self.get_parameter_layout()
+        rm6 = num.array(
+            [x[i] for i in layout.get_indices(
+                ['rmnn', 'rmee', 'rmdd', 'rmne', 'rmnd', 'rmed'])],
+            dtype=num.float)
 
-        m0 = mtm.magnitude_to_moment(d.magnitude)
+        m0 = mtm.magnitude_to_moment(x[layout.index['magnitude']])
         m6 = rm6 * m0
 
-        p = {}
-        for k in self.base_source.keys():
-            if k in d:
-                p[k] = float(
-                    self.ranges[k].make_relative(self.base_source[k], d[k]))
+        p = self.get_source_parameters(x)
 
-        source = self.base_source.clone(m6=m6, stf=self.get_stf(d), **p)
+        source = self.base_source.clone(m6=m6, stf=self.get_stf(x), **p)
         return source
 
     def make_dependant(self, xs, pname):
@@ -212,9 +260,10 @@ class CMTProblem(Problem):
         return x.tolist()
 
     def preconstrain(self, x):
-        d = self.get_parameter_dict(x)
-        m6 = num.array([d.rmnn, d.rmee, d.rmdd, d.rmne, d.rmnd, d.rmed],
-                       dtype=num.float)
+        x = num.array(x, dtype=num.float)
+        im6 = self.get_parameter_layout().get_indices(
+            ['rmnn', 'rmee', 'rmdd', 'rmne', 'rmnd', 'rmed'])
+        m6 = x[im6]
 
         m9 = mtm.symmat6(*m6)
         if self.mt_type == 'deviatoric':
@@ -229,9 +278,7 @@ class CMTProblem(Problem):
         m0_unscaled = math.sqrt(num.sum(m9.A**2)) / math.sqrt(2.)
 
         m9 /= m0_unscaled
-        m6 = mtm.to6(m9)
-        d.rmnn, d.rmee, d.rmdd, d.rmne, d.rmnd, d.rmed = m6
-        x = self.get_parameter_array(d)
+        x[im6] = mtm.to6(m9)
 
         source = self.get_source(x)
         for t in self.waveform_targets:
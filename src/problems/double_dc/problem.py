@@ -73,15 +73,11 @@ class DoubleDCProblem(Problem):
     distance_min = Float.T(default=0.0)
 
     def get_source(self, x):
-        d = self.get_parameter_dict(x)
-        p = {}
-        for k in self.base_source.keys():
-            if k in d:
-                p[k] = float(
-                    self.ranges[k].make_relative(self.base_source[k], d[k]))
-
-        stf1 = gf.HalfSinusoidSTF(duration=float(d.duration1))
-        stf2 = gf.HalfSinusoidSTF(duration=float(d.duration2))
+        ix = self.get_parameter_layout().index
+        p = self.get_source_parameters(x)
+
+        stf1 = gf.HalfSinusoidSTF(duration=float(x[ix['duration1']]))
+        stf2 = gf.HalfSinusoidSTF(duration=float(x[ix['duration2']]))
 
         source = self.base_source.clone(stf1=stf1, stf2=stf2, **p)
         return source
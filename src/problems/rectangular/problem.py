@@ -87,12 +87,7 @@ class RectangularProblem(Problem):
         return arr
 
     def get_source(self, x):
-        d = self.get_parameter_dict(x)
-        p = {}
-        for k in self.base_source.keys():
-            if k in d:
-                p[k] = float(
-                    self.ranges[k].make_relative(self.base_source[k], d[k]))
+        p = self.get_source_parameters(x)
 
         source = self.base_source.clone(**p)
 
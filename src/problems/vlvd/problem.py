@@ -74,14 +74,13 @@ class VLVDProblem(Problem):
         return arr
 
     def get_source(self, x):
-        d = self.get_parameter_dict(x)
-
-        p = {k: float(self.ranges[k].make_relative(self.base_source[k], d[k]))
-             for k in self.base_source.keys() if k in d}
+        layout = self.get_parameter_layout()
+        p = self.get_source_parameters(x)
 
         stf = None
-        if self.has_waveforms:
-            stf = gf.HalfSinusoidSTF(duration=float(d.duration))
+        if layout.waveform_targets:
+            stf = gf.HalfSinusoidSTF(
+                duration=float(x[layout.index['duration']]))
 
         source = self.base_source.clone(stf=stf, **p)
         return source
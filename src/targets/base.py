@@ -6,6 +6,7 @@ from pyrocko import gf
 from pyrocko.guts_array import Array
 from pyrocko.guts import Object, Float, Dict
 
+from grond import cache
 from grond.analysers.base import AnalyserResult
 from grond.meta import has_get_plot_classes
 
@@ -13,6 +14,28 @@ from grond.meta import has_get_plot_classes
 guts_prefix = 'grond'
 
 
+def inverse_sqrtm(covariance):
+    '''
+    Square root of the inverse of a symmetric positive definite matrix.
+
+    Uses a single symmetric eigendecomposition, equivalent to
+    ``scipy.linalg.sqrtm(numpy.linalg.inv(covariance))``.
+    '''
+    w, v = num.linalg.eigh(covariance)
+    return num.dot(v / num.sqrt(w), v.T)
+
+
+def get_noise_weight_matrix(covariance):
+    '''
+    Correlated weights for a data covariance, cached on disk.
+    '''
+    covariance = num.asarray(covariance, dtype=num.float)
+    return cache.cached_array(
+        'noise_weight_matrix',
+        cache.make_key('inverse_sqrtm', covariance),
+        lambda: inverse_sqrtm(covariance))
+
+
 class TargetGroup(Object):
     normalisation_family = gf.StringID.T(
         optional=True,
@@ -75,6 +98,9 @@ class MisfitTarget(Object):
     can_bootstrap_weights = False
     can_bootstrap_residuals = False
 
+    # prepare_modelling has side effects and must be called for every model
+    prepare_modelling_per_model = False
+
     plot_misfits_cumulative = True
 
     def __init__(self, **kwargs):
@@ -87,6 +113,7 @@ class MisfitTarget(Object):
         self._combined_weight = None
         self._target_parameters = None
         self._target_ranges = None
+        self._parameter_values_many = None
 
         self._combined_weight = None
 
@@ -133,9 +160,34 @@ class MisfitTarget(Object):
         return {}
 
     def set_parameter_values(self, model):
+        self._parameter_values_many = None
         for i, p in enumerate(self.parameters):
             self.parameter_values[p.name_nogroups] = model[i]
 
+    def set_parameter_values_many(self, sources, models):
+        ''' Set target parameter values for several sources at once
+
+        Used when several models are forward modelled in a single request.
+        The values belonging to a given source can be retrieved with
+        :py:meth:`get_parameter_values`. Passing ``None`` for *sources* resets
+        to the values set with :py:meth:`set_parameter_values`.
+        '''
+        if not self.parameters or sources is None:
+            self._parameter_values_many = None
+            return
+
+        self._parameter_values_many = dict(
+            (source, dict(
+                (p.name_nogroups, model[i])
+                for (i, p) in enumerate(self.parameters)))
+            for (source, model) in zip(sources, models))
+
+    def get_parameter_values(self, source=None):
+        if source is not None and self._parameter_values_many is not None:
+            return self._parameter_values_many[source]
+
+        return self.parameter_values
+
     def set_result_mode(self, result_mode):
         self._result_mode = result_mode
 
@@ -176,6 +228,10 @@ class MisfitTarget(Object):
 
         This function shall return a list of :class:`pyrocko.gf.Target`
         for forward modelling in the :class:`pyrocko.gf.LocalEngine`.
+
+        The returned targets are reused for all models evaluated with the
+        same set of targets, see :py:class:`grond.problems.ModellingPlan`.
+        They must not depend on the source model.
         '''
         return [self]
 
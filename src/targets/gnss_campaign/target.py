@@ -1,11 +1,11 @@
 import logging
 import numpy as num
-from scipy import linalg as splinalg
 
 from pyrocko import gf
 from pyrocko.guts import String, Dict, List, Int
 
-from ..base import MisfitConfig, MisfitTarget, MisfitResult, TargetGroup
+from ..base import MisfitConfig, MisfitTarget, MisfitResult, TargetGroup, \
+    get_noise_weight_matrix
 from grond.meta import has_get_plot_classes
 
 guts_prefix = 'grond'
@@ -145,7 +145,8 @@ class GNSSCampaignMisfitTarget(gf.GNSSCampaignTarget, MisfitTarget):
 
     def get_correlated_weights(self, nthreads=0):
         if self._correlated_weights is None:
-            self._correlated_weights = splinalg.sqrtm(self.weights)
+            self._correlated_weights = get_noise_weight_matrix(
+                self.get_covariance_matrix())
         return self._correlated_weights
 
     @property
@@ -182,16 +183,19 @@ class GNSSCampaignMisfitTarget(gf.GNSSCampaignTarget, MisfitTarget):
         the _station_component_mask.
         """
         if self._weights is None:
-            covar = self.campaign.get_covariance_matrix()
+            self._weights = num.asmatrix(self.get_covariance_matrix()).I
 
-            if not num.any(covar.diagonal()):
-                logger.warning('GNSS Stations have an empty covariance matrix.'
-                               ' Weights will be all equal.')
-                num.fill_diagonal(covar, 1.)
+        return self._weights
 
-            self._weights = num.asmatrix(covar).I
+    def get_covariance_matrix(self):
+        covar = self.campaign.get_covariance_matrix()
 
-        return self._weights
+        if not num.any(covar.diagonal()):
+            logger.warning('GNSS Stations have an empty covariance matrix.'
+                           ' Weights will be all equal.')
+            num.fill_diagonal(covar, 1.)
+
+        return covar
 
     @property
     def station_component_mask(self):
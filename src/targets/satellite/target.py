@@ -1,15 +1,16 @@
 import logging
 import warnings
 import numpy as num
-from scipy import linalg as splinalg
 
 from pyrocko import gf
 from pyrocko.guts import String, Bool, Dict, List
 
 import os
 
+from grond import cache
 from grond.meta import Parameter, has_get_plot_classes
-from ..base import MisfitConfig, MisfitTarget, MisfitResult, TargetGroup
+from ..base import MisfitConfig, MisfitTarget, MisfitResult, TargetGroup, \
+    get_noise_weight_matrix
 
 guts_prefix = 'grond'
 logger = logging.getLogger('grond.targets.satellite.target')
@@ -131,6 +132,10 @@ class SatelliteMisfitTarget(gf.SatelliteTarget, MisfitTarget):
 
     can_bootstrap_residuals = True
 
+    #: Size limit of the on-disk cache of noise realisations, in bytes.
+    #: Least recently used realisations are removed beyond it.
+    noise_cache_size = 1024**3
+
     available_parameters = [
         Parameter('offset', 'm'),
         Parameter('ramp_north', 'm/m'),
@@ -175,8 +180,8 @@ class SatelliteMisfitTarget(gf.SatelliteTarget, MisfitTarget):
             cov = self.scene.covariance
             cov.nthreads = nthreads
 
-            self._noise_weight_matrix = splinalg.sqrtm(
-                num.linalg.inv(cov.covariance_matrix))
+            self._noise_weight_matrix = get_noise_weight_matrix(
+                cov.covariance_matrix)
 
             logger.info('Inverting scene covariance matrix done.')
 
@@ -198,12 +203,13 @@ class SatelliteMisfitTarget(gf.SatelliteTarget, MisfitTarget):
         obs = quadtree.leaf_medians
 
         if self.misfit_config.optimise_orbital_ramp:
-            stat_level = num.full_like(obs, self.parameter_values['offset'])
+            parameter_values = self.get_parameter_values(source)
+            stat_level = num.full_like(obs, parameter_values['offset'])
 
             stat_level += (quadtree.leaf_center_distance[:, 0]
-                           * self.parameter_values['ramp_east'])
+                           * parameter_values['ramp_east'])
             stat_level += (quadtree.leaf_center_distance[:, 1]
-                           * self.parameter_values['ramp_north'])
+                           * parameter_values['ramp_north'])
             statics['displacement.los'] += stat_level
 
         stat_syn = statics['displacement.los']
@@ -251,6 +257,24 @@ class SatelliteMisfitTarget(gf.SatelliteTarget, MisfitTarget):
         cov = scene.covariance
         bootstraps = num.zeros((nbootstraps, qt.nleaves))
 
+        # Each realisation gets its own random state, so that the result does
+        # not depend on the order in which the threads draw.
+        seeds = rstate.randint(0, 2**31-1, size=nbootstraps)
+
+        scene_key = cache.make_key(
+            'quadtree_noise',
+            self.scene_id,
+            scene.displacement,
+            str(qt.config),
+            str(cov.config))
+
+        def get_noise(seed):
+            return cache.cached_array(
+                'quadtree_noise',
+                cache.make_key(scene_key, int(seed)),
+                lambda: cov.getQuadtreeNoise(
+                    rstate=num.random.RandomState(seed)))
+
         try:
             # TODO:mi Signal handler is not given back to the main task!
             # This is a python3.7 bug
@@ -261,9 +285,7 @@ class SatelliteMisfitTarget(gf.SatelliteTarget, MisfitTarget):
             nthreads = os.cpu_count() if not nthreads else nthreads
 
             with ThreadPoolExecutor(max_workers=nthreads) as executor:
-                res = executor.map(
-                    cov.getQuadtreeNoise,
-                    [rstate for _ in range(nbootstraps)])
+                res = executor.map(get_noise, seeds)
 
                 for ibs, bs in enumerate(res):
                     bootstraps[ibs, :] = bs
@@ -272,8 +294,9 @@ class SatelliteMisfitTarget(gf.SatelliteTarget, MisfitTarget):
                 if not (ibs+1) % 5:
                     logger.info('Calculating noise realisation %d/%d.'
                                 % (ibs+1, nbootstraps))
-                bootstraps[ibs, :] = cov.getQuadtreeNoise(rstate=rstate)
+                bootstraps[ibs, :] = get_noise(seeds[ibs])
 
+        cache.prune('quadtree_noise', self.noise_cache_size)
         self.set_bootstrap_residuals(bootstraps)
 
     @classmethod
@@ -875,7 +875,7 @@ box, red).
 
         gcms = problem.combine_misfits(
             misfits[:1, :, :],
-            extra_correlated_weights=optimiser.get_correlated_weights(problem),
+            extra_correlated_weights=history.get_correlated_weights(optimiser),
             get_contributions=True)[0, :]
 
         w_max = num.nanmax(ws)
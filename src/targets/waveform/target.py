@@ -1,7 +1,10 @@
 from __future__ import print_function
 
+import copy
 import logging
 import math
+from collections import OrderedDict
+
 import numpy as num
 
 from pyrocko import gf, trace, weeding, util
@@ -10,6 +13,7 @@ from pyrocko.guts import (Object, String, Float, Bool, Int, StringChoice,
 from pyrocko.guts_array import Array
 
 from grond.dataset import NotFound
+from grond.timing import TimingTable, nan_to_none
 from grond.meta import GrondError, nslcs_to_patterns
 
 from ..base import (MisfitConfig, MisfitTarget, MisfitResult, TargetGroup)
@@ -281,10 +285,51 @@ class WaveformMisfitTarget(gf.Target, MisfitTarget):
 
     can_bootstrap_weights = True
 
+    #: Maximum number of processed observed traces kept per target.
+    processed_obs_cache_size = 64
+
     def __init__(self, **kwargs):
         gf.Target.__init__(self, **kwargs)
         MisfitTarget.__init__(self, **kwargs)
         self._piggyback_subtargets = []
+        self._processed_obs_cache = OrderedDict()
+
+    def set_dataset(self, ds):
+        MisfitTarget.set_dataset(self, ds)
+        self.clear_processed_obs_cache()
+
+    def clear_processed_obs_cache(self):
+        self._processed_obs_cache.clear()
+
+    def get_processed_obs(self, tr_obs, tobs_shift, taper, domain, tbins):
+        '''
+        Get observed trace processed for misfit calculation.
+
+        The observed side of the misfit depends on the model only through
+        the (sample quantised) taper window and the pick shift, so processed
+        traces and spectra are reused across models.
+        '''
+
+        deltat = tr_obs.deltat
+        key = (
+            domain, deltat, tobs_shift, tbins,
+            int(round(tr_obs.tmin / deltat)), tr_obs.data_len(),
+            tuple(int(round(t / deltat)) for t in (
+                taper.a, taper.b, taper.c, taper.d)))
+
+        cache = self._processed_obs_cache
+        try:
+            processed = cache.pop(key)
+
+        except KeyError:
+            tmin, tmax = taper.time_span()
+            processed = _process(tr_obs, tmin, tmax, taper, domain)
+
+            while len(cache) >= self.processed_obs_cache_size:
+                cache.popitem(last=False)
+
+        cache[key] = processed
+        return processed
 
     def string_id(self):
         return '.'.join(x for x in (self.path,) + self.codes)
@@ -304,11 +349,15 @@ class WaveformMisfitTarget(gf.Target, MisfitTarget):
             self._combined_weight = num.array([w], dtype=num.float)
         return self._combined_weight
 
-    def get_taper_params(self, engine, source):
+    def get_taper_params(self, engine, source, tmin_fit=None, tmax_fit=None):
         store = engine.get_store(self.store_id)
         config = self.misfit_config
-        tmin_fit = source.time + store.t(config.tmin, source, self)
-        tmax_fit = source.time + store.t(config.tmax, source, self)
+        if tmin_fit is None:
+            tmin_fit = source.time + store.t(config.tmin, source, self)
+
+        if tmax_fit is None:
+            tmax_fit = source.time + store.t(config.tmax, source, self)
+
         if config.fmin > 0.0:
             tfade = 1.0/config.fmin
         else:
@@ -336,16 +385,70 @@ class WaveformMisfitTarget(gf.Target, MisfitTarget):
             config.fmin, config.fmax,
             config.fmax*config.ffactor)
 
-    def get_pick_shift(self, engine, source):
+    @classmethod
+    def get_taper_params_many(cls, engine, source, targets, timing_table):
+        '''
+        Get taper parameters of several targets.
+
+        Fit window times are looked up for all targets at once in
+        *timing_table*, see :py:class:`grond.timing.TimingTable`.
+
+        :returns: list with the results of :py:meth:`get_taper_params` for
+            each target
+        '''
+
+        tmins = timing_table.get_times_many(
+            engine, [target.misfit_config.tmin for target in targets],
+            source, targets)
+        tmaxs = timing_table.get_times_many(
+            engine, [target.misfit_config.tmax for target in targets],
+            source, targets)
+
+        # undefined times: leave error handling to the scalar lookup
+        return [
+            target.get_taper_params(
+                engine, source,
+                tmin_fit=nan_to_none(tmin), tmax_fit=nan_to_none(tmax))
+            for (target, tmin, tmax) in zip(targets, tmins, tmaxs)]
+
+    @classmethod
+    def get_pick_shifts_many(cls, engine, source, targets, timing_table):
+        '''
+        Get pick shifts of several targets.
+
+        :returns: list with the results of :py:meth:`get_pick_shift` for
+            each target
+        '''
+
+        ipicks = [
+            i for (i, target) in enumerate(targets)
+            if target.misfit_config.pick_synthetic_traveltime
+            and target.misfit_config.pick_phasename]
+
+        tsyns = [None] * len(targets)
+        for i, tsyn in zip(ipicks, timing_table.get_times_many(
+                engine,
+                [targets[i].misfit_config.pick_synthetic_traveltime
+                 for i in ipicks],
+                source,
+                [targets[i] for i in ipicks])):
+
+            tsyns[i] = nan_to_none(tsyn)
+
+        return [
+            target.get_pick_shift(engine, source, tsyn=tsyn)
+            for (target, tsyn) in zip(targets, tsyns)]
+
+    def get_pick_shift(self, engine, source, tsyn=None):
         config = self.misfit_config
         tobs = None
-        tsyn = None
         ds = self.get_dataset()
 
         if config.pick_synthetic_traveltime and config.pick_phasename:
-            store = engine.get_store(self.store_id)
-            tsyn = source.time + store.t(
-                config.pick_synthetic_traveltime, source, self)
+            if tsyn is None:
+                store = engine.get_store(self.store_id)
+                tsyn = source.time + store.t(
+                    config.pick_synthetic_traveltime, source, self)
 
             marker = ds.get_pick(
                 source.name,
@@ -371,92 +474,259 @@ class WaveformMisfitTarget(gf.Target, MisfitTarget):
 
         return tmin_obs, tmax_obs
 
-    def post_process(self, engine, source, tr_syn):
+    def get_synthetic_response(self):
+        config = self.misfit_config
+        if config.quantity == 'displacement':
+            return None
+        elif config.quantity == 'velocity':
+            return trace.DifferentiationResponse(1)
+        elif config.quantity == 'acceleration':
+            return trace.DifferentiationResponse(2)
+        else:
+            GrondError('Unsupported quantity: %s' % config.quantity)
+
+    @classmethod
+    def process_synthetics_many(
+            cls, engine, source, targets, trs_syn, taper_params=None):
+
+        '''
+        Filter synthetic traces of several targets.
+
+        Traces sharing sampling interval, filter settings and quantity are
+        filtered together, see :py:func:`transfer_many`.
+
+        :param targets: list of :py:class:`WaveformMisfitTarget`
+        :param trs_syn: list of :py:class:`pyrocko.gf.meta.SeismosizerTrace`
+        :param taper_params: optional list with the results of
+            :py:meth:`get_taper_params` for each target
+        :returns: list of :py:class:`pyrocko.trace.Trace`
+        '''
+
+        if taper_params is None:
+            taper_params = [
+                target.get_taper_params(engine, source) for target in targets]
+
+        groups = {}
+        trs_ext = []
+        for itarget, (target, tr_syn, (tmin_fit, tmax_fit, tfade, _)) \
+                in enumerate(zip(targets, trs_syn, taper_params)):
 
-        tr_syn = tr_syn.pyrocko_trace()
-        nslc = self.codes
+            tr_syn = tr_syn.pyrocko_trace()
+            tr_syn.extend(
+                tmin_fit - tfade * 2.0,
+                tmax_fit + tfade * 2.0,
+                fillmethod='repeat')
+
+            trs_ext.append(tr_syn)
+
+            key = (
+                tr_syn.deltat, target.get_freqlimits(), tfade,
+                target.misfit_config.quantity)
+
+            groups.setdefault(key, []).append(itarget)
+
+        trs_proc = [None] * len(targets)
+        for (_, freqlimits, tfade, quantity), itargets in groups.items():
+            trs = transfer_many(
+                [trs_ext[i] for i in itargets],
+                tfade=tfade,
+                freqlimits=freqlimits,
+                transfer_function=targets[
+                    itargets[0]].get_synthetic_response(),
+                cache_key=quantity)
+
+            for itarget, tr in zip(itargets, trs):
+                tmin_fit, tmax_fit, tfade, _ = taper_params[itarget]
+                tr.chop(tmin_fit - 2*tfade, tmax_fit + 2*tfade)
+                trs_proc[itarget] = tr
+
+        return trs_proc
+
+    def get_observed(
+            self, engine, source, deltat, taper_params=None, pick_shift=None):
+
+        '''
+        Get observed trace and taper for misfit calculation.
+
+        Raises :py:exc:`grond.dataset.NotFound` if no waveform data is
+        available.
+
+        :param taper_params: optional result of :py:meth:`get_taper_params`
+        :param pick_shift: optional result of :py:meth:`get_pick_shift`
+        :returns: tuple ``(tr_obs, taper, processed_obs, tobs_shift, tsyn)``
+        '''
 
         config = self.misfit_config
 
-        tmin_fit, tmax_fit, tfade, tfade_taper = \
-            self.get_taper_params(engine, source)
+        if taper_params is None:
+            taper_params = self.get_taper_params(engine, source)
+
+        if pick_shift is None:
+            pick_shift = self.get_pick_shift(engine, source)
+
+        tmin_fit, tmax_fit, tfade, tfade_taper = taper_params
 
         ds = self.get_dataset()
 
-        tobs, tsyn = self.get_pick_shift(engine, source)
+        tobs, tsyn = pick_shift
         if None not in (tobs, tsyn):
             tobs_shift = tobs - tsyn
         else:
             tobs_shift = 0.0
 
-        tr_syn.extend(
-            tmin_fit - tfade * 2.0,
-            tmax_fit + tfade * 2.0,
-            fillmethod='repeat')
+        # Taper corners are aligned to the sampling grid, so that the
+        # processed observed trace can be reused by nearby models.
+        taper = trace.CosTaper(*(
+            round(t / deltat) * deltat for t in (
+                tmin_fit - tfade_taper,
+                tmin_fit,
+                tmax_fit,
+                tmax_fit + tfade_taper)))
+
+        tinc_cache = 1.0/(config.fmin or 0.1*config.fmax)
+        tmin_obs_req = tmin_fit+tobs_shift-tfade
+        tmax_obs_req = tmax_fit+tobs_shift+tfade
+
+        tr_obs = ds.get_waveform(
+            self.codes,
+            quantity=config.quantity,
+            tinc_cache=tinc_cache,
+            tmin=tmin_obs_req,
+            tmax=tmax_obs_req,
+            tfade=tfade,
+            freqlimits=self.get_freqlimits(),
+            deltat=deltat,
+            cache=True,
+            backazimuth=self.get_backazimuth_for_waveform())
 
-        freqlimits = self.get_freqlimits()
+        if tobs_shift != 0.0:
+            tr_obs = tr_obs.copy()
+            tr_obs.shift(-tobs_shift)
 
-        if config.quantity == 'displacement':
-            syn_resp = None
-        elif config.quantity == 'velocity':
-            syn_resp = trace.DifferentiationResponse(1)
-        elif config.quantity == 'acceleration':
-            syn_resp = trace.DifferentiationResponse(2)
-        else:
-            GrondError('Unsupported quantity: %s' % config.quantity)
+        processed_obs = self.get_processed_obs(
+            tr_obs, tobs_shift, taper, config.domain,
+            tbins=(int(math.floor(tmin_obs_req / tinc_cache)),
+                   int(math.ceil(tmax_obs_req / tinc_cache))))
 
-        tr_syn = tr_syn.transfer(
-            freqlimits=freqlimits,
-            tfade=tfade,
-            transfer_function=syn_resp)
+        return tr_obs, taper, processed_obs, tobs_shift, tsyn
 
-        tr_syn.chop(tmin_fit - 2*tfade, tmax_fit + 2*tfade)
+    def post_process(self, engine, source, tr_syn):
+        result = self.post_process_many(engine, source, [self], [tr_syn])[0]
+        if isinstance(result, gf.SeismosizerError):
+            raise result
 
-        tmin_obs, tmax_obs = self.get_cutout_timespan(
-            tmin_fit+tobs_shift, tmax_fit+tobs_shift, tfade)
+        return result
 
-        try:
-            tr_obs = ds.get_waveform(
-                nslc,
-                quantity=config.quantity,
-                tinc_cache=1.0/(config.fmin or 0.1*config.fmax),
-                tmin=tmin_fit+tobs_shift-tfade,
-                tmax=tmax_fit+tobs_shift+tfade,
-                tfade=tfade,
-                freqlimits=freqlimits,
-                deltat=tr_syn.deltat,
-                cache=True,
-                backazimuth=self.get_backazimuth_for_waveform())
-
-            if tobs_shift != 0.0:
-                tr_obs = tr_obs.copy()
-                tr_obs.shift(-tobs_shift)
-
-            mr = misfit(
-                tr_obs, tr_syn,
-                taper=trace.CosTaper(
-                    tmin_fit - tfade_taper,
-                    tmin_fit,
-                    tmax_fit,
-                    tmax_fit + tfade_taper),
-                domain=config.domain,
-                exponent=config.norm_exponent,
-                flip=self.flip_norm,
-                result_mode=self._result_mode,
-                tautoshift_max=config.tautoshift_max,
-                autoshift_penalty_max=config.autoshift_penalty_max,
-                subtargets=self._piggyback_subtargets)
-
-            self._piggyback_subtargets = []
-
-            mr.tobs_shift = float(tobs_shift)
-            mr.tsyn_pick = float_or_none(tsyn)
-
-            return mr
-
-        except NotFound as e:
-            logger.debug(str(e))
-            raise gf.SeismosizerError('No waveform data: %s' % str(e))
+    @classmethod
+    def post_process_many(
+            cls, engine, source, targets, trs_syn, timing_table=None):
+        '''
+        Calculate misfits of several waveform targets for one source.
+
+        Gives the same results as :py:meth:`post_process` for every target,
+        but synthetics are filtered in batches, see
+        :py:meth:`process_synthetics_many`, and misfits in the spectral
+        domains are computed in batches of targets with equal sampling and
+        window length.
+
+        :param targets: list of :py:class:`WaveformMisfitTarget`
+        :param trs_syn: list of :py:class:`pyrocko.gf.meta.SeismosizerTrace`
+            as returned by the forward modelling of the targets
+        :param timing_table: :py:class:`grond.timing.TimingTable` used to
+            look up the fit windows and pick times
+        :returns: list of :py:class:`WaveformMisfitResult` or
+            :py:exc:`pyrocko.gf.SeismosizerError`, if no waveform data is
+            available for a target
+        '''
+
+        if timing_table is None:
+            timing_table = TimingTable()
+
+        taper_params = cls.get_taper_params_many(
+            engine, source, targets, timing_table)
+
+        pick_shifts = cls.get_pick_shifts_many(
+            engine, source, targets, timing_table)
+
+        trs_syn = cls.process_synthetics_many(
+            engine, source, targets, trs_syn, taper_params)
+
+        results = [None] * len(targets)
+        batches = {}
+        for itarget, (target, tr_syn) in enumerate(zip(targets, trs_syn)):
+            config = target.misfit_config
+            try:
+                tr_obs, taper, processed_obs, tobs_shift, tsyn = \
+                    target.get_observed(
+                        engine, source, tr_syn.deltat,
+                        taper_params[itarget], pick_shifts[itarget])
+
+            except NotFound as e:
+                logger.debug(str(e))
+                results[itarget] = gf.SeismosizerError(
+                    'No waveform data: %s' % str(e))
+                continue
+
+            if config.domain in ('frequency_domain', 'log_frequency_domain') \
+                    and target._result_mode == 'sparse':
+
+                deltat = tr_syn.deltat
+                tmin, tmax = taper.time_span()
+                key = (
+                    config.domain, config.norm_exponent, target.flip_norm,
+                    deltat,
+                    int(math.ceil(tmax/deltat)) - int(math.floor(tmin/deltat)))
+
+                batches.setdefault(key, []).append(
+                    (itarget, tr_syn, taper, processed_obs, tobs_shift, tsyn))
+
+            else:
+                mr = misfit(
+                    tr_obs, tr_syn,
+                    taper=taper,
+                    domain=config.domain,
+                    exponent=config.norm_exponent,
+                    flip=target.flip_norm,
+                    result_mode=target._result_mode,
+                    tautoshift_max=config.tautoshift_max,
+                    autoshift_penalty_max=config.autoshift_penalty_max,
+                    subtargets=target._piggyback_subtargets,
+                    processed_obs=processed_obs)
+
+                mr.tobs_shift = float(tobs_shift)
+                mr.tsyn_pick = float_or_none(tsyn)
+                results[itarget] = mr
+
+        for (domain, exponent, flip, _, _), batch in batches.items():
+            itargets, trs_syn, tapers, processed_obs, tobs_shifts, tsyns = \
+                zip(*batch)
+
+            ms, ns, trs_proc_syn, spectra_syn = spectral_misfits(
+                trs_syn, tapers,
+                num.array([trspec.ydata for (_, trspec) in processed_obs]),
+                domain, exponent, flip)
+
+            for i, itarget in enumerate(itargets):
+                target = targets[itarget]
+                result = WaveformMisfitResult(
+                    misfits=num.array([[ms[i], ns[i]]], dtype=num.float),
+                    tobs_shift=float(tobs_shifts[i]),
+                    tsyn_pick=float_or_none(tsyns[i]))
+
+                if target._piggyback_subtargets:
+                    trspec_proc_syn = trspec_from_trace(
+                        trs_proc_syn[i], spectra_syn[i],
+                        trace.nextpow2(trs_proc_syn[i].ydata.size))
+
+                    for subtarget in target._piggyback_subtargets:
+                        result.piggyback_subresults.append(
+                            subtarget.evaluate(
+                                processed_obs[i][0], processed_obs[i][1],
+                                trs_proc_syn[i], trspec_proc_syn))
+
+                results[itarget] = result
+
+        return results
 
     def get_plain_targets(self, engine, source):
         d = dict(
@@ -466,10 +736,14 @@ class WaveformMisfitTarget(gf.Target, MisfitTarget):
     def add_piggyback_subtarget(self, subtarget):
         self._piggyback_subtargets.append(subtarget)
 
+    def clear_piggyback_subtargets(self):
+        self._piggyback_subtargets = []
+
 
 def misfit(
         tr_obs, tr_syn, taper, domain, exponent, tautoshift_max,
-        autoshift_penalty_max, flip, result_mode='sparse', subtargets=[]):
+        autoshift_penalty_max, flip, result_mode='sparse', subtargets=[],
+        processed_obs=None):
 
     '''
     Calculate misfit between observed and synthetic trace.
@@ -490,6 +764,9 @@ tautoshift**2 / tautoshift_max**2``
         computed against *tr_syn* rather than *tr_obs*
     :param result_mode: ``'full'``, include traces and spectra or ``'sparse'``,
         include only misfit and normalization factor in result
+    :param processed_obs: optional tuple of observed trace and spectrum, as
+        returned by :py:func:`_process` for *tr_obs* and *taper*, e.g. from a
+        cache. These are not modified.
 
     :returns: object of type :py:class:`WaveformMisfitResult`
     '''
@@ -498,7 +775,11 @@ tautoshift**2 / tautoshift_max**2``
     deltat = tr_obs.deltat
     tmin, tmax = taper.time_span()
 
-    tr_proc_obs, trspec_proc_obs = _process(tr_obs, tmin, tmax, taper, domain)
+    if processed_obs is None:
+        tr_proc_obs, trspec_proc_obs = _process(
+            tr_obs, tmin, tmax, taper, domain)
+    else:
+        tr_proc_obs, trspec_proc_obs = processed_obs
     tr_proc_syn, trspec_proc_syn = _process(tr_syn, tmin, tmax, taper, domain)
 
     piggyback_results = []
@@ -521,26 +802,8 @@ tautoshift**2 / tautoshift_max**2``
         if nshift_max == 0:
             m, n = trace.Lx_norm(a, b, norm=exponent)
         else:
-            mns = []
-            for ishift in range(-nshift_max, nshift_max+1):
-                if ishift < 0:
-                    a_cut = a[-ishift:]
-                    b_cut = b[:ishift]
-                elif ishift == 0:
-                    a_cut = a
-                    b_cut = b
-                elif ishift > 0:
-                    a_cut = a[:-ishift]
-                    b_cut = b[ishift:]
-
-                mns.append(trace.Lx_norm(a_cut, b_cut, norm=exponent))
-
-            ms, ns = num.array(mns).T
-
-            iarg = num.argmin(ms)
-            tshift = (iarg-nshift_max)*deltat
-
-            m, n = ms[iarg], ns[iarg]
+            ishift, m, n = _autoshift_lx_norm(a, b, nshift_max, exponent)
+            tshift = ishift*deltat
             m += autoshift_penalty_max * n * tshift**2 / tautoshift_max**2
 
     elif domain == 'cc_max_norm':
@@ -580,6 +843,11 @@ tautoshift**2 / tautoshift_max**2``
         m, n = trace.Lx_norm(a, b, norm=exponent)
 
     if result_mode == 'full':
+        if processed_obs is not None:
+            tr_proc_obs = tr_proc_obs.copy()
+            if trspec_proc_obs is not None:
+                trspec_proc_obs = copy.deepcopy(trspec_proc_obs)
+
         result = WaveformMisfitResult(
             misfits=num.array([[m, n]], dtype=num.float),
             processed_obs=tr_proc_obs,
@@ -603,6 +871,268 @@ tautoshift**2 / tautoshift_max**2``
     return result
 
 
+g_transfer_coefs = {}
+
+
+def transfer_many(
+        trs, tfade, freqlimits, transfer_function=None, cache_key=None):
+
+    '''
+    Apply transfer function to several traces at once.
+
+    Gives the same results as :py:meth:`pyrocko.trace.Trace.transfer` with
+    default settings for each trace. Traces with the same FFT length are
+    transformed together, with a single FFT call. All traces must have the
+    same sampling interval.
+
+    :param trs: list of :py:class:`pyrocko.trace.Trace`
+    :param tfade: rise/fall time in seconds of taper applied in time domain
+    :param freqlimits: 4-tuple with corner frequencies in Hz
+    :param transfer_function: :py:class:`pyrocko.trace.FrequencyResponse`
+        object, ``None`` for a flat response
+    :param cache_key: if given, the tapered transfer function coefficients
+        are cached under this key, which must identify *transfer_function*
+    :returns: list of filtered traces
+    '''
+
+    if transfer_function is None:
+        transfer_function = trace.FrequencyResponse()
+
+    groups = {}
+    trs_out = [None] * len(trs)
+    for itr, tr in enumerate(trs):
+        if tr.tmax - tr.tmin <= tfade*2.:
+            # raises TraceTooShort
+            trs_out[itr] = tr.transfer(
+                tfade=tfade, freqlimits=freqlimits,
+                transfer_function=transfer_function)
+        else:
+            ntrans = trace.nextpow2(tr.ydata.size*1.2)
+            groups.setdefault(ntrans, []).append(itr)
+
+    for ntrans, itrs in groups.items():
+        tr0 = trs[itrs[0]]
+        key = (cache_key, tr0.deltat, ntrans, freqlimits)
+        if cache_key is not None and key in g_transfer_coefs:
+            coefs = g_transfer_coefs[key]
+        else:
+            coefs = tr0._get_tapered_coefs(
+                ntrans, freqlimits, transfer_function)
+
+            if cache_key is not None:
+                if len(g_transfer_coefs) > 100:
+                    g_transfer_coefs.clear()
+
+                g_transfer_coefs[key] = coefs
+
+        data_pad = num.zeros((len(itrs), ntrans), dtype=num.float)
+        tapers = {}
+        for irow, itr in enumerate(itrs):
+            data = trs[itr].ydata
+            ndata = data.size
+            data_pad[irow, :ndata] = data
+            data_pad[irow, :ndata] -= data.mean()
+            if tfade != 0.0:
+                if ndata not in tapers:
+                    tapers[ndata] = trace.costaper(
+                        0., tfade, tr0.deltat*(ndata-1)-tfade,
+                        tr0.deltat*ndata, ndata, tr0.deltat)
+
+                data_pad[irow, :ndata] *= tapers[ndata]
+
+        fdata = num.fft.rfft(data_pad, axis=1)
+        fdata *= coefs
+        ddata = num.fft.irfft(fdata, axis=1)
+
+        for irow, itr in enumerate(itrs):
+            tr = trs[itr]
+            output = tr.copy(data=False)
+            output.set_ydata(ddata[irow, :tr.ydata.size])
+            if tfade != 0.0:
+                output.chop(output.tmin+tfade, output.tmax-tfade, inplace=True)
+            else:
+                output.set_ydata(output.ydata.copy())
+
+            trs_out[itr] = output
+
+    return trs_out
+
+
+def _lx_norm_rows(u, v, norm):
+    # row-wise equivalent of trace.Lx_norm
+    if norm == 1:
+        return (
+            num.sum(num.abs(v-u), axis=1),
+            num.sum(num.abs(v), axis=1))
+
+    elif norm == 2:
+        return (
+            num.sqrt(num.sum((v-u)**2, axis=1)),
+            num.sqrt(num.sum(v**2, axis=1)))
+
+    else:
+        return (
+            num.power(
+                num.sum(num.abs(num.power(v - u, norm)), axis=1), 1./norm),
+            num.power(num.sum(num.abs(num.power(v, norm)), axis=1), 1./norm))
+
+
+def spectral_misfits(trs_syn, tapers, spectra_obs, domain, exponent, flip):
+    '''
+    Calculate spectral domain misfits of several synthetic traces at once.
+
+    Traces are processed as in :py:func:`misfit` and transformed with a
+    single FFT call, norms are computed for all traces together. All traces
+    must have the same sampling interval and the same number of samples in
+    their taper windows.
+
+    :param trs_syn: synthetic traces
+    :param tapers: taper for each synthetic trace
+    :param spectra_obs: 2D array with processed observed spectra, one row per
+        trace
+    :param domain: ``'frequency_domain'`` or ``'log_frequency_domain'``
+    :param exponent: exponent of Lx type norms
+    :param flip: ``bool``, if set to ``True``, normalization factor is
+        computed against synthetics rather than observations
+
+    :returns: ``(ms, ns, trs_proc_syn, spectra_syn)``, misfits,
+        normalization factors, processed synthetic traces and 2D array with
+        their spectra
+    '''
+
+    trs_proc_syn = []
+    for tr_syn, taper in zip(trs_syn, tapers):
+        tmin, tmax = taper.time_span()
+        tr_proc = _extend_extract(tr_syn, tmin, tmax)
+        tr_proc.taper(taper)
+        trs_proc_syn.append(tr_proc)
+
+    ndata = trs_proc_syn[0].ydata.size
+    nfft = trace.nextpow2(ndata)
+    padded = num.zeros((len(trs_proc_syn), nfft), dtype=num.float)
+    for itr, tr_proc in enumerate(trs_proc_syn):
+        padded[itr, :ndata] = tr_proc.ydata
+
+    spectra_syn = num.fft.rfft(padded, axis=1)
+
+    a, b = spectra_syn, spectra_obs
+    if flip:
+        b, a = a, b
+
+    a = num.abs(a)
+    b = num.abs(b)
+
+    if domain == 'log_frequency_domain':
+        eps = (num.mean(a, axis=1) + num.mean(b, axis=1)) * 1e-7
+        eps[eps == 0.0] = 1e-7
+
+        a = num.log(a + eps[:, num.newaxis])
+        b = num.log(b + eps[:, num.newaxis])
+
+    ms, ns = _lx_norm_rows(a, b, exponent)
+    return ms, ns, trs_proc_syn, spectra_syn
+
+
+def _shifted_cut(a, b, ishift):
+    if ishift < 0:
+        return a[-ishift:], b[:ishift]
+    elif ishift == 0:
+        return a, b
+    else:
+        return a[:-ishift], b[ishift:]
+
+
+def _shifted_powersums(a, b, nshift_max, norm):
+    '''
+    Get ``sum(abs(b_cut - a_cut)**norm)`` for all shifts, vectorised.
+
+    Element ``i`` corresponds to shift ``i - nshift_max``, where samples
+    ``a[j]`` and ``b[j+ishift]`` are compared.
+    '''
+
+    nsamples = a.size
+    ishifts = num.arange(-nshift_max, nshift_max+1)
+
+    if norm == 2:
+        # sum((b-a)**2) = sum(a**2) + sum(b**2) - 2 * sum(a*b)
+        a2 = num.concatenate(([0.], num.cumsum(a**2)))
+        b2 = num.concatenate(([0.], num.cumsum(b**2)))
+        ncut = nsamples - num.abs(ishifts)
+        ipos = ishifts >= 0
+        sa2 = num.where(ipos, a2[ncut], a2[-1] - a2[nsamples - ncut])
+        sb2 = num.where(ipos, b2[-1] - b2[nsamples - ncut], b2[ncut])
+
+        nfft = trace.nextpow2(2*nsamples)
+        corr = num.fft.irfft(
+            num.fft.rfft(b, nfft) * num.conj(num.fft.rfft(a, nfft)), nfft)
+
+        return sa2 + sb2 - 2.0 * corr[ishifts]
+
+    else:
+        # sliding windows over zero padded b, in blocks of shifts to limit
+        # memory usage; padded samples contribute abs(a)**norm, which is
+        # subtracted afterwards
+        nshifts = ishifts.size
+        bpad = num.zeros(nsamples + 2*nshift_max)
+        bpad[nshift_max:nshift_max+nsamples] = b
+        bwin = num.lib.stride_tricks.as_strided(
+            bpad, (nshifts, nsamples), bpad.strides * 2)
+
+        nblock = max(1, 2**18 // nsamples)
+        buf = num.empty((min(nblock, nshifts), nsamples))
+        sums = num.empty(nshifts)
+        for iblock in range(0, nshifts, nblock):
+            win = bwin[iblock:iblock+nblock]
+            d = buf[:win.shape[0]]
+            num.subtract(win, a, out=d)
+            num.abs(d, out=d)
+            if norm != 1:
+                num.power(d, norm, out=d)
+
+            sums[iblock:iblock+nblock] = num.sum(d, axis=1)
+
+        apow = num.concatenate(([0.], num.cumsum(num.abs(a)**norm)))
+        npad = num.abs(ishifts)
+        sums -= num.where(
+            ishifts >= 0, apow[-1] - apow[nsamples - npad], apow[npad])
+
+        return sums
+
+
+def _autoshift_lx_norm(a, b, nshift_max, norm):
+    '''
+    Find shift of ``b`` against ``a`` minimizing the Lx norm misfit.
+
+    Result is identical to evaluating :py:func:`pyrocko.trace.Lx_norm` for
+    every shift between ``-nshift_max`` and ``nshift_max`` and choosing the
+    first minimum. The power sums of all shifts are computed at once,
+    candidates close to the minimum are then rechecked with
+    :py:func:`pyrocko.trace.Lx_norm`.
+
+    :returns: ``(ishift, m, n)``
+    '''
+
+    ishifts = num.arange(-nshift_max, nshift_max+1)
+
+    sums = _shifted_powersums(a, b, nshift_max, norm)
+
+    # bound for the rounding errors of the vectorised sums
+    tolerance = 1e-9 * 2.0**norm * (
+        num.sum(num.abs(a)**norm) + num.sum(num.abs(b)**norm))
+
+    if num.all(num.isfinite(sums)) and num.isfinite(tolerance):
+        candidates = ishifts[sums <= num.min(sums) + tolerance]
+    else:
+        candidates = ishifts
+
+    mns = [trace.Lx_norm(*_shifted_cut(a, b, ishift), norm=norm)
+           for ishift in candidates]
+
+    ms, ns = num.array(mns).T
+    iarg = num.argmin(ms)
+    return int(candidates[iarg]), ms[iarg], ns[iarg]
+
+
 def _extend_extract(tr, tmin, tmax):
     deltat = tr.deltat
     itmin_frame = int(math.floor(tmin/deltat))
@@ -629,7 +1159,6 @@ def _process(tr, tmin, tmax, taper, domain):
     tr_proc = _extend_extract(tr, tmin, tmax)
     tr_proc.taper(taper)
 
-    df = None
     trspec_proc = None
 
     if domain == 'envelope':
@@ -645,20 +1174,24 @@ def _process(tr, tmin, tmax, taper, domain):
         padded = num.zeros(nfft, dtype=num.float)
         padded[:ndata] = tr_proc.ydata
         spectrum = num.fft.rfft(padded)
-        df = 1.0 / (tr_proc.deltat * nfft)
-
-        trspec_proc = TraceSpectrum(
-            network=tr_proc.network,
-            station=tr_proc.station,
-            location=tr_proc.location,
-            channel=tr_proc.channel,
-            deltaf=df,
-            fmin=0.0,
-            ydata=spectrum)
+        trspec_proc = trspec_from_trace(tr_proc, spectrum, nfft)
 
     return tr_proc, trspec_proc
 
 
+def trspec_from_trace(tr_proc, spectrum, nfft):
+    df = 1.0 / (tr_proc.deltat * nfft)
+
+    return TraceSpectrum(
+        network=tr_proc.network,
+        station=tr_proc.station,
+        location=tr_proc.location,
+        channel=tr_proc.channel,
+        deltaf=df,
+        fmin=0.0,
+        ydata=spectrum)
+
+
 def backazimuth_for_waveform(azimuth, nslc):
     if nslc[-1] == 'R':
         backazimuth = azimuth + 180.
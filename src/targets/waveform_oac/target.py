@@ -57,6 +57,9 @@ class WOACTarget(MisfitTarget):
 
     can_bootstrap_weights = True
 
+    # piggyback subtargets are cleared after each modelling
+    prepare_modelling_per_model = True
+
     def __init__(self, **kwargs):
         MisfitTarget.__init__(self, **kwargs)
         self.piggy_ids = set()
@@ -72,6 +75,7 @@ class WOACTarget(MisfitTarget):
 
     def prepare_modelling(self, engine, source, targets):
         from ..waveform.target import WaveformMisfitTarget
+        self.piggy_ids = set()
         relevant = []
         for target in targets:
             if isinstance(target, WaveformMisfitTarget) \
@@ -92,15 +96,13 @@ class WOACTarget(MisfitTarget):
         for mtarget, mresult in zip(modelling_targets, modelling_results):
             if isinstance(mresult, WaveformMisfitResult):
                 for sr in list(mresult.piggyback_subresults):
-                    try:
-                        self.piggy_ids.remove(sr.piggy_id)
+                    if sr.piggy_id in self.piggy_ids:
                         amps.append((sr.amplitude_obs, sr.amplitude_syn))
                         mresult.piggyback_subresults.remove(sr)
-                    except KeyError:
+                    else:
                         logger.error(
                             'Found inconsistency while gathering piggyback '
                             'results.')
-                        pass
 
         amps = num.array(amps, dtype=num.float)
         mask = num.all(num.isfinite(amps), axis=1)
@@ -3,6 +3,8 @@ from pyrocko import gf, trace
 from pyrocko.guts import Object, Float, StringChoice, List, String
 from pyrocko.gui import marker
 
+from grond.timing import TimingTable
+
 
 guts_prefix = 'grond'
 
@@ -84,9 +86,19 @@ class FeatureMeasure(Object):
     quantity = WaveformQuantity.T(default='displacement')
     method = FeatureMethod.T(default='peak_component')
 
+    def __init__(self, **kwargs):
+        Object.__init__(self, **kwargs)
+        self._timing_table = None
+
     def get_nmodelling_targets(self):
         return len(self.channels)
 
+    def get_timing_table(self):
+        if self._timing_table is None:
+            self._timing_table = TimingTable()
+
+        return self._timing_table
+
     def get_modelling_targets(
             self, codes, lat, lon, depth, store_id, backazimuth):
 
@@ -123,6 +135,14 @@ class FeatureMeasure(Object):
 
         from ..waveform import target as base
 
+        # components of a station share the arrival times, obs and syn
+        # evaluation of the same source use the cached times
+        timing_table = self.get_timing_table()
+        tmins = timing_table.get_times(
+            engine, self.timing_tmin, source, targets)
+        tmaxs = timing_table.get_times(
+            engine, self.timing_tmax, source, targets)
+
         trs_processed = []
         trs_orig = []
         for itarget, target in enumerate(targets):
@@ -131,8 +151,12 @@ class FeatureMeasure(Object):
 
             store = engine.get_store(target.store_id)
 
-            tmin = source.time + store.t(self.timing_tmin, source, target)
-            tmax = source.time + store.t(self.timing_tmax, source, target)
+            tmin, tmax = float(tmins[itarget]), float(tmaxs[itarget])
+            if num.isnan(tmin):
+                tmin = source.time + store.t(self.timing_tmin, source, target)
+
+            if num.isnan(tmax):
+                tmax = source.time + store.t(self.timing_tmax, source, target)
 
             if self.fmin is not None and self.fmax is not None:
                 freqlimits = [
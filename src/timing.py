@@ -0,0 +1,286 @@
+'''
+Vectorised and cached evaluation of phase arrival times.
+'''
+
+import logging
+from collections import OrderedDict
+
+import numpy as num
+
+from pyrocko import gf, spit, orthodrome as od
+
+logger = logging.getLogger('grond.timing')
+
+
+def nan_to_none(x):
+    if num.isnan(x):
+        return None
+    else:
+        return float(x)
+
+
+def source_location_key(source):
+    return (
+        source.lat, source.lon, source.north_shift, source.east_shift,
+        source.depth)
+
+
+def receiver_location_key(target):
+    return (
+        target.store_id, target.lat, target.lon, target.north_shift,
+        target.east_shift, target.depth)
+
+
+def distances(source, targets):
+    '''
+    Surface distances from source to targets.
+
+    Vectorised version of :py:meth:`pyrocko.gf.Location.distance_to`, with
+    identical results.
+    '''
+
+    dists = num.empty(len(targets))
+    same_origin = num.array([
+        source.same_origin(target) for target in targets], dtype=num.bool)
+
+    if num.any(same_origin):
+        north_shifts, east_shifts = num.array([
+            (target.north_shift, target.east_shift)
+            for (target, same) in zip(targets, same_origin) if same]).T
+
+        dists[same_origin] = num.sqrt(
+            (source.north_shift - north_shifts)**2 +
+            (source.east_shift - east_shifts)**2)
+
+    if not num.all(same_origin):
+        slat, slon = source.effective_latlon
+        rlats, rlons = num.array([
+            target.effective_latlon
+            for (target, same) in zip(targets, same_origin) if not same]).T
+
+        dists[~same_origin] = od.distance_accurate50m_numpy(
+            slat, slon, rlats, rlons)
+
+    return dists
+
+
+def _interpolate_cell(cell, x, indices, result):
+    if cell.children:
+        for child in cell.children:
+            xs = x[indices]
+            inside = num.all(num.logical_and(
+                child.xbounds[:, 0] <= xs, xs <= child.xbounds[:, 1]), axis=1)
+
+            if num.any(inside):
+                _interpolate_cell(child, x, indices[inside], result)
+                indices = indices[~inside]
+                if indices.size == 0:
+                    break
+
+    elif num.all(num.isfinite(cell.f)):
+        npoints, ndim = indices.size, x.shape[1]
+        ws = (x[indices, :, num.newaxis] - cell.a) / cell.b
+        wn = 1.0
+        for idim in range(ndim):
+            shape = [npoints] + [1] * ndim
+            shape[1+idim] = 2
+            wn = wn * ws[:, idim, :].reshape(shape)
+
+        result[indices] = num.sum(
+            (cell.f * wn).reshape((npoints, -1)), axis=1)
+
+
+def interpolate_many(tree, x):
+    '''
+    Interpolate :py:class:`pyrocko.spit.SPTree` at many points.
+
+    Unlike :py:meth:`pyrocko.spit.SPTree.interpolate_many`, results are
+    identical to those of :py:meth:`pyrocko.spit.SPTree.interpolate` for
+    every point, also for points on cell boundaries. Undefined values and
+    points out of bounds are ``NaN``.
+
+    :param x: 2D array ``x[ipoint, idim]``
+    '''
+
+    result = num.full(x.shape[0], num.nan)
+    inside = num.all(num.logical_and(
+        tree.xbounds[:, 0] <= x, x <= tree.xbounds[:, 1]), axis=1)
+
+    _interpolate_cell(tree.root, x, num.where(inside)[0], result)
+    return result
+
+
+class TimingTable(object):
+    '''
+    Phase arrival times for many receivers, cached per source location.
+
+    Timings based on stored travel time tables are interpolated for all
+    receivers in a single call, other timings are evaluated one by one with
+    :py:meth:`pyrocko.gf.Store.t`. Times are cached per source location,
+    timing and receiver location, so that repeated lookups, e.g. for the
+    components of a station or for several models with the same source
+    location, are served from the cache.
+    '''
+
+    #: Maximum number of source location and timing combinations kept.
+    cache_size = 64
+
+    def __init__(self):
+        self._cache = OrderedDict()
+
+    def clear(self):
+        self._cache.clear()
+
+    def get_times(self, engine, timing, source, targets):
+        '''
+        Get phase arrival times at several targets.
+
+        Gives the same results as
+        ``source.time + store.t(timing, source, target)`` for each target.
+
+        :param engine: :py:class:`pyrocko.gf.LocalEngine`
+        :param timing: :py:class:`pyrocko.gf.Timing` or timing string
+        :param source: :py:class:`pyrocko.gf.Source`
+        :param targets: list of :py:class:`pyrocko.gf.Target`
+        :returns: array of arrival times, ``NaN`` where the timing is not
+            defined or out of the bounds of the travel time tables
+        '''
+
+        if not isinstance(timing, gf.Timing):
+            timing = gf.Timing(timing)
+
+        key = (source_location_key(source), str(timing))
+        try:
+            entry = self._cache.pop(key)
+        except KeyError:
+            entry = {}
+            while len(self._cache) >= self.cache_size:
+                self._cache.popitem(last=False)
+
+        self._cache[key] = entry
+
+        rkeys = [receiver_location_key(target) for target in targets]
+
+        missing = OrderedDict()
+        for rkey, target in zip(rkeys, targets):
+            if rkey not in entry and rkey not in missing:
+                missing[rkey] = target
+
+        by_store = {}
+        for rkey, target in missing.items():
+            by_store.setdefault(target.store_id, []).append((rkey, target))
+
+        for store_id, items in by_store.items():
+            store = engine.get_store(store_id)
+            rkeys_store, targets_store = zip(*items)
+            times = self._evaluate(store, timing, source, targets_store)
+            entry.update(zip(rkeys_store, times))
+
+        return source.time + num.array(
+            [entry[rkey] for rkey in rkeys], dtype=num.float)
+
+    def get_times_many(self, engine, timings, source, targets):
+        '''
+        Get phase arrival times for a different timing at each target.
+
+        Targets are grouped by timing, see :py:meth:`get_times`.
+
+        :param timings: list with one timing per target
+        '''
+
+        groups = {}
+        for itarget, timing in enumerate(timings):
+            groups.setdefault(str(timing), []).append(itarget)
+
+        times = num.full(len(targets), num.nan)
+        for itargets in groups.values():
+            times[itargets] = self.get_times(
+                engine, timings[itargets[0]], source,
+                [targets[i] for i in itargets])
+
+        return times
+
+    def _evaluate(self, store, timing, source, targets):
+        try:
+            times, ifallback = self._evaluate_stored(
+                store, timing, source, targets)
+
+        except NotImplementedError:
+            times = num.full(len(targets), num.nan)
+            ifallback = range(len(targets))
+
+        for itarget in ifallback:
+            try:
+                t = store.t(timing, source, targets[itarget])
+            except gf.OutOfBounds:
+                t = None
+
+            times[itarget] = t if t is not None else num.nan
+
+        return times
+
+    def _evaluate_stored(self, store, timing, source, targets):
+        # Emulates pyrocko.gf.Timing.evaluate for stored phases, raises
+        # NotImplementedError for anything else. Returns times and indices
+        # of targets which have to be evaluated one by one.
+
+        if timing.offset_is == 'slowness' and timing.offset != 0.0:
+            raise NotImplementedError()
+
+        if isinstance(store.config, gf.ConfigTypeA):
+            args = [
+                num.full(len(targets), source.depth),
+                distances(source, targets)]
+
+        elif isinstance(store.config, gf.ConfigTypeB):
+            args = [
+                num.array([target.depth for target in targets]),
+                num.full(len(targets), source.depth),
+                distances(source, targets)]
+
+        else:
+            raise NotImplementedError()
+
+        if not timing.phase_defs:
+            return num.full(len(targets), timing.offset), []
+
+        phases = []
+        for phase_def in timing.phase_defs:
+            phase = store.get_phase(phase_def)
+            if not isinstance(phase, spit.SPTree):
+                raise NotImplementedError()
+
+            phases.append(phase)
+
+        x = num.ascontiguousarray(num.array(args, dtype=num.float).T)
+
+        values = num.empty((len(phases), len(targets)))
+        out_of_bounds = num.zeros(len(targets), dtype=num.bool)
+        for iphase, phase in enumerate(phases):
+            values[iphase] = interpolate_many(phase, x)
+            out_of_bounds |= num.any(num.logical_or(
+                x < phase.xbounds[:, 0], x > phase.xbounds[:, 1]), axis=1)
+
+        if timing.select == 'first':
+            times = num.min(values, axis=0)
+        elif timing.select == 'last':
+            times = num.max(values, axis=0)
+        else:
+            times = values[0].copy()
+
+        # undefined ordering with NaNs, leave these to Store.t
+        ifallback = num.where(num.logical_and(
+            ~num.all(num.isfinite(values), axis=0), ~out_of_bounds))[0]
+
+        if timing.offset_is == 'percent':
+            times = times*(1.+timing.offset/100.)
+        else:
+            times = times + timing.offset
+
+        times[out_of_bounds] = num.nan
+        return times, ifallback
+
+
+__all__ = '''
+    TimingTable
+'''.split()
@@ -108,7 +108,7 @@ class ToyProblem(Problem):
             * num.mean(num.abs(self._obs_distances))
         return misfits
 
-    def misfits_many(self, xs):
+    def misfits_many(self, xs, mask=None):
         self._setup_modelling()
         distances = num.sqrt(
             num.sum(
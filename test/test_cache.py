@@ -0,0 +1,207 @@
+import glob
+import os
+import os.path as op
+import shutil
+import tempfile
+from contextlib import contextmanager
+
+import numpy as num
+from scipy.linalg import sqrtm
+from pyrocko import config
+
+from grond import cache
+from grond.targets.base import inverse_sqrtm, get_noise_weight_matrix
+from grond.targets.satellite import SatelliteMisfitTarget, \
+    SatelliteMisfitConfig
+
+
+@contextmanager
+def temporary_cache_dir():
+    conf = config.raw_config()
+    cache_dir = conf.cache_dir
+    tempdir = tempfile.mkdtemp(prefix='grond-test-')
+    conf.cache_dir = tempdir
+    try:
+        yield tempdir
+    finally:
+        conf.cache_dir = cache_dir
+        shutil.rmtree(tempdir)
+
+
+def test_make_key():
+    a = num.arange(6.).reshape(2, 3)
+
+    # keys must not change between runs and versions
+    assert cache.make_key('inverse_sqrtm', a, 1.5) \
+        == '516c07c7c604bd929d195a64e9598ffe4bc309c1'
+
+    assert cache.make_key(a) == cache.make_key(num.asfortranarray(a))
+    assert cache.make_key(a) != cache.make_key(a.reshape(3, 2))
+    assert cache.make_key(a) != cache.make_key(a.astype(num.float32))
+    assert cache.make_key(a) != cache.make_key(a + 1e-12)
+    assert cache.make_key('a', 1) != cache.make_key('a', '1')
+
+
+def test_save_load_array():
+    with temporary_cache_dir():
+        a = num.random.RandomState(1).normal(size=(5, 4))
+        key = cache.make_key(a)
+
+        assert cache.load_array('test', key) is None
+
+        cache.save_array('test', key, a)
+        num.testing.assert_equal(cache.load_array('test', key), a)
+
+        dirname = cache.get_cache_dir('test')
+        assert glob.glob(op.join(dirname, '*')) == [
+            op.join(dirname, key + '.npy')]
+
+        ncalls = []
+
+        def func():
+            ncalls.append(1)
+            return a * 2.
+
+        for _ in range(2):
+            num.testing.assert_equal(
+                cache.cached_array('test', 'b', func), a * 2.)
+
+        assert len(ncalls) == 1
+
+
+def test_corrupt_cache_file():
+    with temporary_cache_dir():
+        cache.save_array('test', 'a', num.ones(10))
+        fn = op.join(cache.get_cache_dir('test'), 'a.npy')
+        with open(fn, 'wb') as f:
+            f.write(b'not an array')
+
+        assert cache.load_array('test', 'a') is None
+
+        num.testing.assert_equal(
+            cache.cached_array('test', 'a', lambda: num.zeros(3)),
+            num.zeros(3))
+
+        num.testing.assert_equal(cache.load_array('test', 'a'), num.zeros(3))
+
+
+def test_save_load_arrays():
+    with temporary_cache_dir():
+        arrays = dict(a=num.arange(5), b=num.ones((2, 3)))
+        assert cache.load_arrays('test', 'k') is None
+
+        cache.save_arrays('test', 'k', arrays)
+        loaded = cache.load_arrays('test', 'k')
+        assert sorted(loaded.keys()) == ['a', 'b']
+        for k in arrays:
+            num.testing.assert_equal(loaded[k], arrays[k])
+
+
+def test_prune():
+    with temporary_cache_dir():
+        for i in range(10):
+            cache.save_array('test', 'a%i' % i, num.zeros(1000))
+
+        dirname = cache.get_cache_dir('test')
+        size = op.getsize(op.join(dirname, 'a0.npy'))
+        for i in range(10):
+            os.utime(op.join(dirname, 'a%i.npy' % i), (i, i))
+
+        # loading marks a file as recently used
+        cache.load_array('test', 'a2')
+
+        assert cache.prune('test', size * 4) == 6
+        assert sorted(os.listdir(dirname)) == [
+            'a2.npy', 'a7.npy', 'a8.npy', 'a9.npy']
+
+        assert cache.prune('test', size * 4) == 0
+        assert cache.prune('nonexistent', 0) == 0
+
+
+def test_inverse_sqrtm():
+    rstate = num.random.RandomState(2)
+    x = rstate.normal(size=(50, 20))
+    covariance = num.dot(x.T, x) / 50. + num.eye(20)
+
+    weights = inverse_sqrtm(covariance)
+    num.testing.assert_allclose(
+        weights, sqrtm(num.linalg.inv(covariance)).real, atol=1e-10)
+    num.testing.assert_allclose(
+        weights.dot(covariance).dot(weights), num.eye(20), atol=1e-10)
+
+    with temporary_cache_dir():
+        for _ in range(2):
+            num.testing.assert_allclose(
+                get_noise_weight_matrix(covariance), weights, atol=1e-12)
+
+        assert len(glob.glob(op.join(
+            cache.get_cache_dir('noise_weight_matrix'), '*.npy'))) == 1
+
+
+class DummyQuadtree(object):
+    nleaves = 20
+    config = 'quadtree config'
+
+
+class DummyCovariance(object):
+    config = 'covariance config'
+
+    def __init__(self):
+        self.ncalls = 0
+
+    def getQuadtreeNoise(self, rstate):
+        self.ncalls += 1
+        return rstate.normal(size=DummyQuadtree.nleaves)
+
+
+class DummyScene(object):
+    displacement = num.arange(100.)
+    quadtree = DummyQuadtree()
+
+    def __init__(self):
+        self.covariance = DummyCovariance()
+
+
+class DummyDataset(object):
+    def __init__(self):
+        self.scene = DummyScene()
+
+    def get_kite_scene(self, scene_id):
+        return self.scene
+
+
+def test_satellite_noise_realisations():
+    n = DummyQuadtree.nleaves
+    ds = DummyDataset()
+    target = SatelliteMisfitTarget(
+        quantity='displacement',
+        scene_id='dummy',
+        lats=num.zeros(n),
+        lons=num.zeros(n),
+        east_shifts=num.zeros(n),
+        north_shifts=num.zeros(n),
+        theta=num.zeros(n),
+        phi=num.zeros(n),
+        path='insar',
+        misfit_config=SatelliteMisfitConfig())
+
+    target.set_dataset(ds)
+
+    def get_residuals(nbootstraps):
+        target.init_bootstrap_residuals(
+            nbootstraps, rstate=num.random.RandomState(10), nthreads=3)
+        return target.get_bootstrap_residuals().copy()
+
+    with temporary_cache_dir():
+        residuals = get_residuals(8)
+        assert ds.scene.covariance.ncalls == 8
+        assert len(set(residuals[:, 0])) == 8
+
+        # realisations depend on their seed only, not on the number of
+        # realisations or on the threads
+        num.testing.assert_equal(get_residuals(3), residuals[:3])
+        num.testing.assert_equal(get_residuals(12)[:8], residuals)
+        assert ds.scene.covariance.ncalls == 12
+
+    with temporary_cache_dir():
+        num.testing.assert_equal(get_residuals(8), residuals)
@@ -0,0 +1,112 @@
+import os
+import os.path as op
+import shutil
+import tempfile
+
+import numpy as num
+from nose.tools import assert_raises
+from pyrocko import trace
+
+from grond.dataset import WaveformCache, traces_to_arrays, arrays_to_traces
+
+
+def test_waveform_cache():
+    def tr(n):
+        return trace.Trace(ydata=num.zeros(n))
+
+    # room for three traces and a negative entry
+    nbytes_entry = WaveformCache.nbytes_entry
+    cache = WaveformCache(nbytes_max=3 * (8000 + nbytes_entry) + nbytes_entry)
+
+    cache['a'] = tr(1000)
+    cache['b'] = tr(1000)
+    cache['c'] = None
+    cache['d'] = tr(1000)
+    assert len(cache) == 4
+    assert cache.nnegative == 1
+    assert cache.nevictions == 0
+
+    assert cache['a'] is not None
+    assert cache['c'] is None
+
+    # 'b' is the least recently used entry now
+    cache['e'] = tr(1000)
+    assert 'b' not in cache
+    assert 'a' in cache
+    assert cache.nevictions == 1
+    assert cache.nbytes <= cache.nbytes_max
+
+    with assert_raises(KeyError):
+        cache['b']
+
+    assert (cache.nhits, cache.nhits_negative, cache.nmisses) == (1, 1, 1)
+
+    cache.clear()
+    assert len(cache) == 0
+    assert cache.nbytes == 0
+
+
+def test_traces_arrays_roundtrip():
+    trs = [
+        trace.Trace('', 'STA', '', c, tmin=10., deltat=0.5,
+                    ydata=num.arange(10. + i))
+        for i, c in enumerate('ZNE')]
+
+    trs2 = arrays_to_traces(traces_to_arrays(trs))
+    assert len(trs2) == len(trs)
+    for tr, tr2 in zip(trs, trs2):
+        assert tr.nslc_id == tr2.nslc_id
+        assert tr.tmin == tr2.tmin and tr.deltat == tr2.deltat
+        num.testing.assert_equal(tr.ydata, tr2.ydata)
+
+
+def test_persistent_cache_key():
+    from pyrocko import io, model
+    from grond.dataset import Dataset
+
+    tempdir = tempfile.mkdtemp(prefix='grond-test-')
+    try:
+        def write(sta, tmin, fn):
+            trs = [
+                trace.Trace('', sta, '', c, tmin=tmin, deltat=1.0,
+                            ydata=num.zeros(100))
+                for c in 'ZNE']
+            path = op.join(tempdir, fn)
+            io.save(trs, path)
+            return path
+
+        fn_a = write('A', 0., 'a.mseed')
+        write('B', 0., 'b.mseed')
+
+        station = model.Station('', 'A', '', lat=0., lon=0.)
+
+        def get_key():
+            ds = Dataset()
+            ds.add_waveforms([tempdir])
+            key = ds._get_persistent_cache_key(
+                station, 10., 50., 5., 'displacement', None)
+
+            # traces are not loaded to compute the key
+            for f in ds.pile.iter_files():
+                assert not f.data_loaded
+
+            return key
+
+        key = get_key()
+        assert get_key() == key
+
+        # files of other stations or outside the time span do not matter
+        write('B', 50., 'b2.mseed')
+        write('A', 1000., 'a2.mseed')
+        assert get_key() == key
+
+        # modified raw data files do
+        os.utime(fn_a, (1e9, 1e9))
+        key2 = get_key()
+        assert key2 != key
+
+        write('A', 40., 'a3.mseed')
+        assert get_key() != key2
+
+    finally:
+        shutil.rmtree(tempdir)
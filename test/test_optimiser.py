@@ -1,9 +1,458 @@
 from __future__ import absolute_import
 
 import glob
+import os.path as op
+import shutil
+import tempfile
+
+import numpy as num
+from nose.tools import assert_raises
+from pyrocko import gf
 
 from .common import grond, run_in_project
 from grond import config
+from grond.core import go
+from grond.meta import GrondError
+from grond.toy import scenario, ToyProblem
+from grond.problems.base import ModelHistory, HistoryWriter, \
+    load_problem_data, get_nmodels
+from grond.optimisers.highscore.optimiser import HighScoreOptimiser, \
+    HighScoreOptimiserConfig, UniformSamplerPhase, DirectedSamplerPhase, \
+    Chains, excentricity_compensated_probabilities, truncated_normal
+
+
+def toy_problem():
+    source, targets = scenario('wellposed', 'lownoise')
+    return ToyProblem(
+        name='toy_problem',
+        ranges={
+            'north': gf.Range(start=-10., stop=10.),
+            'east': gf.Range(start=-10., stop=10.),
+            'depth': gf.Range(start=0., stop=10.)},
+        base_source=source,
+        targets=targets)
+
+
+def run_toy_optimiser(rundir, nworkers=1, batch_size=1):
+    problem = toy_problem()
+    optimiser = HighScoreOptimiser(
+        sampler_phases=[
+            UniformSamplerPhase(
+                niterations=100, seed=1, batch_size=batch_size),
+            DirectedSamplerPhase(
+                niterations=400, seed=2, batch_size=batch_size)],
+        nbootstrap=10)
+
+    optimiser.set_nworkers(nworkers)
+    optimiser.init_bootstraps(problem)
+    problem.dump_problem_info(rundir)
+    optimiser.optimise(problem, rundir=rundir)
+
+    history = ModelHistory(
+        problem, nchains=optimiser.nchains, path=rundir, mode='r')
+    return history.models, history.misfits, history.bootstrap_misfits
+
+
+def test_batch_size():
+    tempdir = tempfile.mkdtemp(prefix='grond-test-')
+    try:
+        results = []
+        for batch_size in (1, 8, 33, 1):
+            rundir = op.join(tempdir, 'run-%i-%i' % (len(results), batch_size))
+            problem = toy_problem()
+            optimiser = HighScoreOptimiser(
+                sampler_phases=[
+                    UniformSamplerPhase(
+                        niterations=200, seed=1, batch_size=batch_size)],
+                nbootstrap=10)
+
+            optimiser.init_bootstraps(problem)
+            problem.dump_problem_info(rundir)
+            optimiser.optimise(problem, rundir=rundir)
+
+            history = ModelHistory(
+                problem, nchains=optimiser.nchains, path=rundir, mode='r')
+
+            results.append((
+                history.models, history.misfits, history.bootstrap_misfits))
+
+        for result in results[1:]:
+            for a, b in zip(results[0], result):
+                num.testing.assert_equal(a, b)
+
+        # directed phases draw each batch from the chains state at its
+        # start, runs are reproducible for a fixed seed
+        for a, b in zip(
+                run_toy_optimiser(op.join(tempdir, 'run-a'), batch_size=8),
+                run_toy_optimiser(op.join(tempdir, 'run-b'), batch_size=8)):
+
+            num.testing.assert_equal(a, b)
+
+    finally:
+        shutil.rmtree(tempdir)
+
+
+def test_workers():
+    tempdir = tempfile.mkdtemp(prefix='grond-test-')
+    try:
+        results = [
+            run_toy_optimiser(
+                op.join(tempdir, 'run-%i' % nworkers),
+                nworkers=nworkers, batch_size=16)
+            for nworkers in [1, 3]]
+
+        for a, b in zip(*results):
+            num.testing.assert_equal(a, b)
+
+    finally:
+        shutil.rmtree(tempdir)
+
+
+def test_workers_parallel():
+    class DummyEnvironment(object):
+        nevents_selected = 2
+
+    with assert_raises(GrondError):
+        go(DummyEnvironment(), nparallel=2, nworkers=2)
+
+
+def test_workers_no_batches():
+    from grond.optimisers.highscore import optimiser as hs
+
+    class NoPool(object):
+        def __init__(self, *args):
+            raise AssertionError('worker pool started for batch_size = 1')
+
+    MisfitsPool = hs.MisfitsPool
+    hs.MisfitsPool = NoPool
+    tempdir = tempfile.mkdtemp(prefix='grond-test-')
+    try:
+        run_toy_optimiser(op.join(tempdir, 'run'), nworkers=3, batch_size=1)
+
+    finally:
+        hs.MisfitsPool = MisfitsPool
+        shutil.rmtree(tempdir)
+
+
+def test_history_durability():
+    from grond.problems import base
+
+    nfsync = []
+
+    def fsync(fd):
+        nfsync.append(fd)
+
+    os_fsync = base.os.fsync
+    base.os.fsync = fsync
+    tempdir = tempfile.mkdtemp(prefix='grond-test-')
+    try:
+        for durability in ['flush', 'fsync']:
+            rundir = op.join(tempdir, durability)
+            problem = toy_problem()
+            optimiser = HighScoreOptimiserConfig(
+                sampler_phases=[UniformSamplerPhase(niterations=20, seed=1)],
+                nbootstrap=10,
+                history_durability=durability).get_optimiser()
+
+            optimiser.init_bootstraps(problem)
+            problem.dump_problem_info(rundir)
+            optimiser.optimise(problem, rundir=rundir)
+
+            assert (len(nfsync) > 0) == (durability == 'fsync')
+
+    finally:
+        base.os.fsync = os_fsync
+        shutil.rmtree(tempdir)
+
+
+def test_resume():
+    tempdir = tempfile.mkdtemp(prefix='grond-test-')
+    try:
+        for batch_size in (1, 7):
+            rundir = op.join(tempdir, 'run-%i' % batch_size)
+            reference = run_toy_optimiser(rundir, batch_size=batch_size)
+            nmodels = reference[0].shape[0]
+
+            class Interrupt(Exception):
+                pass
+
+            rundir = op.join(tempdir, 'run-%i-resumed' % batch_size)
+            for nmodels_interrupt in (150, 320, None):
+                problem = toy_problem()
+                optimiser = HighScoreOptimiser(
+                    sampler_phases=[
+                        UniformSamplerPhase(
+                            niterations=100, seed=1, batch_size=batch_size),
+                        DirectedSamplerPhase(
+                            niterations=400, seed=2, batch_size=batch_size)],
+                    nbootstrap=10)
+
+                optimiser.CHECKPOINT_INTERVAL = -1.
+                optimiser.init_bootstraps(problem)
+
+                resume = op.exists(rundir)
+                if resume:
+                    nevaluated = [get_nmodels(rundir, problem)]
+                else:
+                    nevaluated = [0]
+                    problem.dump_problem_info(rundir)
+
+                misfits_many = problem.misfits_many
+
+                def misfits_many_interrupted(xs, mask=None):
+                    nevaluated[0] += xs.shape[0]
+                    if nmodels_interrupt is not None and \
+                            nevaluated[0] > nmodels_interrupt:
+                        raise Interrupt()
+
+                    return misfits_many(xs, mask=mask)
+
+                problem.misfits_many = misfits_many_interrupted
+
+                try:
+                    optimiser.optimise(problem, rundir=rundir, resume=resume)
+                except Interrupt:
+                    pass
+
+            history = ModelHistory(
+                problem, nchains=optimiser.nchains, path=rundir, mode='r')
+
+            assert history.nmodels == nmodels
+            for a, b in zip(reference, (
+                    history.models,
+                    history.misfits,
+                    history.bootstrap_misfits)):
+
+                num.testing.assert_equal(a, b)
+
+    finally:
+        shutil.rmtree(tempdir)
+
+
+def test_history_read_mode():
+    tempdir = tempfile.mkdtemp(prefix='grond-test-')
+    try:
+        rundir = op.join(tempdir, 'run')
+        run_toy_optimiser(rundir)
+        problem = toy_problem()
+        models, misfits, _, sampler_contexts = load_problem_data(
+            rundir, problem)
+
+        # grow a second rundir while it is being read
+        rundir_grow = op.join(tempdir, 'run-grow')
+        problem.dump_problem_info(rundir_grow)
+        writer = HistoryWriter(rundir_grow)
+        writer.write(models[:100], misfits[:100], None, sampler_contexts[:100])
+        writer.flush()
+
+        history = ModelHistory(problem, path=rundir_grow, mode='r')
+        assert isinstance(history.models, num.memmap)
+        assert not history.models.flags.writeable
+        assert history.nmodels == 100
+
+        extended = []
+
+        class Listener(object):
+            def extend(self, ioffset, n, models, misfits, sampler_contexts):
+                extended.append((ioffset, n))
+
+        history.add_listener(Listener())
+
+        writer.write(models[100:], misfits[100:], None, sampler_contexts[100:])
+        writer.close()
+        history.update()
+
+        assert extended == [(100, models.shape[0] - 100)]
+        num.testing.assert_equal(history.models, models)
+        num.testing.assert_equal(history.misfits, misfits)
+        num.testing.assert_equal(history.sampler_contexts, sampler_contexts)
+
+    finally:
+        shutil.rmtree(tempdir)
+
+
+def chains_reference(bootstrap_misfits, nlinks_cap):
+    # one model at a time, re-sorting all links
+    nmodels, nchains = bootstrap_misfits.shape
+    chains_m = num.zeros((nchains, nlinks_cap))
+    chains_i = num.zeros((nchains, nlinks_cap), dtype=int)
+    accept = num.zeros((nchains, nmodels), dtype=bool)
+    nlinks = 0
+    for imodel in range(nmodels):
+        chains_m[:, nlinks] = bootstrap_misfits[imodel, :]
+        chains_i[:, nlinks] = imodel
+        nlinks += 1
+        for ichain in range(nchains):
+            isort = num.argsort(chains_m[ichain, :nlinks], kind='mergesort')
+            chains_m[ichain, :nlinks] = chains_m[ichain, isort]
+            chains_i[ichain, :nlinks] = chains_i[ichain, isort]
+
+        if nlinks == nlinks_cap:
+            accept[:, imodel] = chains_i[:, nlinks_cap-1] != imodel
+            nlinks -= 1
+        else:
+            accept[:, imodel] = True
+
+    return chains_m[:, :nlinks], chains_i[:, :nlinks], accept
+
+
+def test_chains_goto():
+    problem = toy_problem()
+    nchains, nlinks_cap, nmodels = 5, 25, 1000
+
+    rstate = num.random.RandomState(123)
+    bootstrap_misfits = rstate.uniform(size=(nmodels, nchains))
+    bootstrap_misfits[::7, 1] = num.inf
+    bootstrap_misfits[::11, 2] = num.nan
+    bootstrap_misfits[::3, 3] = num.round(
+        bootstrap_misfits[::3, 3], decimals=1)
+
+    history = ModelHistory(problem, nchains=nchains, path=None, mode='w')
+    chains = Chains(problem, history, nchains, nlinks_cap)
+
+    history.extend(
+        rstate.uniform(size=(nmodels, problem.nparameters)),
+        rstate.uniform(size=(nmodels, problem.nmisfits, 2)),
+        bootstrap_misfits,
+        num.zeros((nmodels, 4), dtype=int))
+
+    chains_m, chains_i, accept = chains_reference(
+        bootstrap_misfits, nlinks_cap)
+
+    num.testing.assert_equal(chains.chains_m[:, :chains.nlinks], chains_m)
+    num.testing.assert_equal(chains.chains_i[:, :chains.nlinks], chains_i)
+    num.testing.assert_equal(chains.acceptance_history, accept)
+    num.testing.assert_equal(chains.accept_sum, num.sum(accept, axis=1))
+
+
+def test_truncated_normal():
+    from scipy import stats
+
+    rstate = num.random.RandomState(123)
+    n = 5000
+    for xmin, xmax in [
+            (-1., 2.), (3., 4.), (-4., -3.), (10., 11.),
+            (40., 41.), (-45., -44.), (40., num.inf), (39., 39.0001)]:
+
+        # shifted and scaled, bounds flipped to the lower side
+        for mean, std in [(0., 1.), (5., 2.)]:
+            xs = truncated_normal(
+                num.full(n, mean), std,
+                mean + std * xmin, mean + std * xmax, rstate)
+
+            assert num.all(xs >= mean + std * xmin)
+            assert num.all(xs <= mean + std * xmax)
+
+            zs = (xs - mean) / std
+            assert stats.kstest(
+                zs, stats.truncnorm(xmin, xmax).cdf).pvalue > 0.001
+
+    # one random number per value, in row-major order
+    mean = num.zeros((3, 4))
+    xmaxs = num.array([1., 2., 3., 50.])
+    xs = truncated_normal(
+        mean, 1.0, xmaxs - 3., xmaxs, num.random.RandomState(1))
+
+    rstate_single = num.random.RandomState(1)
+    xs_single = [
+        truncated_normal(0., 1., xmax - 3., xmax, rstate_single)
+        for _ in range(3) for xmax in xmaxs]
+
+    num.testing.assert_equal(xs.ravel(), num.array(xs_single))
+    num.testing.assert_equal(
+        truncated_normal(mean, 0., -1., 1., rstate), mean)
+
+
+def test_chains_cache():
+    problem = toy_problem()
+    nchains, nlinks_cap, nmodels = 3, 20, 50
+
+    rstate = num.random.RandomState(42)
+    history = ModelHistory(problem, nchains=nchains, path=None, mode='w')
+    chains = Chains(problem, history, nchains, nlinks_cap)
+
+    def extend(models, bootstrap_misfits):
+        n = models.shape[0]
+        history.extend(
+            models,
+            rstate.uniform(size=(n, problem.nmisfits, 2)),
+            bootstrap_misfits,
+            num.zeros((n, 4), dtype=int))
+
+    extend(
+        rstate.uniform(size=(nmodels, problem.nparameters)),
+        rstate.uniform(size=(nmodels, nchains)))
+
+    estimators = [
+        'median_density_single_chain',
+        'standard_deviation_all_chains',
+        'standard_deviation_single_chain']
+
+    def check():
+        for estimator in estimators:
+            std = chains._standard_deviation_models(0, estimator)
+            num.testing.assert_equal(
+                chains.standard_deviation_models(0, estimator), std)
+
+            num.testing.assert_equal(
+                chains.excentricity_compensated_cumulative(
+                    0, estimator, 1.5),
+                num.cumsum(excentricity_compensated_probabilities(
+                    chains.models(0), std, 1.5)))
+
+    check()
+
+    # only the other chains accept the new, distant models
+    accept_sum = chains.accept_sum.copy()
+    bootstrap_misfits = num.zeros((10, nchains))
+    bootstrap_misfits[:, 0] = 10.
+    extend(
+        rstate.uniform(10., 20., size=(10, problem.nparameters)),
+        bootstrap_misfits)
+
+    assert chains.accept_sum[0] == accept_sum[0]
+    assert num.all(chains.accept_sum[1:] > accept_sum[1:])
+    check()
+
+
+def test_covariance_cholesky():
+    problem = toy_problem()
+    nchains, nlinks_cap, nmodels = 2, 30, 100
+
+    rstate = num.random.RandomState(7)
+    history = ModelHistory(problem, nchains=nchains, path=None, mode='w')
+    chains = Chains(problem, history, nchains, nlinks_cap)
+
+    models = rstate.normal(size=(nmodels, problem.nparameters))
+    models[:, 1] += 0.5 * models[:, 0]
+
+    # fixed parameter in chain 1
+    bootstrap_misfits = rstate.uniform(size=(nmodels, nchains))
+    bootstrap_misfits[nmodels//2:, 1] += 1.0
+    models[:nmodels//2, 2] = 3.0
+
+    history.extend(
+        models,
+        rstate.uniform(size=(nmodels, problem.nmisfits, 2)),
+        bootstrap_misfits,
+        num.zeros((nmodels, 4), dtype=int))
+
+    for ichain in range(nchains):
+        cov = num.cov(chains.models(ichain).T)
+        L = chains.covariance_cholesky(ichain)
+        num.testing.assert_allclose(L.dot(L.T), cov, atol=1e-12)
+
+    # singular covariance, eigendecomposition fallback
+    assert num.all(chains.models(1)[:, 2] == 3.0)
+    with assert_raises(num.linalg.LinAlgError):
+        num.linalg.cholesky(chains.covariance_models(1))
+
+    num.testing.assert_allclose(
+        chains.covariance_cholesky(1)[2, :], 0.0, atol=1e-12)
+
+    # positive definite covariances get the lower triangular factor
+    L = chains.covariance_cholesky(0)
+    num.testing.assert_equal(L, num.tril(L))
 
 
 def test_starting_point():
@@ -1,12 +1,20 @@
 from __future__ import print_function
+import os
 import os.path as op
+import shutil
+import tempfile
 import nose.tools as t
 
 import numpy as num
 
 from numpy.testing import assert_almost_equal as assert_ae
 from pyrocko import gf
+from pyrocko import moment_tensor as mtm
+from pyrocko.guts import List
 from grond.toy import scenario, ToyProblem, ToyTarget, ToySource
+from grond.meta import GrondError, ADict
+from grond.problems.base import Problem, HistoryStorage, HistoryWriter, \
+    ModelHistory, get_nmodels, load_problem_data
 
 
 def test_combine_misfits(dump=False, reference=None):
@@ -148,5 +156,473 @@ def test_combine_covariance():
     num.testing.assert_almost_equal(res_weights, res_corr)
 
 
+def test_combine_chunked():
+    source, targets = scenario('wellposed', 'noisefree')
+
+    p = ToyProblem(
+        name='toy_problem',
+        ranges={
+            'north': gf.Range(start=-10., stop=10.),
+            'east': gf.Range(start=-10., stop=10.),
+            'depth': gf.Range(start=0., stop=10.)},
+        base_source=source,
+        targets=targets)
+
+    rstate = num.random.RandomState(123)
+    nmodels = 100
+    nbootstrap = 11
+
+    misfits = rstate.uniform(size=(nmodels, p.nmisfits, 2))
+    extra_weights = rstate.uniform(size=(nbootstrap, p.nmisfits))
+    extra_residuals = rstate.normal(size=(nbootstrap, p.nmisfits))
+    extra_correlated_weights = {2: rstate.normal(size=(4, 4))}
+
+    for get_contributions in (False, True):
+        results = [
+            p.combine_misfits(
+                misfits,
+                extra_weights=extra_weights,
+                extra_residuals=extra_residuals,
+                extra_correlated_weights=extra_correlated_weights,
+                get_contributions=get_contributions,
+                memory_limit=memory_limit)
+            for memory_limit in (None, 1, 10000)]
+
+        for result in results[1:]:
+            num.testing.assert_equal(result, results[0])
+
+
+class WeightedToyTarget(ToyTarget):
+
+    def get_combined_weight(self):
+        if self._combined_weight is None:
+            self._combined_weight = num.full(self.nmisfits, self.manual_weight)
+
+        return self._combined_weight
+
+
+class WeightedToyProblem(ToyProblem):
+    targets = List.T(WeightedToyTarget.T())
+
+
+def toy_problem_multi_misfits():
+    targets = [
+        WeightedToyTarget(
+            path='t%i' % itarget,
+            north=float(itarget), east=0., depth=0., obs_distance=0.,
+            nmisfits=nmisfits,
+            normalisation_family=family,
+            manual_weight=1.0 + itarget)
+        for (itarget, (nmisfits, family)) in enumerate(
+            [(1, 'a'), (5, 'a'), (3, 'b'), (1, 'b')])]
+
+    return WeightedToyProblem(
+        name='toy_problem',
+        ranges={
+            'north': gf.Range(start=-10., stop=10.),
+            'east': gf.Range(start=-10., stop=10.),
+            'depth': gf.Range(start=0., stop=10.)},
+        base_source=ToySource(north=0., east=0., depth=5.),
+        targets=targets)
+
+
+def test_combine_aggregated():
+    p = toy_problem_multi_misfits()
+
+    rstate = num.random.RandomState(123)
+    misfits = rstate.uniform(size=(20, p.nmisfits, 2))
+    misfits[3, 1:6, :] = num.nan
+    extra_correlated_weights = {1: rstate.normal(size=(5, 5))}
+
+    aggregated = p.aggregate_misfits(misfits, extra_correlated_weights)
+    assert aggregated.shape == (20, p.ntargets, 2)
+    assert num.all(num.isnan(aggregated[3, 1, :]))
+
+    # expanded misfits aggregate to the same values again
+    num.testing.assert_allclose(
+        p.aggregate_misfits(p.expand_aggregated_misfits(aggregated)),
+        aggregated)
+
+    for get_contributions in (False, True):
+        combined = p.combine_misfits(
+            misfits, extra_correlated_weights=extra_correlated_weights,
+            get_contributions=get_contributions)
+
+        combined_aggregated = p.combine_misfits(
+            aggregated, aggregated=True,
+            get_contributions=get_contributions)
+
+        combined_expanded = p.combine_misfits(
+            p.expand_aggregated_misfits(aggregated),
+            get_contributions=get_contributions)
+
+        if get_contributions:
+            combined = num.array([
+                num.nansum(combined[..., imisfit:imisfit+target.nmisfits],
+                           axis=-1)
+                for (imisfit, target) in zip([0, 1, 6, 9], p.targets)]).T
+
+            # targets without data contribute nothing
+            combined_aggregated = num.nan_to_num(combined_aggregated)
+            combined_expanded = num.nan_to_num(
+                combined_expanded[..., [0, 1, 6, 9]])
+
+        num.testing.assert_allclose(combined_aggregated, combined)
+        num.testing.assert_allclose(combined_expanded, combined)
+
+    with t.assert_raises(GrondError):
+        p.combine_misfits(
+            aggregated, aggregated=True,
+            extra_weights=num.ones((2, p.ntargets)))
+
+
+def test_history_storage():
+    p = toy_problem_multi_misfits()
+
+    rstate = num.random.RandomState(123)
+    nmodels = 100
+    models = rstate.uniform(size=(nmodels, p.nparameters))
+    misfits = rstate.uniform(size=(nmodels, p.nmisfits, 2))
+
+    tempdir = tempfile.mkdtemp(prefix='grond-test-')
+    try:
+        for storage, misfits_expect in [
+                (HistoryStorage(), misfits),
+                (HistoryStorage(misfits_dtype='float32'),
+                 misfits.astype(num.float32)),
+                (HistoryStorage(compression='zlib'), misfits),
+                (HistoryStorage(aggregate_targets=True),
+                 p.aggregate_misfits(misfits)),
+                (HistoryStorage(aggregate_targets=True, compression='zlib'),
+                 p.aggregate_misfits(misfits))]:
+
+            rundir = op.join(tempdir, str(id(storage)))
+            os.mkdir(rundir)
+            writer = HistoryWriter(rundir, nbytes_flush=0, storage=storage)
+            for imodel in range(0, nmodels, 30):
+                writer.write(
+                    models[imodel:imodel+30], misfits_expect[imodel:imodel+30])
+
+            writer.close()
+
+            assert get_nmodels(rundir, p) == nmodels
+            models_load, misfits_load, _, _ = load_problem_data(
+                rundir, p, nmodels_skip=40)
+
+            if storage.aggregate_targets:
+                misfits_expect = p.expand_aggregated_misfits(misfits_expect)
+
+            num.testing.assert_equal(models_load, models[40:])
+            num.testing.assert_equal(misfits_load, misfits_expect[40:])
+
+            history = ModelHistory(p, path=rundir, mode='r')
+            num.testing.assert_equal(history.misfits, misfits_expect)
+            assert history.misfits_aggregated == storage.aggregate_targets
+
+    finally:
+        shutil.rmtree(tempdir)
+
+
+def test_aggregated_rundir_plot():
+    from grond.optimisers.plot import ContributionsPlot
+
+    p = toy_problem_multi_misfits()
+
+    rstate = num.random.RandomState(23)
+    nmodels, nchains = 50, 3
+    models = rstate.uniform(size=(nmodels, p.nparameters))
+    misfits = rstate.uniform(size=(nmodels, p.nmisfits, 2))
+    correlated_weights = {1: num.eye(5) + 0.1 * rstate.normal(size=(5, 5))}
+    bootstrap_misfits = p.combine_misfits(
+        misfits,
+        extra_weights=rstate.uniform(size=(nchains, p.nmisfits)),
+        extra_correlated_weights=correlated_weights)
+
+    class DummyOptimiser(object):
+        def get_correlated_weights(self, problem):
+            return correlated_weights
+
+    optimiser = DummyOptimiser()
+
+    tempdir = tempfile.mkdtemp(prefix='grond-test-')
+    try:
+        histories = []
+        for storage in [
+                HistoryStorage(), HistoryStorage(aggregate_targets=True)]:
+
+            rundir = op.join(tempdir, str(id(storage)))
+            os.mkdir(rundir)
+            writer = HistoryWriter(rundir, storage=storage)
+            if storage.aggregate_targets:
+                misfits_write = p.aggregate_misfits(
+                    misfits, correlated_weights)
+            else:
+                misfits_write = misfits
+
+            writer.write(models, misfits_write, bootstrap_misfits)
+            writer.close()
+
+            history = ModelHistory(
+                p, nchains=nchains, path=rundir, mode='r')
+
+            figs = ContributionsPlot().draw_figures(None, history, optimiser)
+            assert len(figs) == 1
+
+            histories.append(history)
+
+        gms_full, gms_aggregated = [
+            p.combine_misfits(
+                history.misfits,
+                extra_correlated_weights=history.get_correlated_weights(
+                    optimiser))
+            for history in histories]
+
+        num.testing.assert_allclose(gms_aggregated, gms_full)
+
+        with t.assert_raises(GrondError):
+            histories[1].bootstrap_misfits = None
+            histories[1].ensure_bootstrap_misfits(optimiser)
+
+    finally:
+        shutil.rmtree(tempdir)
+
+
+class PlanTarget(ToyTarget):
+
+    def prepare_modelling(self, engine, source, targets):
+        self._nprepared = getattr(self, '_nprepared', 0) + 1
+        # first target is shared by all
+        return [targets[0], self]
+
+    def finalize_modelling(
+            self, engine, source, modelling_targets, modelling_results):
+        return modelling_results
+
+
+class PlanProblem(ToyProblem):
+    targets = List.T(PlanTarget.T())
+
+    def get_source(self, x):
+        return ToySource(north=x[0], east=x[1], depth=x[2])
+
+
+class PlanEngine(object):
+
+    def __init__(self):
+        self.requests = []
+
+    def process(self, sources, targets, nthreads=0):
+        self.requests.append(targets)
+        return ADict(results_list=[
+            [(source.north, target.north) for target in targets]
+            for source in sources])
+
+
+def test_modelling_plan():
+    source, targets = scenario('wellposed', 'noisefree')
+    targets = [
+        PlanTarget(
+            path=target.path, north=target.north, east=target.east,
+            depth=target.depth, obs_distance=target.obs_distance)
+        for target in targets]
+
+    engine = PlanEngine()
+    p = PlanProblem(
+        name='plan_problem', ranges={}, base_source=source, targets=targets)
+    p.set_engine(engine)
+
+    x = num.array([1., 2., 3.])
+    results = Problem.evaluate(p, x)
+    for target, result in zip(targets, results):
+        assert result == [(1., targets[0].north), (1., target.north)]
+
+    assert len(engine.requests[-1]) == len(targets)
+
+    xs = num.array([[1., 2., 3.], [4., 5., 6.]])
+    results_many = Problem.evaluate_many(p, xs)
+    assert results_many[0] == results
+    assert results_many[1][3] == [
+        (4., targets[0].north), (4., targets[3].north)]
+
+    # new mask reuses prepared targets
+    mask = num.ones(len(targets), dtype=num.bool)
+    mask[0] = mask[3] = False
+    results = Problem.evaluate(p, x, mask=mask)
+    assert isinstance(results[3], gf.SeismosizerError)
+    assert results[1] == [(1., targets[0].north), (1., targets[1].north)]
+    assert len(engine.requests[-1]) == len(targets) - 1
+    assert all(target._nprepared == 1 for target in targets)
+
+    # new targets are prepared again
+    p.targets = targets[:5]
+    Problem.evaluate(p, x)
+    assert len(engine.requests[-1]) == 5
+    assert all(target._nprepared == 2 for target in targets[:5])
+
+
+def test_parameter_layout():
+    from pyrocko import model
+    from grond.problems import CMTProblemConfig
+
+    event = model.Event(
+        lat=10., lon=20., depth=5000., time=0., magnitude=6., name='ev')
+
+    ranges = {
+        'time': gf.Range('-5 .. 5 | add'),
+        'north_shift': gf.Range('-15e3 .. 15e3'),
+        'east_shift': gf.Range('-15e3 .. 15e3'),
+        'depth': gf.Range('5e3 .. 15e3'),
+        'magnitude': gf.Range('5. .. 7.'),
+        'rmnn': gf.Range('-1.41421 .. 1.41421'),
+        'rmee': gf.Range('-1.41421 .. 1.41421'),
+        'rmdd': gf.Range('-1.41421 .. 1.41421'),
+        'rmne': gf.Range('-1 .. 1'),
+        'rmnd': gf.Range('-1 .. 1'),
+        'rmed': gf.Range('-1 .. 1'),
+        'duration': gf.Range('1. .. 10.')}
+
+    p = CMTProblemConfig(name_template='cmt', ranges=ranges).get_problem(
+        event, [], [])
+
+    assert p.nparameters == len(p.problem_parameters) == 12
+    assert p.parameter_names[:5] == [
+        'time', 'north_shift', 'east_shift', 'depth', 'magnitude']
+    assert p.name_to_index('duration') == 11
+    assert p.name_to_index('strike1') == 12
+    with t.assert_raises(ValueError):
+        p.name_to_index('nonexistent')
+
+    xbounds = p.get_parameter_bounds()
+    assert xbounds.shape == (12, 2)
+    xbounds[:] = 0.
+    assert num.all(p.get_parameter_bounds()[:, 1] > 0.)
+
+    rstate = num.random.RandomState(2)
+    for i in range(10):
+        x = num.array(p.random_uniform(p.get_parameter_bounds(), rstate))
+        source = p.get_source(x)
+
+        # reference through parameter dictionary
+        d = p.get_parameter_dict(x)
+        assert source.time == p.base_source.time + d.time
+        assert source.depth == d.depth
+        assert source.stf.duration == d.duration
+        num.testing.assert_equal(
+            source.m6,
+            num.array([d.rmnn, d.rmee, d.rmdd, d.rmne, d.rmnd, d.rmed])
+            * mtm.magnitude_to_moment(d.magnitude))
+
+        num.testing.assert_equal(p.pack(source)[:4], x[:4])
+
+    # layout is rebuilt after invalidation
+    nparameters = p.nparameters
+    p.problem_parameters = p.problem_parameters[:-1]
+    assert p.nparameters == nparameters
+    p.invalidate_parameter_layout()
+    assert p.nparameters == nparameters - 1
+
+
+def make_random_store(store_dir, seed=0):
+    config = gf.ConfigTypeA(
+        id='random', ncomponents=10, sample_rate=2.,
+        receiver_depth=0.,
+        source_depth_min=0., source_depth_max=20e3, source_depth_delta=5e3,
+        distance_min=0., distance_max=200e3, distance_delta=10e3,
+        component_scheme='elastic10')
+
+    gf.Store.create(store_dir, config=config)
+    store = gf.Store(store_dir, 'w')
+    rstate = num.random.RandomState(seed)
+    for args in config.iter_nodes():
+        store.put(args, gf.GFTrace(
+            data=rstate.normal(size=200).astype(num.float32),
+            itmin=int(args[1] // 10e3), deltat=config.deltat))
+
+    store.close()
+
+
+def test_mt_elementary_cache():
+    from grond.problems.cmt.elementary import MTElementaryCache
+
+    tempdir = tempfile.mkdtemp(prefix='grond-test-')
+    try:
+        make_random_store(op.join(tempdir, 'random'))
+        engine = gf.LocalEngine(store_superdirs=[tempdir])
+
+        targets = [
+            gf.Target(
+                codes=('', 'S%i' % i, '', c),
+                north_shift=i*15e3 + 3e3, east_shift=i*7e3,
+                store_id='random', quantity=quantity,
+                interpolation='multilinear')
+            for i in range(1, 4)
+            for c in 'ZNE'
+            for quantity in ['displacement', 'velocity']]
+
+        # not supported, modelled with the engine
+        targets.append(gf.Target(
+            codes=('', 'S1', '', 'Z'), north_shift=20e3,
+            store_id='random', tmin=10., tmax=40.))
+
+        rstate = num.random.RandomState(1)
+        sources = []
+        for depth in [7e3, 9e3]:
+            for i in range(3):
+                sources.append(gf.MTSource(
+                    depth=depth, time=rstate.uniform(-10., 10.),
+                    m6=rstate.normal(size=6) * 1e18,
+                    stf=gf.HalfSinusoidSTF(duration=rstate.uniform(0., 5.))))
+
+        sources.append(gf.MTSource(depth=7e3, time=0.0, m6=num.ones(6)))
+
+        cache = MTElementaryCache()
+        results_list = cache.process(engine, sources, targets)
+        assert cache.nmisses == 2 * (len(targets) - 1)
+        assert cache.nhits == 5 * (len(targets) - 1)
+
+        def check(results_list, sources, targets):
+            results_list_ref = engine.process(sources, targets).results_list
+            for results, results_ref in zip(results_list, results_list_ref):
+                for result, result_ref in zip(results, results_ref):
+                    tr = result.trace
+                    tr_ref = result_ref.trace
+                    assert tr.codes == tr_ref.codes
+                    assert abs(tr.tmin - tr_ref.tmin) < 1e-6 * tr.deltat
+                    assert tr.data.size == tr_ref.data.size
+                    num.testing.assert_allclose(
+                        tr.data, tr_ref.data,
+                        rtol=0., atol=1e-5 * num.max(num.abs(tr_ref.data)))
+
+        check(results_list, sources, targets)
+
+        # with nearest neighbor interpolation, source depths snap to the
+        # depth nodes of the store (5 km spacing, halves round up)
+        for target in targets[:-1]:
+            target.interpolation = 'nearest_neighbor'
+
+        sources = [
+            gf.MTSource(
+                depth=depth, time=rstate.uniform(-10., 10.),
+                m6=rstate.normal(size=6) * 1e18)
+            for depth in [6e3, 7.4e3, 4e3, 7.5e3, 12e3]]
+
+        cache = MTElementaryCache()
+        results_list = cache.process(engine, sources, targets)
+        assert cache.nmisses == 2 * (len(targets) - 1)
+        assert cache.nhits == 3 * (len(targets) - 1)
+        check(results_list, sources, targets)
+
+        # out of bounds, like the engine
+        source = gf.MTSource(depth=23e3, m6=num.ones(6))
+        with t.assert_raises(gf.SeismosizerError):
+            engine.process(source, targets[:-1])
+
+        with t.assert_raises(gf.SeismosizerError):
+            cache.process(engine, [source], targets[:-1])
+
+    finally:
+        shutil.rmtree(tempdir)
+
+
 def dump_combine_misfits():
     test_combine_misfits(dump='combined_misfits.npz')
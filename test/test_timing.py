@@ -0,0 +1,112 @@
+import numpy as num
+from pyrocko import gf, spit
+
+from grond.timing import TimingTable, interpolate_many
+
+
+class DummyStore(object):
+
+    t = gf.Store.t
+    get_phase = gf.Store.get_phase
+
+    def __init__(self):
+        self.config = gf.ConfigTypeA(
+            id='dummy',
+            ncomponents=10,
+            sample_rate=1.0,
+            source_depth_min=0.,
+            source_depth_max=20e3,
+            source_depth_delta=1e3,
+            distance_min=0.,
+            distance_max=500e3,
+            distance_delta=1e3)
+
+        def f_p(x):
+            return (x[0]**2 + x[1]**2)**0.5 / 6000.
+
+        def f_s(x):
+            return (x[0]**2 + x[1]**2)**0.5 / 3500.
+
+        xbounds = num.array([[0., 20e3], [0., 400e3]])
+        self.phases = dict(
+            (phase_id, spit.SPTree(
+                f=f, ftol=0.01, xbounds=xbounds, xtols=[1e3, 10e3]))
+            for (phase_id, f) in [('P', f_p), ('S', f_s)])
+
+        self.ncalls = 0
+
+    def get_stored_phase(self, phase_id, attribute='phase'):
+        self.ncalls += 1
+        return self.phases[phase_id]
+
+
+class DummyEngine(object):
+    def __init__(self):
+        self.store = DummyStore()
+
+    def get_store(self, store_id):
+        return self.store
+
+
+def test_timing_table():
+    engine = DummyEngine()
+    store = engine.store
+
+    targets = [
+        gf.Target(
+            store_id='dummy', lat=10., lon=10. + i * 0.5,
+            codes=('', 'STA%i' % i, '', 'Z'))
+        for i in range(10)]
+
+    targets.extend(
+        gf.Target(
+            store_id='dummy', lat=10., lon=10., north_shift=i*10e3,
+            codes=('', 'LOC%i' % i, '', 'Z'))
+        for i in range(3))
+
+    source = gf.DCSource(lat=10., lon=10., depth=5e3, time=100.)
+
+    table = TimingTable()
+    for timing in ['{stored:P}', '{stored:P}-10', '{stored:S}+5%',
+                   'first{stored:P|stored:S}', 'last{stored:P|stored:S}',
+                   '20', 'vel:8']:
+
+        times = table.get_times(engine, timing, source, targets)
+        for target, t in zip(targets, times):
+            try:
+                t_ref = source.time + store.t(timing, source, target)
+            except gf.OutOfBounds:
+                t_ref = num.nan
+
+            num.testing.assert_equal(t, t_ref)
+
+        # out of bounds
+        assert num.isnan(times[-5]) != (timing in ('20', 'vel:8'))
+
+    ncalls = store.ncalls
+    times = table.get_times(engine, '{stored:P}', source, targets)
+    assert store.ncalls == ncalls
+
+    table.clear()
+    times2 = table.get_times(engine, '{stored:P}', source, targets)
+    assert store.ncalls > ncalls
+    num.testing.assert_equal(times, times2)
+
+
+def test_interpolate_many():
+    store = DummyStore()
+    tree = store.phases['S']
+    rstate = num.random.RandomState(1)
+    x = num.vstack([
+        rstate.uniform(-1e3, 21e3, size=(500, 2)) * [1., 20.],
+        num.array([[d, r] for d in num.arange(0., 21e3, 2.5e3)
+                   for r in num.arange(0., 420e3, 25e3)])])
+
+    values = interpolate_many(tree, x)
+    for xx, v in zip(x, values):
+        try:
+            v_ref = tree.interpolate(xx)
+        except spit.OutOfBounds:
+            v_ref = num.nan
+
+        num.testing.assert_equal(v, v_ref)
@@ -0,0 +1,239 @@
+import numpy as num
+from nose.tools import assert_raises
+from pyrocko import trace, gf
+
+from grond.targets.waveform.target import (
+    WaveformMisfitTarget, WaveformMisfitConfig, misfit, spectral_misfits,
+    transfer_many, _autoshift_lx_norm)
+
+
+domains = [
+    'time_domain', 'envelope', 'absolute', 'frequency_domain',
+    'log_frequency_domain', 'cc_max_norm']
+
+
+def make_traces(n=1000, deltat=0.1):
+    rstate = num.random.RandomState(123)
+    tr_obs = trace.Trace(
+        '', 'STA', '', 'Z', tmin=1000., deltat=deltat,
+        ydata=rstate.normal(size=n))
+    tr_syn = tr_obs.copy()
+    tr_syn.set_ydata(tr_obs.ydata + rstate.normal(scale=0.3, size=n))
+    return tr_obs, tr_syn
+
+
+def test_processed_obs_cache():
+    tr_obs, tr_syn = make_traces()
+    target = WaveformMisfitTarget(
+        path='test',
+        codes=tr_obs.nslc_id,
+        misfit_config=WaveformMisfitConfig(fmin=0.1, fmax=1.0))
+
+    for domain in domains:
+        for tautoshift_max in (0.0, 1.0):
+            taper = trace.CosTaper(1010., 1020., 1060., 1070.)
+            kwargs = dict(
+                taper=taper,
+                domain=domain,
+                exponent=2,
+                tautoshift_max=tautoshift_max,
+                autoshift_penalty_max=0.1,
+                flip=False)
+
+            mr = misfit(tr_obs, tr_syn, **kwargs)
+
+            processed = target.get_processed_obs(
+                tr_obs, 0.0, taper, domain, tbins=(0, 1))
+            assert target.get_processed_obs(
+                tr_obs, 0.0, taper, domain, tbins=(0, 1)) is processed
+
+            mr_cached = misfit(
+                tr_obs, tr_syn, processed_obs=processed, **kwargs)
+
+            num.testing.assert_equal(mr.misfits, mr_cached.misfits)
+
+    assert len(target._processed_obs_cache) == len(domains)
+
+    target.processed_obs_cache_size = 2
+    for i in range(5):
+        taper = trace.CosTaper(1010., 1020. + i, 1060., 1070.)
+        target.get_processed_obs(
+            tr_obs, 0.0, taper, 'time_domain', tbins=(0, 1))
+
+    assert len(target._processed_obs_cache) == 2
+
+    target.set_dataset(None)
+    assert len(target._processed_obs_cache) == 0
+
+
+def autoshift_lx_norm_loop(a, b, nshift_max, norm):
+    mns = []
+    for ishift in range(-nshift_max, nshift_max+1):
+        if ishift < 0:
+            a_cut = a[-ishift:]
+            b_cut = b[:ishift]
+        elif ishift == 0:
+            a_cut = a
+            b_cut = b
+        elif ishift > 0:
+            a_cut = a[:-ishift]
+            b_cut = b[ishift:]
+
+        mns.append(trace.Lx_norm(a_cut, b_cut, norm=norm))
+
+    ms, ns = num.array(mns).T
+    iarg = num.argmin(ms)
+    return iarg - nshift_max, ms[iarg], ns[iarg]
+
+
+def test_autoshift():
+    rstate = num.random.RandomState(42)
+    n = 500
+    a = rstate.normal(size=n)
+    cases = [
+        (a, rstate.normal(size=n)),
+        (a, num.roll(a, 7)),
+        (a, a.copy()),
+        (a, num.roll(a, -3) + rstate.normal(scale=1e-6, size=n)),
+        (num.zeros(n), num.zeros(n)),
+        (num.ones(n), num.ones(n))]
+
+    for norm in (1, 2, 3):
+        for a, b in cases:
+            for nshift_max in (1, 10, n-1):
+                assert _autoshift_lx_norm(a, b, nshift_max, norm) \
+                    == autoshift_lx_norm_loop(a, b, nshift_max, norm)
+
+
+def test_spectral_misfits():
+    rstate = num.random.RandomState(10)
+    tr_obs, _ = make_traces()
+    trs_syn = []
+    tapers = []
+    for i in range(5):
+        tr_syn = tr_obs.copy()
+        tr_syn.set_ydata(
+            tr_obs.ydata + rstate.normal(scale=0.1*(i+1), size=1000))
+        trs_syn.append(tr_syn)
+        tapers.append(trace.CosTaper(
+            1010. + i, 1020. + i, 1060. + i, 1070. + i))
+
+    for domain in ('frequency_domain', 'log_frequency_domain'):
+        for exponent in (1, 2, 3):
+            for flip in (False, True):
+                mrs = [
+                    misfit(
+                        tr_obs, tr_syn, taper=taper, domain=domain,
+                        exponent=exponent, tautoshift_max=0.0,
+                        autoshift_penalty_max=0.0, flip=flip,
+                        result_mode='full')
+                    for (tr_syn, taper) in zip(trs_syn, tapers)]
+
+                ms, ns, _, _ = spectral_misfits(
+                    trs_syn, tapers,
+                    num.array([mr.spectrum_obs.ydata for mr in mrs]),
+                    domain, exponent, flip)
+
+                for i, mr in enumerate(mrs):
+                    assert tuple(mr.misfits[0]) == (ms[i], ns[i])
+
+
+class DummyStore(object):
+    config = None
+
+    def t(self, timing, source, target):
+        return timing.offset + target.north_shift * 1e-3
+
+
+class DummyEngine(object):
+    def get_store(self, store_id):
+        return DummyStore()
+
+
+class DummyDataset(object):
+    def __init__(self, trs):
+        self.trs = dict((tr.nslc_id, tr) for tr in trs)
+
+    def get_pick(self, *args):
+        return None
+
+    def get_waveform(self, nslc, tmin, tmax, **kwargs):
+        return self.trs[nslc].chop(tmin, tmax, inplace=False)
+
+
+def test_post_process_many():
+    rstate = num.random.RandomState(11)
+    deltat = 0.5
+    n = 1000
+    engine = DummyEngine()
+    source = gf.DCSource(time=0.0)
+
+    targets = []
+    trs_obs = []
+    trs_syn = []
+    for i, domain in enumerate(domains * 2):
+        target = WaveformMisfitTarget(
+            path='test',
+            codes=('', 'STA%i' % i, '', 'Z'),
+            north_shift=i * 1000.,
+            store_id='dummy',
+            misfit_config=WaveformMisfitConfig(
+                fmin=0.02, fmax=0.2, tmin=gf.Timing('100'),
+                tmax=gf.Timing('300'), domain=domain,
+                norm_exponent=1 + i % 2,
+                tautoshift_max=2.0 * (i % 3)))
+
+        data = num.cumsum(rstate.normal(size=n))
+        trs_obs.append(trace.Trace(
+            *target.codes, tmin=-50., deltat=deltat, ydata=data))
+        trs_syn.append(gf.meta.SeismosizerTrace(
+            codes=target.codes, tmin=-50., deltat=deltat,
+            data=data + rstate.normal(scale=5., size=n)))
+        targets.append(target)
+
+    ds = DummyDataset(trs_obs)
+    for target in targets:
+        target.set_dataset(ds)
+
+    results = {}
+    for result_mode in ('sparse', 'full'):
+        for target in targets:
+            target.set_result_mode(result_mode)
+
+        results[result_mode] = WaveformMisfitTarget.post_process_many(
+            engine, source, targets, trs_syn)
+
+    for mr_sparse, mr_full in zip(results['sparse'], results['full']):
+        num.testing.assert_equal(mr_sparse.misfits, mr_full.misfits)
+
+
+def test_transfer_many():
+    rstate = num.random.RandomState(12)
+    trs = []
+    for i, n in enumerate([500, 700, 501, 1000]):
+        trs.append(trace.Trace(
+            '', 'STA%i' % i, '', 'Z', tmin=100. + i, deltat=0.5,
+            ydata=num.cumsum(rstate.normal(size=n))))
+
+    freqlimits = (0.01, 0.02, 0.2, 0.3)
+    for transfer_function in (None, trace.DifferentiationResponse(1)):
+        for tfade in (0., 20.):
+            trs_filtered = [
+                tr.transfer(
+                    tfade=tfade, freqlimits=freqlimits,
+                    transfer_function=transfer_function)
+                for tr in trs]
+
+            for i in range(2):
+                trs_filtered_many = transfer_many(
+                    trs, tfade, freqlimits, transfer_function,
+                    cache_key=str(transfer_function))
+
+                for tr, tr_many in zip(trs_filtered, trs_filtered_many):
+                    assert tr.tmin == tr_many.tmin
+                    num.testing.assert_equal(tr.ydata, tr_many.ydata)
+
+    tr_short = trs[0].copy()
+    tr_short.chop(tr_short.tmin, tr_short.tmin + 30.)
+    with assert_raises(trace.TraceTooShort):
+        transfer_many(trs + [tr_short], 20., freqlimits)